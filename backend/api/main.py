@@ -9,7 +9,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Import routers using absolute imports
-from routers import stats, topic_analysis
+from routers import stats, topic_analysis, pipeline_progress
 
 # Import auth router
 from auth.router import router as auth_router
@@ -69,6 +69,9 @@ async def root():
             "home_stats": "/api/home/stats?data_type={email|chat|ticket|twitter|voice}",
             "cluster_options": "/api/topic-analysis/clusters?data_type={email|chat|ticket|twitter|voice}",
             "topic_documents": "/api/topic-analysis/documents?data_type={email|chat|ticket|twitter|voice}",
+            "cluster_matrix": "/api/topic-analysis/cluster-matrix?data_type={email|chat|ticket|socialmedia|voice}",
+            "pipeline_progress": "/api/pipeline/progress",
+            "pipeline_progress_stream": "/api/pipeline/progress/stream",
             "health_check": "/health",
             "docs": "/docs",
             "redoc": "/redoc"
@@ -88,6 +91,7 @@ app.include_router(public_router)  # Public router for basic endpoints
 app.include_router(auth_router, prefix="/api")  # Auth router
 app.include_router(stats.router, prefix="/api/v1")  # Stats router with version prefix
 app.include_router(topic_analysis.router, prefix="/api")  # Topic analysis router
+app.include_router(pipeline_progress.router, prefix="/api")  # Generator progress (SSE) router
 
 # Global exception handler
 @app.exception_handler(Exception)
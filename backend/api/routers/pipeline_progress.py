@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from pymongo import database
+from dependencies import get_database
+
+# Import authentication dependencies
+from auth.dependencies import get_current_user
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(tags=["pipeline-progress"])
+
+# Collection written by pipeline_common.progress.ProgressPublisher in the generators
+PROGRESS_COLLECTION = "pipeline_progress"
+# Generators publish every few seconds; a job silent for longer than this is flagged as stalled
+STALLED_AFTER_SECONDS = 120
+SSE_HEARTBEAT_SECONDS = 15
+
+
+def serialize_progress(doc: dict, now: datetime) -> dict:
+    """Convert a progress document to JSON-safe output with staleness and collapse indicators"""
+    doc = dict(doc)
+    doc["job_id"] = str(doc.pop("_id"))
+    updated_at = doc.get("updated_at")
+    if isinstance(updated_at, datetime):
+        seconds_since_update = (now - updated_at).total_seconds()
+        doc["seconds_since_update"] = round(seconds_since_update, 1)
+        doc["stalled"] = doc.get("status") == "running" and seconds_since_update > STALLED_AFTER_SECONDS
+    # Recent vs. overall throughput: well below 1.0 means the job has slowed down
+    overall = doc.get("throughput_per_sec") or 0
+    recent = doc.get("recent_throughput_per_sec")
+    doc["throughput_ratio"] = round(recent / overall, 3) if overall and recent is not None else None
+    for key, value in doc.items():
+        if isinstance(value, datetime):
+            doc[key] = value.isoformat()
+    return doc
+
+
+def build_progress_query(job_name: Optional[str], active_within_minutes: int, updated_after: Optional[datetime] = None) -> dict:
+    query = {"updated_at": {"$gte": datetime.utcnow() - timedelta(minutes=active_within_minutes)}}
+    if updated_after is not None:
+        query["updated_at"]["$gt"] = updated_after
+    if job_name:
+        query["job_name"] = job_name
+    return query
+
+
+def fetch_progress(collection, query: dict) -> list:
+    return list(collection.find(query).sort("updated_at", 1))
+
+
+@router.get("/pipeline/progress")
+async def get_pipeline_progress(
+    job_name: Optional[str] = None,
+    active_within_minutes: int = Query(60, ge=1, le=7 * 24 * 60),
+    db: database.Database = Depends(get_database),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get the latest progress snapshot for generator jobs
+
+    Args:
+        job_name: Optional job filter (e.g. email_generator_ollama)
+        active_within_minutes: Only include jobs that published within this window
+
+    Returns:
+        Per-job throughput, success/failure rates, ETA and active concurrency
+    """
+    try:
+        now = datetime.utcnow()
+        docs = fetch_progress(db[PROGRESS_COLLECTION], build_progress_query(job_name, active_within_minutes))
+        return {
+            "status": "success",
+            "jobs": [serialize_progress(doc, now) for doc in docs],
+            "generated_at": now.isoformat()
+        }
+    except Exception as e:
+        logger.error(f"Error fetching pipeline progress: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+
+@router.get("/pipeline/progress/stream")
+async def stream_pipeline_progress(
+    request: Request,
+    job_name: Optional[str] = None,
+    active_within_minutes: int = Query(60, ge=1, le=7 * 24 * 60),
+    poll_seconds: float = Query(2.0, ge=0.5, le=60),
+    db: database.Database = Depends(get_database),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Stream generator progress as Server-Sent Events
+
+    Sends every active job once on connect, then one `progress` event per job
+    update. A comment heartbeat keeps proxies from closing idle connections.
+    """
+    collection = db[PROGRESS_COLLECTION]
+
+    async def event_stream():
+        last_seen = None
+        last_sent = asyncio.get_event_loop().time()
+        while True:
+            if await request.is_disconnected():
+                logger.info("Pipeline progress stream client disconnected")
+                break
+            try:
+                query = build_progress_query(job_name, active_within_minutes, last_seen)
+                docs = await asyncio.to_thread(fetch_progress, collection, query)
+            except Exception as e:
+                logger.error(f"Error polling pipeline progress: {str(e)}")
+                yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+                await asyncio.sleep(poll_seconds)
+                continue
+
+            now = datetime.utcnow()
+            for doc in docs:
+                last_seen = doc["updated_at"] if last_seen is None else max(last_seen, doc["updated_at"])
+                yield f"event: progress\ndata: {json.dumps(serialize_progress(doc, now), default=str)}\n\n"
+                last_sent = asyncio.get_event_loop().time()
+
+            if asyncio.get_event_loop().time() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = asyncio.get_event_loop().time()
+            await asyncio.sleep(poll_seconds)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
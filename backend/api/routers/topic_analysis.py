@@ -1,4 +1,5 @@
 import logging
+import time
 from typing import Literal, Optional, List, Dict, Any
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pymongo import database
@@ -211,6 +212,28 @@ class TopicAnalysisResponse(BaseModel):
     pagination: Dict[str, Any]
     documents: List[DocumentResponse]  # Use union type to handle all document types
 
+class ClusterMatrixResponse(BaseModel):
+    status: str
+    data_type: str
+    domain: str
+    cached: bool
+    computed_at: str
+    collection_version: Dict[str, Any]
+    total_documents: int
+    dimensions: Dict[str, List[Any]]
+    cells: List[Dict[str, Any]]
+
+# Dimensions of the cluster matrix, in the order they are grouped and sorted
+CLUSTER_MATRIX_DIMENSIONS = ["kmeans_cluster_id", "subcluster_id", "channel", "urgency", "priority"]
+
+# How long a memoized matrix is served without re-reading the collection version,
+# and the hard upper bound on its age (label propagation does not bump the version)
+CLUSTER_MATRIX_VERSION_CHECK_SECONDS = 30
+CLUSTER_MATRIX_MAX_AGE_SECONDS = 600
+
+# (data_type, domain) -> {"version": ..., "checked_at": ..., "created_at": ..., "response": ...}
+_cluster_matrix_cache: Dict[tuple, Dict[str, Any]] = {}
+
 def get_collection(db: database.Database, data_type: str):
     """Helper function to get collection with multiple access patterns"""
     collection_map = {
@@ -257,9 +280,40 @@ def get_base_query(collection, domain: str):
         if total_docs_no_filter > 0:
             base_query = {}
             logger.info(f"Using query without domain filter, found {total_docs_no_filter} documents")
-    
+
     return base_query
 
+def get_collection_version(collection) -> Dict[str, Any]:
+    """Cheap fingerprint of a collection, used to invalidate memoized aggregations"""
+    latest_clustering = collection.find_one(
+        {"clustering_updated_at": {"$exists": True}},
+        {"_id": 0, "clustering_updated_at": 1},
+        sort=[("clustering_updated_at", -1)]
+    )
+    return {
+        "document_count": collection.estimated_document_count(),
+        "clustering_updated_at": latest_clustering.get("clustering_updated_at") if latest_clustering else None
+    }
+
+def build_cluster_matrix_pipeline(base_query: Dict[str, Any], data_type: str) -> List[Dict[str, Any]]:
+    """Single $group pass counting documents per (cluster, subcluster, channel, urgency, priority)"""
+    return [
+        {"$match": {**base_query, "kmeans_cluster_id": {"$ne": None}}},
+        {"$group": {
+            "_id": {
+                "kmeans_cluster_id": "$kmeans_cluster_id",
+                "subcluster_id": {"$ifNull": ["$subcluster_id", None]},
+                # Only socialmedia documents carry a channel; other collections are their own channel
+                "channel": {"$ifNull": ["$channel", data_type]},
+                # Urgency is stored as a bool in most collections and as "true" in a few older ones
+                "urgency": {"$in": [{"$ifNull": ["$urgency", False]}, [True, "true"]]},
+                "priority": {"$ifNull": ["$priority", None]}
+            },
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {f"_id.{dimension}": 1 for dimension in CLUSTER_MATRIX_DIMENSIONS}}
+    ]
+
 @router.get("/topic-analysis/clusters")
 async def get_cluster_options(
     data_type: Literal["email", "chat", "ticket", "socialmedia", "voice"],
@@ -713,6 +767,103 @@ async def get_cluster_options(
             detail=f"Error retrieving cluster options: {str(e)}"
         )
 
+@router.get("/topic-analysis/cluster-matrix")
+async def get_cluster_matrix(
+    data_type: Literal["email", "chat", "ticket", "socialmedia", "voice"] = Query(..., description="Type of data (email, chat, ticket, socialmedia, voice)"),
+    domain: Literal["banking"] = Query("banking", description="Domain filter"),
+    refresh: bool = Query(False, description="Bypass the memoized matrix and recompute it"),
+    db: database.Database = Depends(get_database),
+    current_user: dict = Depends(get_current_user)
+) -> ClusterMatrixResponse:
+    """
+    Get document counts for every (kmeans_cluster_id, subcluster_id, channel, urgency, priority)
+    combination in a single aggregation, so heatmaps and drilldowns need one request
+
+    The matrix is memoized per data type and domain and reused until the collection
+    version (document count and latest clustering_updated_at) changes.
+
+    Args:
+        data_type: Type of data (email, chat, ticket, socialmedia, voice)
+        domain: Domain filter (banking)
+        refresh: Force recomputation even if the memoized matrix is still current
+
+    Returns:
+        Matrix cells with counts, the distinct values of each dimension and the collection version
+    """
+    try:
+        collection = get_collection(db, data_type)
+        cache_key = (data_type, domain)
+        now = time.time()
+        cached_entry = _cluster_matrix_cache.get(cache_key)
+
+        if cached_entry and not refresh and now - cached_entry["created_at"] < CLUSTER_MATRIX_MAX_AGE_SECONDS:
+            if now - cached_entry["checked_at"] < CLUSTER_MATRIX_VERSION_CHECK_SECONDS:
+                logger.info(f"Serving memoized cluster matrix for {data_type} (version check skipped)")
+                return ClusterMatrixResponse(**{**cached_entry["response"], "cached": True})
+
+            collection_version = get_collection_version(collection)
+            if collection_version == cached_entry["version"]:
+                cached_entry["checked_at"] = now
+                logger.info(f"Serving memoized cluster matrix for {data_type} (version unchanged)")
+                return ClusterMatrixResponse(**{**cached_entry["response"], "cached": True})
+        else:
+            collection_version = get_collection_version(collection)
+
+        base_query = get_base_query(collection, domain)
+        pipeline = build_cluster_matrix_pipeline(base_query, data_type)
+        logger.info(f"Computing cluster matrix for {data_type} with base query: {base_query}")
+
+        cells = []
+        dimension_values = {dimension: set() for dimension in CLUSTER_MATRIX_DIMENSIONS}
+        total_documents = 0
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            cell = {**group["_id"], "count": group["count"]}
+            cells.append(cell)
+            total_documents += group["count"]
+            for dimension in CLUSTER_MATRIX_DIMENSIONS:
+                dimension_values[dimension].add(cell.get(dimension))
+
+        logger.info(f"Cluster matrix for {data_type}: {len(cells)} cells covering {total_documents} documents")
+
+        response_data = {
+            "status": "success",
+            "data_type": data_type,
+            "domain": domain,
+            "cached": False,
+            "computed_at": datetime.now().isoformat(),
+            "collection_version": collection_version,
+            "total_documents": total_documents,
+            # None sorts first so "unassigned" buckets lead each axis, then numbers
+            # in numeric order (cluster ids), then everything else as text
+            "dimensions": {
+                dimension: sorted(values, key=lambda value: (
+                    value is not None,
+                    not isinstance(value, (int, float)),
+                    value if isinstance(value, (int, float)) else str(value),
+                ))
+                for dimension, values in dimension_values.items()
+            },
+            "cells": cells
+        }
+
+        _cluster_matrix_cache[cache_key] = {
+            "version": collection_version,
+            "checked_at": now,
+            "created_at": now,
+            "response": response_data
+        }
+
+        return ClusterMatrixResponse(**response_data)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error computing cluster matrix for {data_type}: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error computing cluster matrix: {str(e)}"
+        )
+
 @router.get("/topic-analysis/documents")
 async def get_topic_analysis_documents(
     data_type: Literal["email", "chat", "ticket", "socialmedia", "voice"] = Query(..., description="Type of data (email, chat, ticket, socialmedia, voice)"),
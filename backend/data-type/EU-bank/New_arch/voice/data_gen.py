@@ -22,8 +22,12 @@ import psutil
 from pathlib import Path
 from pymongo import UpdateOne
 from asyncio import Semaphore
+from contextlib import asynccontextmanager
 import traceback
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_common.progress import ProgressPublisher
+
 # Load environment variables
 load_dotenv()
 
@@ -138,18 +142,50 @@ class PerformanceMonitor:
         self.calls_processed = 0
         self.successful_requests = 0
         self.failed_requests = 0
+        self.active_requests = 0
         self._lock = asyncio.Lock()
+        self.progress = ProgressPublisher("voice_generator_ollama", max_concurrency=MAX_CONCURRENT, model=OLLAMA_MODEL)
+    
+    @asynccontextmanager
+    async def track_request(self):
+        """Count in-flight Ollama calls for the active concurrency figure"""
+        self.active_requests += 1
+        try:
+            yield
+        finally:
+            self.active_requests -= 1
+    
+    def progress_snapshot(self):
+        return (self.successful_requests, self.failed_requests, self.active_requests,
+                {"checkpoint": dict(checkpoint_manager.stats)})
+    
+    def publish_progress(self, status="running", force=False):
+        succeeded, failed, active, extra = self.progress_snapshot()
+        if force:
+            self.progress.finish(succeeded, failed, status=status, extra=extra)
+        else:
+            self.progress.publish(succeeded, failed, active=active, extra=extra)
+    
+    async def publish_progress_async(self, snapshot):
+        """Publish a snapshot taken under the lock; the Mongo write runs on a worker thread"""
+        if self.progress.due():
+            succeeded, failed, active, extra = snapshot
+            await asyncio.to_thread(self.progress.publish, succeeded, failed, active=active, extra=extra)
     
     async def record_success(self):
         async with self._lock:
             self.successful_requests += 1
             self.calls_processed += 1
             await self.log_progress()
+            snapshot = self.progress_snapshot()
+        await self.publish_progress_async(snapshot)
     
     async def record_failure(self):
         async with self._lock:
             self.failed_requests += 1
             await self.log_progress()
+            snapshot = self.progress_snapshot()
+        await self.publish_progress_async(snapshot)
     
     async def log_progress(self):
         if self.calls_processed % 50 == 0 and self.calls_processed > 0:
@@ -532,7 +568,7 @@ class RateLimitedProcessor:
     
     async def call_ollama_async(self, session, prompt, max_retries=MAX_RETRIES):
         """Async Ollama API call (chat-style) with rate limiting and retries"""
-        async with self.semaphore:
+        async with self.semaphore, performance_monitor.track_request():
             # Rate limiting - ensure minimum delay between requests
             async with self._lock:
                 current_time = time.time()
@@ -1079,6 +1115,7 @@ async def process_voice_calls_optimized():
             return
         
         logger.info(f"Found {total_calls} voice calls that need LLM processing")
+        performance_monitor.progress.set_total(total_calls)
         logger.info(f"Previously processed (checkpoint): {len(checkpoint_manager.processed_calls)} calls")
         progress_logger.info(f"BATCH_START: total_calls={total_calls}")
         
@@ -1182,8 +1219,10 @@ async def process_voice_calls_optimized():
         
         if shutdown_flag.is_set():
             logger.info("Processing interrupted gracefully!")
+            performance_monitor.publish_progress(status="interrupted", force=True)
         else:
             logger.info("Optimized voice transcript content generation complete!")
+            performance_monitor.publish_progress(status="completed", force=True)
         
         logger.info(f"Final Results:")
         logger.info(f"  Total voice calls updated: {total_updated}")
@@ -1206,6 +1245,7 @@ async def process_voice_calls_optimized():
     except Exception as e:
         logger.error(f"Unexpected error in main processing: {e}")
         logger.error(traceback.format_exc())
+        performance_monitor.publish_progress(status="failed", force=True)
     finally:
         await checkpoint_manager.save_checkpoint()
 
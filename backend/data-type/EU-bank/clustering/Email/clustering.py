@@ -1,16 +1,24 @@
+import importlib.util
 import warnings
 import re
 import numpy as np
 import pandas as pd
 import os
 import time
-import umap
-from sklearn.metrics import silhouette_score
-from sklearn.metrics.pairwise import cosine_similarity
 from pymongo import MongoClient
 from bson import ObjectId
 from dotenv import load_dotenv
 import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_common.embedding_loader import load_keyphrase_embeddings
+from pipeline_common.embedding_models import configured_model_id, embedding_model_filter
+from pipeline_common.experiments import REGISTRY_FILE, save_experiment
+from pipeline_common.preprocess import SPACY_MODEL, Lemmatizer
+from pipeline_common.coherence import COHERENCE_MODE
+from pipeline_common.sweep import reduce_cached, run_hdbscan_sweep
 
 # Try to import required packages
 try:
@@ -23,20 +31,17 @@ except ImportError:
 
 try:
     import gensim
-    from gensim.corpora.dictionary import Dictionary
-    from gensim.models.coherencemodel import CoherenceModel
     GENSIM_AVAILABLE = True
     print("Gensim loaded successfully")
 except ImportError:
     GENSIM_AVAILABLE = False
     print("ERROR: Gensim is required but not available")
 
-try:
-    import hdbscan
-    HDBSCAN_AVAILABLE = True
-    print("HDBSCAN loaded successfully")
-except ImportError:
-    HDBSCAN_AVAILABLE = False
+# pipeline_common.sweep imports hdbscan itself; only check that it is installed
+HDBSCAN_AVAILABLE = importlib.util.find_spec("hdbscan") is not None
+if HDBSCAN_AVAILABLE:
+    print("HDBSCAN found")
+else:
     print("ERROR: HDBSCAN is required but not available")
 
 warnings.filterwarnings("ignore")
@@ -61,28 +66,16 @@ print("Connecting to MongoDB...")
 print(f"Database: {DB_NAME}")
 print(f"Collection: {COLLECTION_NAME}")
 
-# Initialize spaCy (required)
-try:
-    nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-    print("spaCy model loaded successfully")
-except OSError:
+# Initialize spaCy (required); batched lemmatization backed by the shared lemma cache
+if spacy.util.is_package(SPACY_MODEL):
+    preprocess_text = Lemmatizer()
+    print("spaCy model found")
+else:
     print("ERROR: spaCy English model not found.")
     print("Please download it with: python -m spacy download en_core_web_sm")
     client.close()
     exit()
 
-def preprocess_text(text):
-    """Lemmatize and filter text using spaCy"""
-    if not isinstance(text, str):
-        text = str(text)
-    
-    # Use spaCy for advanced processing
-    doc = nlp(text.lower())  
-    lemmatized_tokens = [
-        token.lemma_ for token in doc if not token.is_stop and not token.is_punct
-    ]
-    return " ".join(lemmatized_tokens)
-
 # Check if required packages are available
 if not HDBSCAN_AVAILABLE:
     print("ERROR: HDBSCAN is required but not available.")
@@ -103,74 +96,31 @@ if not GENSIM_AVAILABLE:
     client.close()
     exit()
 
-# Load data from MongoDB - only documents with embeddings
+# Load data from MongoDB - only documents with embeddings, streamed with a
+# projection straight into one float32 matrix
 print("Loading data from MongoDB...")
-cursor = collection.find({
+loaded = load_keyphrase_embeddings(collection, {
     "dominant_topic": {"$exists": True, "$ne": None},
-    "embeddings": {"$exists": True, "$ne": []}
-})
-documents = list(cursor)
-print(f"Found {len(documents)} documents with both dominant_topic and embeddings")
-
-if len(documents) == 0:
+    "embeddings": {"$exists": True, "$ne": []},
+    # Only vectors from the configured embedding model are comparable
+    **embedding_model_filter(configured_model_id())
+}, preprocess_text, dedupe=True)
+num_documents = loaded.scanned
+print(f"Found {num_documents} documents with both dominant_topic and embeddings")
+
+if len(loaded.keyphrases) == 0:
     print("No documents found with both dominant_topic and embeddings fields. Exiting...")
     client.close()
     exit()
 
-# Extract keyphrases and embeddings from MongoDB documents
-# Use a dictionary to deduplicate keyphrases while preserving document relationships
-unique_keyphrases = {}  # keyphrase -> (embedding, document_ids)
-document_to_keyphrase = {}
-
-print("Processing documents and extracting unique keyphrases with embeddings...")
-for doc in documents:
-    doc_id = doc["_id"]
-    dominant_topic = doc.get("dominant_topic", "")
-    embedding_data = doc.get("embeddings", [])
-    
-    if not dominant_topic or not isinstance(dominant_topic, str) or len(dominant_topic.strip()) == 0:
-        print(f"Skipping document {doc_id}: empty or invalid dominant_topic")
-        continue
-    
-    if not embedding_data or len(embedding_data) == 0:
-        print(f"Skipping document {doc_id}: empty embeddings")
-        continue
-        
-    # Preprocess the dominant topic
-    lemmatized_phrase = preprocess_text(dominant_topic)
-    if lemmatized_phrase.strip():
-        # Convert embedding list to numpy array
-        embedding_vector = np.array(embedding_data)
-        
-        # Store document relationship
-        document_to_keyphrase[doc_id] = lemmatized_phrase
-        
-        # Deduplicate keyphrases - if we've seen this before, just add the document ID
-        if lemmatized_phrase in unique_keyphrases:
-            unique_keyphrases[lemmatized_phrase]['document_ids'].append(doc_id)
-            print(f"Duplicate keyphrase '{lemmatized_phrase}' - document {doc_id} added to existing group")
-        else:
-            # New unique keyphrase
-            unique_keyphrases[lemmatized_phrase] = {
-                'embedding': embedding_vector,
-                'document_ids': [doc_id]
-            }
-            print(f"New unique keyphrase: '{lemmatized_phrase}'")
-    else:
-        print(f"Skipping document {doc_id}: processed keyphrase is empty")
-
-# Convert deduplicated data to lists for processing
-keyphrases = list(unique_keyphrases.keys())
-embeddings = [unique_keyphrases[phrase]['embedding'] for phrase in keyphrases]
-keyphrase_to_documents = {phrase: unique_keyphrases[phrase]['document_ids'] for phrase in keyphrases}
+keyphrases = loaded.keyphrases
+embeddings = loaded.embeddings
+keyphrase_to_documents = loaded.keyphrase_to_documents
 
 print(f"\nDeduplication summary:")
-print(f"Original documents: {len(documents)}")
+print(f"Original documents: {num_documents}")
 print(f"Unique keyphrases: {len(keyphrases)}")
-print(f"Duplicate reduction: {len(documents) - len(keyphrases)} documents removed")
-
-# Convert embeddings to numpy array
-embeddings = np.array(embeddings)
+print(f"Duplicate reduction: {num_documents - len(keyphrases)} documents removed")
 
 print(f"Total keyphrases with embeddings: {len(keyphrases)}")
 print(f"Embedding shape: {embeddings.shape}")
@@ -220,211 +170,127 @@ best_avg_similarity = -1
 best_umap_params = None
 best_hdbscan_params = None
 best_labels = None
-best_reduced_embeddings = None
-
-for umap_idx, umap_params in enumerate(umap_params_list):
-    print(f"\n--- UMAP Experiment {umap_idx+1}: {umap_params} ---")
+best_exp_id = None
+
+# UMAP reductions are cached on disk, so HDBSCAN variants and reruns reuse them;
+# the (UMAP, HDBSCAN) grid itself is evaluated on a process pool
+sweep_results = run_hdbscan_sweep(
+    embeddings, keyphrases, umap_params_list, hdbscan_params_list,
+    n_components=20,
+    phrase_repeats=[len(keyphrase_to_documents[phrase]) for phrase in keyphrases]
+)
+
+for result in sweep_results:
+    exp_id = result['experiment_id']
+    umap_params = result['umap_params']
+    hdbscan_params = result['hdbscan_params']
+    labels = result['labels']
+    num_clusters = result['num_clusters']
+    noise_count = result['noise_count']
+    noise_percent = result['noise_percent']
+    print(f"\n-- Experiment {exp_id}: UMAP {umap_params}, HDBSCAN {hdbscan_params} ({result['seconds']}s) --")
+    print(f"Found {num_clusters} clusters with {noise_count} noise points ({noise_percent:.1f}%)")
     
-    # Apply UMAP dimensionality reduction
-    reducer = umap.UMAP(
-        n_components=20,
-        metric='cosine',
-        **umap_params
-    )
-    
-    try:
-        reduced_embeddings = reducer.fit_transform(embeddings)
-        print(f"Reduced embedding dimensions from {embeddings.shape[1]} to {reduced_embeddings.shape[1]}")
-    except Exception as e:
-        print(f"UMAP reduction failed: {e}")
+    # Skip further analysis if we found only noise or a single cluster
+    if num_clusters <= 1:
+        print("Insufficient clusters found, skipping this parameter combination")
         continue
     
-    for hdbscan_idx, hdbscan_params in enumerate(hdbscan_params_list):
-        exp_id = f"umap_{umap_idx+1}_hdbscan_{hdbscan_idx+1}"
-        print(f"\n-- HDBSCAN Experiment: {hdbscan_params} --")
-        
-        # Apply HDBSCAN clustering
-        clusterer = hdbscan.HDBSCAN(
-            metric='euclidean',
-            core_dist_n_jobs=-1,
-            **hdbscan_params
-        )
-        
-        labels = clusterer.fit_predict(reduced_embeddings)
-        
-        # Calculate clustering metrics
-        num_clusters = len(set(labels)) - (1 if -1 in labels else 0)
-        noise_count = np.sum(labels == -1)
-        noise_percent = noise_count / len(labels) * 100
-        
-        print(f"Found {num_clusters} clusters with {noise_count} noise points ({noise_percent:.1f}%)")
-        
-        # Skip further analysis if we found only noise or a single cluster
-        if num_clusters <= 1:
-            print("Insufficient clusters found, skipping this parameter combination")
-            continue
-        
-        # Calculate silhouette score
-        silhouette_value = np.nan
-        try:
-            valid_labels = labels != -1
-            if valid_labels.sum() > 1 and num_clusters > 1:
-                silhouette_value = silhouette_score(
-                    reduced_embeddings[valid_labels], 
-                    labels[valid_labels], 
-                    metric="cosine"
-                )
-                print(f"Silhouette score: {silhouette_value:.4f}")
-        except Exception as e:
-            print(f"Could not calculate silhouette score: {e}")
-        
-        # Create dataframe with cluster assignments
-        # Expand deduplicated keyphrases back to document level for analysis
-        expanded_data = []
-        for i, phrase in enumerate(keyphrases):
-            cluster_id = labels[i]
-            doc_ids = keyphrase_to_documents[phrase]
-            for doc_id in doc_ids:
-                expanded_data.append({
-                    'keyphrase': phrase,
-                    'cluster_id': cluster_id,
-                    'document_id': str(doc_id)
-                })
-        
-        clustered_df = pd.DataFrame(expanded_data)
-        
-        # Group by cluster
-        final_df = clustered_df.groupby('cluster_id')['keyphrase'].apply(list).reset_index()
-        final_df['cluster_name'] = final_df['cluster_id'].apply(
-            lambda x: f'Cluster {x}' if x != -1 else 'Cluster -1 (Noise)'
-        )
-        final_df.rename(columns={'keyphrase': 'keywords'}, inplace=True)
-        
-        # Show cluster sizes
-        cluster_sizes = clustered_df['cluster_id'].value_counts().sort_index()
-        print("\nCluster sizes:")
-        for cluster_id, size in cluster_sizes.items():
-            cluster_name = "Noise" if cluster_id == -1 else f"Cluster {cluster_id}"
-            print(f"{cluster_name}: {size} keyphrases")
-        
-        # Display cluster contents (up to 5 items per cluster)
-        print("\nCluster contents:")
-        for _, row in final_df.iterrows():
-            cluster_id = row['cluster_id']
-            keywords = row['keywords']
-            
-            print(f"\nCluster {cluster_id}")
-            print("  Sample phrases (up to 5):")
-            for phrase in keywords[:5]:
-                print(f"  - {phrase}")
-            if len(keywords) > 5:
-                print(f"  - ... and {len(keywords) - 5} more phrases")
-        
-        # Calculate coherence score if valid clusters exist and gensim is available
-        coherence_value = np.nan
-        noise_cluster = -1 in final_df['cluster_id'].values
-        valid_clusters = [row['keywords'] for _, row in final_df.iterrows() 
-                         if row['cluster_id'] != -1 or not noise_cluster]
-        
-        if len(valid_clusters) > 1:
-            print("\nCalculating coherence score...")
-            try:
-                # Prepare data for coherence model
-                clustered_tokens = [[word for phrase in cluster for word in phrase.split()] 
-                                    for cluster in valid_clusters]
-                
-                dictionary = Dictionary(clustered_tokens)
-                coherence_model_cv = CoherenceModel(
-                    topics=clustered_tokens, 
-                    texts=clustered_tokens, 
-                    dictionary=dictionary, 
-                    coherence="c_v"
-                )
-                coherence_value = coherence_model_cv.get_coherence()
-                print(f"C_V Coherence Score: {coherence_value:.4f}")
-            except Exception as e:
-                print(f"Error calculating coherence score: {e}")
-        
-        # Calculate average similarity within clusters
-        print("\nCalculating average similarity within clusters...")
-        
-        def average_cluster_similarity(cluster_embeddings):
-            """Calculate average cosine similarity within a cluster"""
-            if len(cluster_embeddings) < 2:
-                return np.nan  
-            similarities = cosine_similarity(cluster_embeddings)
-            np.fill_diagonal(similarities, 0)  # Exclude self-similarity
-            return np.mean(similarities)
-        
-        # Use original embeddings for similarity calculations
-        cluster_similarities = {}
-        for cluster_id in set(labels):
-            if cluster_id == -1:
-                continue  # Skip noise cluster
-            cluster_indices = np.where(labels == cluster_id)[0]
-            cluster_embeddings = embeddings[cluster_indices]
-            avg_sim = average_cluster_similarity(cluster_embeddings)
-            cluster_similarities[cluster_id] = avg_sim
-            print(f"Cluster {cluster_id}: Avg. Similarity = {avg_sim:.4f}")
-        
-        valid_similarities = [sim for sim in cluster_similarities.values() if not np.isnan(sim)]
-        overall_avg_similarity = np.mean(valid_similarities) if valid_similarities else np.nan
-        print(f"Overall Avg. Similarity Across Clusters: {overall_avg_similarity:.4f}")
-        
-        # Save experiment results
-        experiment_result = {
-            'experiment_id': exp_id,
-            'umap_params': umap_params,
-            'hdbscan_params': hdbscan_params,
-            'num_clusters': num_clusters,
-            'noise_percent': noise_percent,
-            'silhouette_score': silhouette_value,
-            'coherence_score': coherence_value,
-            'avg_similarity': overall_avg_similarity
-        }
-        all_experiment_results.append(experiment_result)
-        
-        # Save cluster results for this experiment
-        final_df['experiment_id'] = exp_id
-        final_df['umap_params'] = str(umap_params)
-        final_df['hdbscan_params'] = str(hdbscan_params)
-        clustered_df['experiment_id'] = exp_id
-        
-        output_folder = f"clustering_results/exp_{exp_id}"
-        os.makedirs(output_folder, exist_ok=True)
-        final_df.to_csv(f"{output_folder}/clusters.csv", index=False)
-        clustered_df.to_csv(f"{output_folder}/all_keyphrases_with_clusters.csv", index=False)
-        
-        # Save cluster visualization - create a 2D projection for visualization
-        try:
-            viz_reducer = umap.UMAP(n_components=2, **umap_params)
-            viz_embeddings = viz_reducer.fit_transform(embeddings)
-            
-            viz_df = pd.DataFrame({
-                'x': viz_embeddings[:, 0],
-                'y': viz_embeddings[:, 1],
-                'cluster': labels,
-                'keyphrase': keyphrases,
-                'document_id': [str(doc_id) for doc_id in document_ids]
+    for error in result['errors']:
+        print(error)
+    silhouette_value = result['silhouette_score']
+    coherence_value = result['coherence_score']
+    overall_avg_similarity = result['avg_similarity']
+    
+    # Create dataframe with cluster assignments
+    # Expand deduplicated keyphrases back to document level for analysis
+    expanded_data = []
+    for i, phrase in enumerate(keyphrases):
+        cluster_id = labels[i]
+        doc_ids = keyphrase_to_documents[phrase]
+        for doc_id in doc_ids:
+            expanded_data.append({
+                'keyphrase': phrase,
+                'cluster_id': cluster_id,
+                'document_id': str(doc_id)
             })
-            viz_df.to_csv(f"{output_folder}/cluster_visualization.csv", index=False)
-        except Exception as e:
-            print(f"Error creating visualization data: {e}")
-        
-        # Check if this is the best result so far - prioritize silhouette score
-        is_best = False
-        if not np.isnan(silhouette_value) and silhouette_value > best_silhouette:
-            best_silhouette = silhouette_value
-            best_coherence = coherence_value
-            best_avg_similarity = overall_avg_similarity
-            best_umap_params = umap_params
-            best_hdbscan_params = hdbscan_params
-            best_labels = labels
-            best_reduced_embeddings = reduced_embeddings
-            is_best = True
+    
+    clustered_df = pd.DataFrame(expanded_data)
+    
+    # Group by cluster
+    final_df = clustered_df.groupby('cluster_id')['keyphrase'].apply(list).reset_index()
+    final_df['cluster_name'] = final_df['cluster_id'].apply(
+        lambda x: f'Cluster {x}' if x != -1 else 'Cluster -1 (Noise)'
+    )
+    final_df.rename(columns={'keyphrase': 'keywords'}, inplace=True)
+    
+    # Show cluster sizes
+    cluster_sizes = clustered_df['cluster_id'].value_counts().sort_index()
+    print("\nCluster sizes:")
+    for cluster_id, size in cluster_sizes.items():
+        cluster_name = "Noise" if cluster_id == -1 else f"Cluster {cluster_id}"
+        print(f"{cluster_name}: {size} keyphrases")
+    
+    # Display cluster contents (up to 5 items per cluster)
+    print("\nCluster contents:")
+    for _, row in final_df.iterrows():
+        cluster_id = row['cluster_id']
+        keywords = row['keywords']
         
-        if is_best:
-            print(f"\n*** New best result: {exp_id} ***")
+        print(f"\nCluster {cluster_id}")
+        print("  Sample phrases (up to 5):")
+        for phrase in keywords[:5]:
+            print(f"  - {phrase}")
+        if len(keywords) > 5:
+            print(f"  - ... and {len(keywords) - 5} more phrases")
+    
+    print(f"\nSilhouette score: {silhouette_value:.4f} (±{result['silhouette_stderr']:.4f}, n={result['silhouette_sample_size']})")
+    print(f"Coherence score ({COHERENCE_MODE}): {coherence_value:.4f}")
+    for cluster_id, avg_sim in result['cluster_similarities'].items():
+        print(f"Cluster {cluster_id}: Avg. Similarity = {avg_sim:.4f}")
+    print(f"Overall Avg. Similarity Across Clusters: {overall_avg_similarity:.4f}")
+    
+    # Save experiment results
+    experiment_result = {
+        'experiment_id': exp_id,
+        'umap_params': umap_params,
+        'hdbscan_params': hdbscan_params,
+        'num_clusters': num_clusters,
+        'noise_percent': noise_percent,
+        'silhouette_score': silhouette_value,
+        'silhouette_stderr': result['silhouette_stderr'],
+        'coherence_score': coherence_value,
+        'coherence_npmi': result['coherence_npmi'],
+        'coherence_c_v': result['coherence_c_v'],
+        'avg_similarity': overall_avg_similarity,
+        'seconds': result['seconds']
+    }
+    all_experiment_results.append(experiment_result)
+    
+    # Save labels and reduced coordinates as Parquet and register the run with its params and scores
+    save_experiment(
+        "clustering_results", exp_id, keyphrases, labels, loaded.document_ids,
+        reduced=np.load(result['reduction_file']),
+        cluster_similarities=result['cluster_similarities'],
+        record=dict(experiment_result, collection=COLLECTION_NAME, data_hash=result['data_hash'],
+                    n_components=result['n_components'], prereduce=result['prereduce'],
+                    documents=num_documents),
+    )
+    
+    # Check if this is the best result so far - prioritize silhouette score
+    is_best = False
+    if not np.isnan(silhouette_value) and silhouette_value > best_silhouette:
+        best_silhouette = silhouette_value
+        best_coherence = coherence_value
+        best_avg_similarity = overall_avg_similarity
+        best_umap_params = umap_params
+        best_hdbscan_params = hdbscan_params
+        best_labels = labels
+        best_exp_id = exp_id
+        is_best = True
+    
+    if is_best:
+        print(f"\n*** New best result: {exp_id} ***")
 
 # Save summary of all experiments
 pd.DataFrame(all_experiment_results).to_csv("clustering_results/all_experiments_summary.csv", index=False)
@@ -491,6 +357,21 @@ if best_umap_params is not None:
     final_df.to_csv("clustering_results/best_clusters.csv", index=False)
     clustered_df.to_csv("clustering_results/best_all_keyphrases_with_clusters.csv", index=False)
     
+    # 2-D projection for visualization, computed only for the winning configuration
+    try:
+        viz_embeddings = reduce_cached(embeddings, 2, best_umap_params, metric='euclidean')
+        viz_df = pd.DataFrame({
+            'x': viz_embeddings[:, 0],
+            'y': viz_embeddings[:, 1],
+            'cluster': best_labels,
+            'keyphrase': keyphrases,
+            'document_ids': [';'.join(str(doc_id) for doc_id in keyphrase_to_documents[phrase]) for phrase in keyphrases]
+        })
+        viz_df.to_csv(f"clustering_results/exp_{best_exp_id}/cluster_visualization.csv", index=False)
+        viz_df.to_csv("clustering_results/best_cluster_visualization.csv", index=False)
+    except Exception as e:
+        print(f"Error creating visualization data: {e}")
+    
     # Save keyphrase to document mapping
     mapping_data = []
     for phrase, doc_ids in keyphrase_to_documents.items():
@@ -519,9 +400,9 @@ if best_umap_params is not None:
     
     # Save final statistics
     stats = {
-        'total_documents_processed': len(documents),
+        'total_documents_processed': num_documents,
         'unique_keyphrases_clustered': len(keyphrases),
-        'duplicate_reduction': len(documents) - len(keyphrases),
+        'duplicate_reduction': num_documents - len(keyphrases),
         'best_num_clusters': len(set(best_labels)) - (1 if -1 in best_labels else 0),
         'best_silhouette_score': best_silhouette,
         'best_coherence_score': best_coherence,
@@ -551,9 +432,9 @@ print("\n" + "="*60)
 print("CLUSTERING ANALYSIS COMPLETE")
 print("="*60)
 print(f"Total execution time: {execution_time:.2f} seconds")
-print(f"Documents processed: {len(documents)}")
+print(f"Documents processed: {num_documents}")
 print(f"Unique keyphrases clustered: {len(keyphrases)}")
-print(f"Duplicate reduction: {len(documents) - len(keyphrases)} documents")
+print(f"Duplicate reduction: {num_documents - len(keyphrases)} documents")
 if best_umap_params is not None:
     print(f"Best configuration found with {len(set(best_labels)) - (1 if -1 in best_labels else 0)} clusters")
     print(f"Best silhouette score: {best_silhouette:.4f}")
@@ -563,5 +444,8 @@ print("- best_clusters.csv: Final cluster results using best parameters")
 print("- best_all_keyphrases_with_clusters.csv: All keyphrases with their cluster assignments")
 print("- keyphrase_document_mapping.csv: Mapping between keyphrases and documents")
 print("- clustering_statistics.json: Overall clustering statistics")
-print("- exp_*/: Individual experiment results for each parameter combination")
+print("- best_cluster_visualization.csv: 2-D projection of the best configuration")
+print("- exp_*/: assignments.parquet (labels, UMAP coordinates) and clusters.parquet per parameter combination")
+print(f"- {REGISTRY_FILE}: Parameters, data hash, timings and scores of every run "
+      "(python -m pipeline_common.experiments list)")
 print("="*60)
\ No newline at end of file
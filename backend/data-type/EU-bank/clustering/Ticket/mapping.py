@@ -2,6 +2,11 @@ import os
 from pymongo import MongoClient
 from dotenv import load_dotenv
 import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_common.label_propagation import propagate_labels
 
 # Load environment variables
 load_dotenv()
@@ -117,54 +122,13 @@ def get_cluster_data(db):
 def update_tickets(db, cluster_dominant_labels, keyphrase_to_label, keyphrase_to_subcluster_id):
     """Update tickets collection with dominant_cluster_label, subcluster labels, and subcluster_id"""
     try:
-        tickets_collection = db['tickets']
-        
-        # Get all email messages
-        messages = list(tickets_collection.find({}))
-        logger.info(f"Found {len(messages)} email messages to process")
-        
-        updated_count = 0
-        dominant_label_updates = 0
-        subcluster_label_updates = 0
-        subcluster_id_updates = 0
-        
-        for message in messages:
-            message_id = message.get('_id')
-            updates = {}
-            
-            # Update dominant_cluster_label based on kmeans_cluster_id
-            kmeans_cluster_id = message.get('kmeans_cluster_id')
-            if kmeans_cluster_id is not None and kmeans_cluster_id in cluster_dominant_labels:
-                dominant_label = cluster_dominant_labels[kmeans_cluster_id]
-                updates['dominant_cluster_label'] = dominant_label
-                dominant_label_updates += 1
-            
-            # Update subcluster label and subcluster_id based on kmeans_cluster_keyphrase
-            kmeans_cluster_keyphrase = message.get('kmeans_cluster_keyphrase')
-            if kmeans_cluster_keyphrase and kmeans_cluster_keyphrase in keyphrase_to_label:
-                subcluster_label = keyphrase_to_label[kmeans_cluster_keyphrase]
-                updates['subcluster_label'] = subcluster_label
-                subcluster_label_updates += 1
-                
-                # Also add subcluster_id
-                if kmeans_cluster_keyphrase in keyphrase_to_subcluster_id:
-                    subcluster_id = keyphrase_to_subcluster_id[kmeans_cluster_keyphrase]
-                    updates['subcluster_id'] = subcluster_id
-                    subcluster_id_updates += 1
-            
-            # Perform update if there are changes
-            if updates:
-                result = tickets_collection.update_one(
-                    {'_id': message_id},
-                    {'$set': updates}
-                )
-                
-                if result.modified_count > 0:
-                    updated_count += 1
-                    logger.debug(f"Updated message {message_id} with: {updates}")
+        # Labels are copied on the server per batch of clusters instead of one update_one per message
+        updated_count, dominant_label_updates, subcluster_label_updates, subcluster_id_updates = propagate_labels(
+            db, 'tickets', cluster_dominant_labels, keyphrase_to_label, keyphrase_to_subcluster_id
+        )
         
         logger.info(f"Update completed:")
-        logger.info(f"  - Total messages updated: {updated_count}")
+        logger.info(f"  - Total messages labelled: {updated_count}")
         logger.info(f"  - Dominant cluster labels added: {dominant_label_updates}")
         logger.info(f"  - Subcluster labels added: {subcluster_label_updates}")
         logger.info(f"  - Subcluster IDs added: {subcluster_id_updates}")
@@ -196,7 +160,7 @@ def main():
         
         logger.info("Process completed successfully!")
         logger.info(f"Summary:")
-        logger.info(f"  - Documents updated: {updated_count}")
+        logger.info(f"  - Documents labelled: {updated_count}")
         logger.info(f"  - Dominant cluster labels: {dominant_updates}")
         logger.info(f"  - Subcluster labels: {subcluster_updates}")
         logger.info(f"  - Subcluster IDs: {subcluster_id_updates}")
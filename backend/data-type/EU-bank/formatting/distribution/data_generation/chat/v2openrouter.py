@@ -24,8 +24,12 @@ import psutil
 from pathlib import Path
 from pymongo import UpdateOne
 from asyncio import Semaphore
+from contextlib import asynccontextmanager
 import traceback
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[5]))
+from pipeline_common.progress import ProgressPublisher
+
 # Load environment variables
 load_dotenv()
 
@@ -147,18 +151,50 @@ class PerformanceMonitor:
         self.chats_processed = 0
         self.successful_requests = 0
         self.failed_requests = 0
+        self.active_requests = 0
         self._lock = asyncio.Lock()
+        self.progress = ProgressPublisher("chat_generator_openrouter", max_concurrency=MAX_CONCURRENT, model=OPENROUTER_MODEL)
+    
+    @asynccontextmanager
+    async def track_request(self):
+        """Count in-flight OpenRouter calls for the active concurrency figure"""
+        self.active_requests += 1
+        try:
+            yield
+        finally:
+            self.active_requests -= 1
+    
+    def progress_snapshot(self):
+        return (self.successful_requests, self.failed_requests, self.active_requests,
+                {"checkpoint": dict(checkpoint_manager.stats)})
+    
+    def publish_progress(self, status="running", force=False):
+        succeeded, failed, active, extra = self.progress_snapshot()
+        if force:
+            self.progress.finish(succeeded, failed, status=status, extra=extra)
+        else:
+            self.progress.publish(succeeded, failed, active=active, extra=extra)
+    
+    async def publish_progress_async(self, snapshot):
+        """Publish a snapshot taken under the lock; the Mongo write runs on a worker thread"""
+        if self.progress.due():
+            succeeded, failed, active, extra = snapshot
+            await asyncio.to_thread(self.progress.publish, succeeded, failed, active=active, extra=extra)
     
     async def record_success(self, total_chats=None):
         async with self._lock:
             self.successful_requests += 1
             self.chats_processed += 1
             await self.log_progress(total_chats)
+            snapshot = self.progress_snapshot()
+        await self.publish_progress_async(snapshot)
     
     async def record_failure(self, total_chats=None):
         async with self._lock:
             self.failed_requests += 1
             await self.log_progress(total_chats)
+            snapshot = self.progress_snapshot()
+        await self.publish_progress_async(snapshot)
     
     async def log_progress(self, total_chats=None):
         if self.chats_processed % 50 == 0 and self.chats_processed > 0:
@@ -357,7 +393,7 @@ class RateLimitedProcessor:
     
     async def call_openrouter_async(self, session, prompt, max_retries=MAX_RETRIES):
         """Async OpenRouter API call with smart adaptive rate limiting and retries"""
-        async with self.semaphore:
+        async with self.semaphore, performance_monitor.track_request():
             # Intelligent rate limiting based on recent rate limit hits
             async with self._lock:
                 current_time = time.time()
@@ -1364,6 +1400,7 @@ async def process_chats_optimized():
             return
         
         logger.info(f"Found {total_chats} chats that need LLM processing")
+        performance_monitor.progress.set_total(total_chats)
         logger.info(f"Previously processed (checkpoint): {len(checkpoint_manager.processed_chats)} chats")
         
         # Log session progress
@@ -1554,8 +1591,10 @@ async def process_chats_optimized():
         
         if shutdown_flag.is_set():
             logger.info("Processing interrupted gracefully!")
+            performance_monitor.publish_progress(status="interrupted", force=True)
         else:
             logger.info("Optimized chat content generation complete!")
+            performance_monitor.publish_progress(status="completed", force=True)
         
         # Final statistics
         final_total_completed = chats_processed_by_llm + total_updated
@@ -1605,6 +1644,7 @@ async def process_chats_optimized():
     except Exception as e:
         logger.error(f"Unexpected error in main processing: {e}")
         logger.error(traceback.format_exc())
+        performance_monitor.publish_progress(status="failed", force=True)
     finally:
         await checkpoint_manager.save_checkpoint()
 
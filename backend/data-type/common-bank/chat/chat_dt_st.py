@@ -14,11 +14,15 @@ from collections import Counter
 from pymongo import MongoClient
 from bson import ObjectId
 from dotenv import load_dotenv
+from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
 import threading
 from queue import Queue
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from pipeline_common.llm_cache import LLMCache, prompt_version
+
 # Load environment variables
 load_dotenv()
 
@@ -26,6 +30,27 @@ load_dotenv()
 MONGO_URI = os.getenv("MONGO_CONNECTION_STRING")
 DB_NAME = "sparzaai"
 CHAT_COLLECTION = "chat-chunks"
+SUMMARY_PROMPT = """
+        # Chat Conversation Summarization Task
+
+        Below is a long chat conversation that needs to be summarized. Please create a comprehensive summary of approximately 200-300 words 
+        that captures the main points, key issues discussed, and overall context of the banking conversation. Maintain the essential 
+        information that would be needed for topic classification.
+
+        ## RULES:
+        1. Preserve key banking terminology, account details, and important references
+        2. Keep the most important exchanges and topics discussed
+        3. Maintain the conversational flow and participant roles (customer service vs customer)
+        4. Aim for about 200-300 words in your summary
+        5. Include only the summary in your response, no additional commentary
+        6. Focus on the banking issue or request being discussed
+
+        ## CONVERSATION TO SUMMARIZE:
+
+        {conversation}
+        """
+# Cached summaries are invalidated whenever the summarization prompt changes
+SUMMARY_PROMPT_VERSION = prompt_version("summary", SUMMARY_PROMPT)
 
 # Set up logging - modified for MongoDB chat processing
 logging.basicConfig(
@@ -57,6 +82,9 @@ class MongoDBChatTopicExtractionProcessor:
         self.ollama_url = f"{base_url}/api/generate"
         self.tags_url = f"{base_url}/api/tags"
         self.prompt_template = self._load_prompt_template()
+        self.prompt_version = prompt_version("chat-topics", self.prompt_template)
+        # Successful responses are reused across reruns; LLM_CACHE_BYPASS=1 asks the model again
+        self.llm_cache = LLMCache()
         self.max_workers = max_workers
         
         # MongoDB setup
@@ -377,6 +405,28 @@ class MongoDBChatTopicExtractionProcessor:
         
         return "\n".join(conversation_lines)
 
+    def _cached_ollama_request(self, chat_conversation, prompt, version):
+        """
+        Execute an Ollama request through the persistent response cache, keyed by
+        (model, prompt version, input text). A fresh response is not stored here;
+        the caller passes it to _cache_response once it has parsed successfully
+        """
+        cache_key = self.llm_cache.key(self.model_name, version, chat_conversation)
+        cached = self.llm_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Using cached LLM response")
+            return {"response": cached}
+        response = self._execute_ollama_request(chat_conversation, prompt)
+        return {"response": response["response"], "cache_key": cache_key, "version": version}
+
+    def _cache_response(self, response):
+        """
+        Store a validated response from _cached_ollama_request; responses served
+        from the cache are not written again
+        """
+        if response.get("cache_key"):
+            self.llm_cache.put(response["cache_key"], response["response"], self.model_name, response["version"])
+
     def summarize_long_conversation(self, conversation):
         """
         Summarize long conversation using the LLM to reduce it to manageable size
@@ -387,32 +437,16 @@ class MongoDBChatTopicExtractionProcessor:
         logger.info(f"Conversation exceeds 1000 words. Summarizing before topic extraction...")
 
         # Create the summarization prompt
-        summarize_prompt = f"""
-        # Chat Conversation Summarization Task
-
-        Below is a long chat conversation that needs to be summarized. Please create a comprehensive summary of approximately 200-300 words 
-        that captures the main points, key issues discussed, and overall context of the banking conversation. Maintain the essential 
-        information that would be needed for topic classification.
-
-        ## RULES:
-        1. Preserve key banking terminology, account details, and important references
-        2. Keep the most important exchanges and topics discussed
-        3. Maintain the conversational flow and participant roles (customer service vs customer)
-        4. Aim for about 200-300 words in your summary
-        5. Include only the summary in your response, no additional commentary
-        6. Focus on the banking issue or request being discussed
-
-        ## CONVERSATION TO SUMMARIZE:
-
-        {conversation}
-        """
+        summarize_prompt = SUMMARY_PROMPT.format(conversation=conversation)
 
         try:
             # Use the retry-enabled function with the summarization prompt
-            response = self._execute_ollama_request(conversation, summarize_prompt)
+            response = self._cached_ollama_request(conversation, summarize_prompt, SUMMARY_PROMPT_VERSION)
 
             # Extract the summarized text
             summarized_conversation = response['response'].strip()
+            if summarized_conversation:
+                self._cache_response(response)
 
             # Log summarization results
             original_word_count = len(conversation.split())
@@ -479,7 +513,7 @@ class MongoDBChatTopicExtractionProcessor:
 
         try:
             # Use the retry-enabled function
-            response = self._execute_ollama_request(conversation_for_extraction, prompt)
+            response = self._cached_ollama_request(conversation_for_extraction, prompt, self.prompt_version)
 
             # Extract the response text
             response_text = response['response'].strip()
@@ -500,6 +534,8 @@ class MongoDBChatTopicExtractionProcessor:
             dominant_topic = self._extract_dominant_topic(response_text)
             subtopics = self._extract_subtopics(response_text)
             urgent = self._extract_urgency(response_text)
+            if dominant_topic and dominant_topic != "Unknown Topic":
+                self._cache_response(response)
 
             return {
                 "dominant_topic": dominant_topic,
@@ -938,6 +974,8 @@ class MongoDBChatTopicExtractionProcessor:
         Close MongoDB connection
         """
         try:
+            logger.info(f"LLM response cache: {self.llm_cache.report()}")
+            self.llm_cache.close()
             self.client.close()
             logger.info("MongoDB connection closed successfully")
         except Exception as e:
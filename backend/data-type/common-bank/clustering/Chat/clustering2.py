@@ -1,18 +1,24 @@
 import os
 import warnings
-import spacy
 import numpy as np
 import pandas as pd
 import time
-import umap
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from kneed import KneeLocator
 from pymongo import MongoClient
 from bson import ObjectId
 from dotenv import load_dotenv
 from collections import defaultdict
 from datetime import datetime
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_common.embedding_loader import load_keyphrase_embeddings
+from pipeline_common.embedding_models import configured_model_id, embedding_model_filter
+from pipeline_common.preprocess import Lemmatizer
+from pipeline_common.cluster_metrics import sampled_silhouette
+from pipeline_common.k_selection import select_k
+from pipeline_common.out_of_core import cluster_out_of_core, use_out_of_core, write_assignments
+from pipeline_common.sweep import reduce_cached
 
 warnings.filterwarnings("ignore")
 
@@ -43,18 +49,8 @@ print(f"Cluster Collection: {CLUSTER_COLLECTION_NAME}")
 existing_cluster_count = cluster_collection.count_documents({})
 print(f"Found {existing_cluster_count} existing documents in cluster collection")
 
-# Load spaCy model with only necessary components for speed
-nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-
-def preprocess_text(text):
-    """Lemmatize and filter text"""
-    if not isinstance(text, str):
-        text = str(text)
-    doc = nlp(text.lower())  
-    lemmatized_tokens = [
-        token.lemma_ for token in doc if not token.is_stop and not token.is_punct
-    ]
-    return " ".join(lemmatized_tokens)
+# Batched spaCy lemmatization backed by the shared lemma cache; spaCy loads only on cache misses
+preprocess_text = Lemmatizer()
 
 def get_next_cluster_id():
     """Get the next available cluster ID from existing clusters"""
@@ -70,147 +66,97 @@ def get_next_cluster_id():
         print(f"Error getting next cluster ID: {e}")
         return 0
 
-# Load data from MongoDB - only documents with embeddings, including domain field
-print("Loading data from MongoDB...")
-cursor = chat_chunks_collection.find({
+# Documents to cluster: a dominant topic and an embedding
+embedding_query = {
     "dominant_topic": {"$exists": True, "$ne": None},
-    "embeddings": {"$exists": True, "$ne": []}
-}, {
-    "_id": 1,
-    "dominant_topic": 1,
-    "embeddings": 1,
-    "domain": 1  # Include domain field
-})
-documents = list(cursor)
-print(f"Found {len(documents)} documents with both dominant_topic and embeddings")
-
-if len(documents) == 0:
-    print("No documents found with both dominant_topic and embeddings fields. Exiting...")
-    client.close()
-    exit()
-
-# Extract keyphrases and embeddings from MongoDB documents
-keyphrases = []
-embeddings = []
-document_data = []  # Store full document data including domain
-
-print("Processing documents and extracting keyphrases with embeddings...")
-for doc in documents:
-    doc_id = doc["_id"]
-    dominant_topic = doc.get("dominant_topic", "")
-    embedding_data = doc.get("embeddings", [])
-    domain = doc.get("domain", "")  # Extract domain field
-    
-    if not dominant_topic or not isinstance(dominant_topic, str) or len(dominant_topic.strip()) == 0:
-        continue
-    
-    if not embedding_data or len(embedding_data) == 0:
-        continue
-        
-    # Skip "Unknown Topic" entries
-    if dominant_topic.strip().lower() == "unknown topic":
-        continue
-        
-    # Preprocess the dominant topic
-    lemmatized_phrase = preprocess_text(dominant_topic)
-    if lemmatized_phrase.strip():
-        # Convert embedding list to numpy array
-        embedding_vector = np.array(embedding_data)
-        
-        # Store the data
-        keyphrases.append(lemmatized_phrase)
-        embeddings.append(embedding_vector)
-        document_data.append({
-            "_id": doc_id,
-            "domain": domain,
-            "original_keyphrase": dominant_topic,
-            "processed_keyphrase": lemmatized_phrase
-        })
-
-# Convert embeddings to numpy array
-embeddings = np.array(embeddings)
-
-print(f"Total keyphrases with embeddings: {len(keyphrases)}")
-print(f"Embedding shape: {embeddings.shape}")
-
-# Verify embeddings are valid
-if embeddings.size == 0:
-    print("No valid embeddings found. Exiting...")
-    client.close()
-    exit()
-
-# Apply UMAP dimensionality reduction using the successful parameters from HDBSCAN
-print("Applying UMAP dimensionality reduction...")
-umap_params = {
-    "n_neighbors": 30,
-    "min_dist": 0.05
+    "embeddings": {"$exists": True, "$ne": []},
+    # Only vectors from the configured embedding model are comparable
+    **embedding_model_filter(configured_model_id())
 }
 
-reducer = umap.UMAP(
-    n_components=25,
-    metric='cosine',
-    **umap_params
-)
-
-try:
-    reduced_embeddings = reducer.fit_transform(embeddings)
-    print(f"Reduced embedding dimensions from {embeddings.shape[1]} to {reduced_embeddings.shape[1]}")
-except Exception as e:
-    print(f"UMAP reduction failed: {e}")
-    client.close()
-    raise
-  
 # Define K range for optimization
 min_k = 10
 max_k = 50
 step = 5
 k_values = list(range(min_k, max_k + 1, step))
 
-# Find optimal K using elbow method and silhouette score
-print("Finding optimal K...")
-results = []
-inertia_values = []
+if use_out_of_core(chat_chunks_collection, embedding_query):
+    # Stream the embeddings into a disk-backed memmap and cluster them chunk by chunk
+    # (IncrementalPCA, then MiniBatchKMeans) within OOC_MEMORY_MB; UMAP is skipped
+    print("Clustering out of core...")
+    clustered = cluster_out_of_core(chat_chunks_collection, embedding_query, preprocess_text, k_values,
+                                    extra_fields=("domain",), skip_topics=("unknown topic",))
+    if clustered is None:
+        print("No documents found with both dominant_topic and embeddings fields. Exiting...")
+        client.close()
+        exit()
+    num_documents = clustered.scanned
+    keyphrases = clustered.keyphrases
+    document_data = clustered.documents  # Records built on access from compact columns
+    labels = clustered.labels
+    optimal_k = clustered.k
+    silhouette_value = clustered.silhouette
+    print(f"Final silhouette score: {silhouette_value:.4f}")
+else:
+    # Load data from MongoDB - only documents with embeddings, including domain field,
+    # streamed with a projection straight into one float32 matrix
+    print("Loading data from MongoDB...")
+    loaded = load_keyphrase_embeddings(chat_chunks_collection, embedding_query, preprocess_text,
+        extra_fields=("domain",),
+        # Skip "Unknown Topic" entries
+        skip_topics=("unknown topic",)
+    )
+    num_documents = loaded.scanned
+    print(f"Found {num_documents} documents with both dominant_topic and embeddings")
+
+    if len(loaded.keyphrases) == 0:
+        print("No documents found with both dominant_topic and embeddings fields. Exiting...")
+        client.close()
+        exit()
+
+    keyphrases = loaded.keyphrases
+    embeddings = loaded.embeddings
+    document_data = loaded.documents  # Full document data including domain
+
+    print(f"Total keyphrases with embeddings: {len(keyphrases)}")
+    print(f"Embedding shape: {embeddings.shape}")
+
+    # Verify embeddings are valid
+    if embeddings.size == 0:
+        print("No valid embeddings found. Exiting...")
+        client.close()
+        exit()
+
+    # Apply UMAP dimensionality reduction using the successful parameters from HDBSCAN
+    print("Applying UMAP dimensionality reduction...")
+    umap_params = {
+        "n_neighbors": 30,
+        "min_dist": 0.05
+    }
 
-for k in k_values:
-    print(f"Testing K={k}...")
-    kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-    kmeans.fit(reduced_embeddings)
-    inertia_values.append(kmeans.inertia_)
-    
-    # Calculate silhouette score
-    silhouette_avg = silhouette_score(reduced_embeddings, kmeans.labels_, metric="cosine")
-    
-    results.append({
-        "k": k,
-        "inertia": kmeans.inertia_,
-        "silhouette": silhouette_avg
-    })
-    
-    print(f"K={k}, Silhouette={silhouette_avg:.4f}")
-
-# Find optimal K using elbow method
-optimal_k = None
-try:
-    kneedle = KneeLocator(k_values, inertia_values, curve='convex', direction='decreasing')
-    optimal_k = kneedle.elbow
-    print(f"Automatically detected optimal K: {optimal_k}")
-except Exception as e:
-    print(f"Could not automatically detect optimal K: {e}")
-
-# If automatic detection failed, find K with the best silhouette score
-if optimal_k is None:
-    best_result = max(results, key=lambda x: x["silhouette"])
-    optimal_k = best_result["k"]
-    print(f"Using K with best silhouette score: {optimal_k}")
-
-# Run K-means with optimal K
-print(f"Running final K-means with K={optimal_k}...")
-kmeans = KMeans(n_clusters=optimal_k, random_state=42, n_init=10)
-labels = kmeans.fit_predict(reduced_embeddings)
-
-# Calculate final metrics
-silhouette_value = silhouette_score(reduced_embeddings, labels, metric="cosine")
-print(f"Final silhouette score: {silhouette_value:.4f}")
+    try:
+        # Cached on disk by (data hash, params), so reruns on unchanged data skip UMAP
+        reduced_embeddings = reduce_cached(embeddings, 25, umap_params)
+        print(f"Reduced embedding dimensions from {embeddings.shape[1]} to {reduced_embeddings.shape[1]}")
+    except Exception as e:
+        print(f"UMAP reduction failed: {e}")
+        client.close()
+        raise
+  
+    # Fit every candidate K in parallel (MiniBatchKMeans on large sets) and pick one
+    # by the inertia elbow, falling back to the best silhouette score
+    print("Finding optimal K...")
+    chosen, results = select_k(reduced_embeddings, k_values)
+    optimal_k = chosen["k"]
+
+    # Reuse the chosen K's fitted model instead of refitting it
+    kmeans = chosen["model"]
+    labels = chosen["labels"]
+
+    # Calculate final metrics
+    final_silhouette = sampled_silhouette(reduced_embeddings, labels, metric="cosine")
+    silhouette_value = final_silhouette["score"]
+    print(f"Final silhouette score: {silhouette_value:.4f} (±{final_silhouette['stderr']:.4f}, n={final_silhouette['sample_size']})")
 
 # Show cluster distribution
 unique_labels, counts = np.unique(labels, return_counts=True)
@@ -300,7 +246,6 @@ def merge_cluster_data(existing_doc, new_data):
 # Prepare cluster collection documents
 cluster_documents = []
 cluster_updates = []
-chat_chunks_updates = []
 
 print("Preparing data for database updates...")
 
@@ -345,22 +290,6 @@ for cluster_id, data in cluster_data.items():
         }
         cluster_documents.append(cluster_doc)
 
-# Prepare chat-chunks collection updates
-for idx, (doc_data, original_cluster_id) in enumerate(zip(document_data, labels)):
-    # Use adjusted cluster ID
-    adjusted_cluster_id = int(original_cluster_id) + next_cluster_id
-    
-    chat_chunks_update = {
-        "filter": {"_id": doc_data["_id"]},
-        "update": {"$set": {
-            "kmeans_cluster_id": adjusted_cluster_id,
-            "kmeans_cluster_keyphrase": doc_data["processed_keyphrase"],
-            "clustering_method": "kmeans",
-            "clustering_updated_at": time.time()
-        }}
-    }
-    chat_chunks_updates.append(chat_chunks_update)
-
 # Insert new cluster documents
 cluster_inserts_successful = 0
 cluster_inserts_failed = 0
@@ -403,24 +332,11 @@ if cluster_updates:
 
 # Update chat-chunks collection
 print("Updating chat-chunks collection with K-means cluster information...")
-chat_chunks_updates_successful = 0
-chat_chunks_updates_failed = 0
-
-for update_data in chat_chunks_updates:
-    try:
-        result = chat_chunks_collection.update_one(
-            update_data["filter"],
-            update_data["update"]
-        )
-        
-        if result.modified_count > 0 or result.matched_count > 0:
-            chat_chunks_updates_successful += 1
-        else:
-            chat_chunks_updates_failed += 1
-            
-    except Exception as e:
-        chat_chunks_updates_failed += 1
-        print(f"Error updating chat-chunks document {update_data['filter']['_id']}: {e}")
+# Streamed as unordered bulk chunks instead of one update_one per document
+write_stats = write_assignments(chat_chunks_collection, document_data, labels, offset=next_cluster_id,
+                                label="chat-chunks K-means write-back")
+chat_chunks_updates_successful = write_stats["matched"]
+chat_chunks_updates_failed = write_stats["failed_operations"]
 
 print(f"Successfully updated {chat_chunks_updates_successful} chat-chunks documents with K-means cluster information")
 if chat_chunks_updates_failed > 0:
@@ -483,7 +399,7 @@ print("\n" + "="*50)
 print("K-MEANS CLUSTERING COMPLETE")
 print("="*50)
 print(f"Execution time: {execution_time:.2f} seconds")
-print(f"Documents processed: {len(documents)}")
+print(f"Documents processed: {num_documents}")
 print(f"Keyphrases clustered: {len(keyphrases)}")
 print(f"New clusters created: {cluster_inserts_successful}")
 print(f"Existing clusters updated: {cluster_updates_successful}")
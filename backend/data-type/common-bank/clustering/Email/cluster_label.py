@@ -2,21 +2,34 @@ import asyncio
 import json
 import logging
 import re
+import sys
 import time
 import warnings
 import os
 from datetime import datetime
-from typing import Any, Dict, List, Set
+from pathlib import Path
+from typing import Any, Dict, List
 from collections import defaultdict
 import numpy as np
-import ollama
-import requests
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from pymongo.database import Database
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_common.llm_cache import LLMCache, prompt_version
+from pipeline_common.llm_labelling import (
+    LABEL_BATCH_SIZE,
+    LABEL_CONCURRENCY,
+    LABEL_WRITE_BATCH,
+    AsyncOllamaClient,
+    LabelReservations,
+    label_batches,
+    request_batch,
+)
+from pipeline_common.mongo_bulk import bulk_write_chunked
+from pipeline_common.subclustering import SUBCLUSTER_MODE, SUBCLUSTER_NAME_SAMPLE, subcluster_groups
+
 # Load environment variables
 load_dotenv()
 
@@ -30,9 +43,6 @@ logger = logging.getLogger(__name__)
 # Suppress warnings
 warnings.filterwarnings("ignore")
 
-# Ollama client configuration
-client = ollama.Client(host="http://localhost:11434")
-
 # Banking subcluster analysis prompt template with uniqueness enforcement
 SUBCLUSTER_PROMPT = """
 # Banking Subcluster Analysis System with Uniqueness Enforcement
@@ -134,6 +144,120 @@ Provide EXACTLY ONE LINE containing ONLY the 4-5 word unique banking label, with
 {keyphrases}
 """
 
+# Batched variants: several clusters per request, answered as a JSON array keyed by cluster id
+BATCH_DOMINANT_PROMPT = """
+You are an Expert Banking Cluster Labeling Analyst focused on creating UNIQUE, GRANULAR dominant labels for banking clusters.
+
+## EXISTING LABELS TO AVOID (CRITICAL)
+
+The following dominant labels have already been used and MUST NOT be duplicated:
+
+{existing_dominant_labels}
+
+## INSTRUCTIONS
+
+- Label EACH of the {cluster_count} clusters below with a HIGHLY SPECIFIC, GRANULAR banking label using EXACTLY 4-5 WORDS
+- Every label must be COMPLETELY UNIQUE: different from the existing labels AND from every other label in your answer
+- Focus on specific banking products, systems, processes, or technologies
+- Use precise banking industry terminology and avoid generic terms
+
+## CLUSTERS
+
+{clusters}
+
+## OUTPUT FORMAT - RESPOND WITH A VALID JSON ARRAY ONLY
+
+[
+  {{"id": "<cluster id>", "label": "<unique 4-5 word banking label>"}}
+]
+
+Include exactly one entry for each of the {cluster_count} cluster ids. NO explanations or additional text.
+"""
+
+BATCH_SUBCLUSTER_PROMPT = """
+# Banking Subcluster Analysis System with Uniqueness Enforcement
+
+You are an Expert Banking Topic Clustering Analyst specializing in creating UNIQUE, GRANULAR keyphrase clusters for financial institutions.
+
+## EXISTING LABELS TO AVOID (CRITICAL)
+
+EXISTING DOMINANT LABELS:
+{existing_dominant_labels}
+
+EXISTING SUBCLUSTER LABELS:
+{existing_subcluster_labels}
+
+## TASK DESCRIPTION
+
+For EACH of the {cluster_count} clusters below, group its keyphrases into UNIQUE subclusters.
+
+## CLUSTERS
+
+{clusters}
+
+## CRITICAL REQUIREMENTS
+
+1. **ABSOLUTE UNIQUENESS**: Every subcluster label must differ from existing labels and from all other labels in your answer
+2. **INCLUDE ALL KEYPHRASES**: Every keyphrase of a cluster must appear exactly once among that cluster's subclusters
+3. **GRANULAR SPECIFICITY**: Use specific banking terminology
+4. **JSON FORMAT ONLY**: Respond with a valid JSON array only, no explanations
+
+## OUTPUT FORMAT - RESPOND WITH A VALID JSON ARRAY ONLY
+
+[
+  {{
+    "id": "<cluster id>",
+    "subclusters": {{
+      "Mortgage Loan Processing System APIs": {{"keyphrases": ["keyphrase1", "keyphrase2"]}},
+      "Credit Risk Assessment ML Models": {{"keyphrases": ["keyphrase3"]}}
+    }}
+  }}
+]
+
+Include exactly one entry for each of the {cluster_count} cluster ids.
+"""
+
+# Embedding-based subclustering: the groups are fixed, the LLM only names them
+SUBCLUSTER_NAMING_PROMPT = """
+You are an Expert Banking Topic Clustering Analyst creating UNIQUE, GRANULAR subcluster labels for financial institutions.
+
+## EXISTING LABELS TO AVOID (CRITICAL)
+
+EXISTING DOMINANT LABELS:
+{existing_dominant_labels}
+
+EXISTING SUBCLUSTER LABELS:
+{existing_subcluster_labels}
+
+## TASK DESCRIPTION
+
+The keyphrases below have already been grouped into {group_count} subclusters (the most representative keyphrases of each are shown).
+Name EACH group with a specific 4-5 word banking label that describes its keyphrases.
+
+## GROUPS
+
+{groups}
+
+## CRITICAL REQUIREMENTS
+
+1. **ABSOLUTE UNIQUENESS**: Every label must differ from the existing labels and from all other labels in your answer
+2. **GRANULAR SPECIFICITY**: Use specific banking terminology, avoid generic terms
+3. **DO NOT REGROUP**: Name the groups exactly as given
+
+## OUTPUT FORMAT - RESPOND WITH A VALID JSON ARRAY ONLY
+
+[
+  {{"id": "<group id>", "label": "<unique 4-5 word banking label>"}}
+]
+
+Include exactly one entry for each of the {group_count} group ids. NO explanations or additional text.
+"""
+
+# Cached responses are keyed by these, so editing a prompt invalidates its cache entries
+DOMINANT_PROMPT_VERSION = prompt_version("dominant-label", DOMINANT_TOPIC_PROMPT)
+SUBCLUSTER_PROMPT_VERSION = prompt_version("subclusters", SUBCLUSTER_PROMPT)
+SUBCLUSTER_NAMING_PROMPT_VERSION = prompt_version("subcluster-names", SUBCLUSTER_NAMING_PROMPT)
+
 
 class UniqueBankingClusterLabeler:
     def __init__(self, db: Database):
@@ -145,11 +269,20 @@ class UniqueBankingClusterLabeler:
         self.db = db
         self.model_name = "gemma3:27b"
         self.max_retries = 5
-        self.used_dominant_labels: Set[str] = set()
-        self.used_subcluster_labels: Set[str] = set()
+        # Claimed atomically by concurrent cluster tasks, so two clusters never share a label
+        self.used_dominant_labels = LabelReservations()
+        self.used_subcluster_labels = LabelReservations()
         self.headers = {
             "Authorization": f"Bearer a2a78f42fbe58ce99fe0e3fec1726748ac434a16ea5cbfa9c1994979df874a0c"
         }
+        self.concurrency = LABEL_CONCURRENCY
+        self.llm = AsyncOllamaClient(model=self.model_name, headers=self.headers, concurrency=self.concurrency)
+        self.batch_size = LABEL_BATCH_SIZE
+        # Subclusters are grouped from the keyphrase embeddings of these messages unless SUBCLUSTER_MODE=llm
+        self.subcluster_mode = SUBCLUSTER_MODE
+        self.message_collection = "emailmessages"
+        # Accepted labels survive reruns; set LLM_CACHE_BYPASS=1 to ask the model again
+        self.llm_cache = LLMCache()
 
     def _create_indexes(self):
         """Create necessary indexes on collections"""
@@ -171,7 +304,7 @@ class UniqueBankingClusterLabeler:
         try:
             # Load existing dominant labels
             dominant_labels = self.db["cluster"].distinct("dominant_label")
-            self.used_dominant_labels = set(label for label in dominant_labels if label)
+            self.used_dominant_labels = LabelReservations(label for label in dominant_labels if label)
             
             # Load existing subcluster labels
             subcluster_labels = set()
@@ -186,95 +319,29 @@ class UniqueBankingClusterLabeler:
                     if isinstance(subcluster_info, dict) and "label" in subcluster_info:
                         subcluster_labels.add(subcluster_info["label"])
             
-            self.used_subcluster_labels = subcluster_labels
+            self.used_subcluster_labels = LabelReservations(subcluster_labels)
             
             logger.info(f"Loaded {len(self.used_dominant_labels)} existing dominant labels")
             logger.info(f"Loaded {len(self.used_subcluster_labels)} existing subcluster labels")
             
         except Exception as e:
             logger.error(f"Error loading existing labels: {e}")
-            self.used_dominant_labels = set()
-            self.used_subcluster_labels = set()
-
-    def _check_api_health(self):
-        """Check if the Ollama API is responsive"""
-        try:
-            response = requests.get(
-                "http://localhost:11434/api/tags",
-                timeout=10,
-                headers=self.headers
-            )
-
-            if response.status_code == 200:
-                logger.info("Ollama API health check: OK")
-                return True
-            else:
-                logger.warning(
-                    f"Ollama API health check failed with status code: {response.status_code}"
-                )
-                return False
-        except Exception as e:
-            logger.error(f"Ollama API health check failed: {e}")
-            return False
-
-    def _recreate_ollama_client(self):
-        """Recreate the Ollama client"""
-        try:
-            logger.info("Recreating Ollama client...")
-            global client
-            client = ollama.Client(host="http://localhost:11434")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to recreate Ollama client: {e}")
-            return False
-
-    @retry(
-        retry=retry_if_exception_type(
-            (
-                requests.exceptions.RequestException,
-                TimeoutError,
-                ConnectionError,
-                ollama.ResponseError,
-            )
-        ),
-        stop=stop_after_attempt(5),
-        wait=wait_exponential(multiplier=1, min=2, max=60),
-        before_sleep=lambda retry_state: logger.info(
-            f"API request failed, retrying in {retry_state.next_action.sleep} seconds... "
-            f"(Attempt {retry_state.attempt_number}/{5})"
-        ),
-    )
-    def _execute_ollama_request(self, prompt, model=None):
-        """Execute Ollama API request with retry logic"""
-        model_to_use = model if model else self.model_name
-
-        if not self._check_api_health():
-            logger.info("API seems to be down, waiting 15 seconds before retry...")
-            time.sleep(15)
-            if not self._check_api_health():
-                if self._recreate_ollama_client():
-                    logger.info("Ollama client recreated successfully")
-                else:
-                    logger.error("Failed to recreate client and API is still down")
-                    raise ConnectionError(
-                        "Ollama API is not responding after client recreation attempt"
-                    )
+            self.used_dominant_labels = LabelReservations()
+            self.used_subcluster_labels = LabelReservations()
 
+    async def _generate(self, prompt, model=None):
+        """Send a prompt through the shared non-blocking Ollama client"""
         try:
-            return client.generate(
-                model=model_to_use,
-                prompt=prompt,
-                options={
-                    "timeout_ms": 60000,
-                    "num_ctx": 30000,
-                    "num_predict": -1,
-                },
-            )
+            return await self.llm.generate(prompt, model=model or self.model_name)
         except Exception as e:
-            logger.error(f"Error during Ollama API call with model {model_to_use}: {e}")
-            self._recreate_ollama_client()
+            logger.error(f"Error during Ollama API call with model {model or self.model_name}: {e}")
             raise
 
+    async def close(self):
+        """Close the Ollama HTTP session and the response cache"""
+        await self.llm.close()
+        self.llm_cache.close()
+
     def extract_json_from_response(self, response_text):
         """Extract JSON from the LLM response with improved error handling"""
         logger.debug(f"Raw response text: {repr(response_text)}")
@@ -383,12 +450,23 @@ class UniqueBankingClusterLabeler:
     def _validate_label_uniqueness(self, label, label_type="dominant"):
         """Validate that a label is unique"""
         if label_type == "dominant":
-            return label.lower().strip() not in {l.lower().strip() for l in self.used_dominant_labels}
+            return label not in self.used_dominant_labels
         else:  # subcluster
-            return label.lower().strip() not in {l.lower().strip() for l in self.used_subcluster_labels}
+            return label not in self.used_subcluster_labels
+
+    async def _ensure_unique_dominant_label(self, keyphrases, max_attempts=5, use_cache=True):
+        """Generate a unique dominant label with multiple attempts if needed.
 
-    def _ensure_unique_dominant_label(self, keyphrases, max_attempts=5):
-        """Generate a unique dominant label with multiple attempts if needed"""
+        The returned label is already reserved in ``used_dominant_labels``.
+        With ``use_cache`` False the cached label is ignored (and replaced),
+        e.g. when regenerating a label that turned out to be a duplicate.
+        """
+        cache_key = self.llm_cache.key(self.model_name, DOMINANT_PROMPT_VERSION, keyphrases)
+        cached_label = self.llm_cache.get(cache_key) if use_cache else None
+        if cached_label and self.used_dominant_labels.reserve(cached_label):
+            logger.info(f"Using cached dominant topic: {cached_label}")
+            return cached_label
+        
         existing_labels_str = "\n".join([f"- {label}" for label in sorted(self.used_dominant_labels)])
         
         for attempt in range(max_attempts):
@@ -400,17 +478,13 @@ class UniqueBankingClusterLabeler:
                     keyphrases=formatted_keyphrases
                 )
                 
-                response = self._execute_ollama_request(prompt, model=self.model_name)
-                dominant_topic = response["response"].strip()
-                
-                # Clean the response
-                dominant_topic = re.sub(r"^[^a-zA-Z0-9]+", "", dominant_topic)
-                dominant_topic = re.sub(r"[^a-zA-Z0-9]+$", "", dominant_topic)
-                dominant_topic = dominant_topic.strip("\"'")
+                response = await self._generate(prompt, model=self.model_name)
+                dominant_topic = self._clean_label(response["response"])
                 
-                # Validate uniqueness
-                if self._validate_label_uniqueness(dominant_topic, "dominant"):
+                # Check and claim in one step so a concurrent cluster cannot take it too
+                if dominant_topic and self.used_dominant_labels.reserve(dominant_topic):
                     logger.info(f"Generated unique dominant topic (attempt {attempt + 1}): {dominant_topic}")
+                    self.llm_cache.put(cache_key, dominant_topic, self.model_name, DOMINANT_PROMPT_VERSION)
                     return dominant_topic
                 else:
                     logger.warning(f"Generated duplicate dominant label (attempt {attempt + 1}): {dominant_topic}")
@@ -422,12 +496,32 @@ class UniqueBankingClusterLabeler:
                 logger.error(f"Error generating dominant topic (attempt {attempt + 1}): {e}")
         
         # Fallback with timestamp if all attempts fail
-        fallback_label = f"Banking Cluster {int(time.time())}"
+        fallback_label = original_label = f"Banking Cluster {int(time.time())}"
+        counter = 1
+        while not self.used_dominant_labels.reserve(fallback_label):
+            fallback_label = f"{original_label}_v{counter}"
+            counter += 1
         logger.warning(f"Using fallback dominant label: {fallback_label}")
         return fallback_label
 
-    async def analyze_subclusters(self, cluster_id, keyphrases, max_attempts=5):
-        """Analyze keyphrases within a cluster to create unique subclusters"""
+    async def analyze_subclusters(self, cluster_id, keyphrases, max_attempts=5, use_cache=True):
+        """Analyze keyphrases within a cluster to create unique subclusters.
+
+        The returned labels are already reserved in ``used_subcluster_labels``.
+        With ``use_cache`` False cached subclusters are ignored (and replaced).
+        """
+        if self.subcluster_mode == "embedding":
+            subclusters = await self._embedding_subclusters(cluster_id, keyphrases)
+            if subclusters:
+                return subclusters
+            logger.warning(f"No keyphrase embeddings for cluster {cluster_id}, asking the LLM to partition it")
+        
+        cache_key = self.llm_cache.key(self.model_name, SUBCLUSTER_PROMPT_VERSION, keyphrases)
+        cached_subclusters = self.llm_cache.get(cache_key) if use_cache else None
+        if cached_subclusters and not self.used_subcluster_labels.reserve_all(cached_subclusters.keys()):
+            logger.info(f"Using {len(cached_subclusters)} cached subclusters for cluster {cluster_id}")
+            return cached_subclusters
+        
         existing_dominant_str = "\n".join([f"- {label}" for label in sorted(self.used_dominant_labels)])
         existing_subcluster_str = "\n".join([f"- {label}" for label in sorted(self.used_subcluster_labels)])
         
@@ -445,7 +539,7 @@ class UniqueBankingClusterLabeler:
                 )
 
                 logger.debug(f"Sending prompt for cluster {cluster_id}, attempt {attempt + 1}")
-                response = self._execute_ollama_request(prompt)
+                response = await self._generate(prompt)
                 response_text = response["response"].strip()
                 
                 logger.debug(f"Raw response for cluster {cluster_id}, attempt {attempt + 1}: {repr(response_text[:200])}")
@@ -469,36 +563,18 @@ class UniqueBankingClusterLabeler:
                         break
                 
                 # Validate that we have the expected structure
-                valid_subclusters = {}
-                for label, content in subclusters.items():
-                    if isinstance(content, dict) and "keyphrases" in content:
-                        keyphrases_list = content["keyphrases"]
-                    elif isinstance(content, list):
-                        keyphrases_list = content
-                    else:
-                        logger.warning(f"Invalid subcluster structure for label '{label}': {content}")
-                        continue
-                    
-                    if isinstance(keyphrases_list, list) and all(isinstance(kp, str) for kp in keyphrases_list):
-                        valid_subclusters[label] = {"keyphrases": keyphrases_list}
-                    else:
-                        logger.warning(f"Invalid keyphrases structure for label '{label}': {keyphrases_list}")
+                valid_subclusters = self._valid_subclusters(subclusters)
                 
                 if not valid_subclusters:
                     logger.warning(f"No valid subclusters extracted for cluster {cluster_id} (attempt {attempt + 1})")
                     continue
                 
-                # Validate uniqueness of all subcluster labels
-                all_labels_unique = True
-                duplicate_labels = []
-                
-                for label in valid_subclusters.keys():
-                    if not self._validate_label_uniqueness(label, "subcluster"):
-                        all_labels_unique = False
-                        duplicate_labels.append(label)
+                # Reserve every subcluster label at once, or none if any is already taken
+                duplicate_labels = self.used_subcluster_labels.reserve_all(valid_subclusters.keys())
                 
-                if all_labels_unique:
+                if not duplicate_labels:
                     logger.info(f"Generated {len(valid_subclusters)} unique subclusters for cluster {cluster_id} (attempt {attempt + 1})")
+                    self.llm_cache.put(cache_key, valid_subclusters, self.model_name, SUBCLUSTER_PROMPT_VERSION)
                     return valid_subclusters
                 else:
                     logger.warning(f"Found duplicate subcluster labels (attempt {attempt + 1}): {duplicate_labels}")
@@ -520,6 +596,63 @@ class UniqueBankingClusterLabeler:
         fallback_subclusters = self._create_fallback_subclusters(cluster_id, keyphrases)
         return fallback_subclusters
 
+    async def _embedding_subclusters(self, cluster_id, keyphrases):
+        """Subclusters from the keyphrase embeddings, named by the LLM; None if the embeddings are unavailable.
+
+        The returned labels are already reserved in ``used_subcluster_labels``.
+        """
+        try:
+            groups = await asyncio.to_thread(subcluster_groups, self.db[self.message_collection], cluster_id, keyphrases)
+        except Exception as e:
+            logger.error(f"Error grouping keyphrases of cluster {cluster_id}: {e}")
+            return None
+        if not groups:
+            return None
+        
+        cache_key = self.llm_cache.key(self.model_name, SUBCLUSTER_NAMING_PROMPT_VERSION, groups)
+        cached_subclusters = self.llm_cache.get(cache_key)
+        if cached_subclusters and not self.used_subcluster_labels.reserve_all(cached_subclusters.keys()):
+            logger.info(f"Using {len(cached_subclusters)} cached subcluster names for cluster {cluster_id}")
+            return cached_subclusters
+        
+        def build_prompt(pending, rejected):
+            return SUBCLUSTER_NAMING_PROMPT.format(
+                existing_dominant_labels="\n".join(f"- {label}" for label in sorted(self.used_dominant_labels)),
+                existing_subcluster_labels="\n".join(f"- {label}" for label in sorted(self.used_subcluster_labels) + rejected),
+                groups=json.dumps([{"id": group_id, "keyphrases": group[:SUBCLUSTER_NAME_SAMPLE]}
+                                   for group_id, group in pending.items()], ensure_ascii=False, indent=2),
+                group_count=len(pending)
+            )
+        
+        def accept(group_id, entry):
+            label = self._clean_label(entry.get("label"))
+            if label and self.used_subcluster_labels.reserve(label):
+                return label, []
+            return None, [label]
+        
+        items = {str(group_idx): group for group_idx, group in enumerate(groups)}
+        names, unnamed, requests = await request_batch(items, build_prompt, self._generate_text, accept,
+                                                       max_rounds=self.max_retries)
+        
+        subclusters = {}
+        timestamp = int(time.time())
+        for group_id, group in items.items():
+            label = names.get(group_id)
+            if label is None:
+                label = original_label = f"Banking Operations Subset {timestamp}_{cluster_id}_{int(group_id) + 1}"
+                counter = 1
+                while not self.used_subcluster_labels.reserve(label):
+                    label = f"{original_label}_v{counter}"
+                    counter += 1
+            subclusters[label] = {"keyphrases": group}
+        
+        if unnamed:
+            logger.warning(f"Using fallback names for {len(unnamed)} of {len(groups)} subclusters of cluster {cluster_id}")
+        else:
+            self.llm_cache.put(cache_key, subclusters, self.model_name, SUBCLUSTER_NAMING_PROMPT_VERSION)
+        logger.info(f"Named {len(names)} embedding subclusters for cluster {cluster_id} in {requests} requests")
+        return subclusters
+
     def _create_fallback_subclusters(self, cluster_id, keyphrases):
         """Create fallback subclusters when LLM generation fails"""
         fallback_subclusters = {}
@@ -540,16 +673,226 @@ class UniqueBankingClusterLabeler:
             # Ensure this fallback label is unique
             counter = 1
             original_label = fallback_label
-            while not self._validate_label_uniqueness(fallback_label, "subcluster"):
+            while not self.used_subcluster_labels.reserve(fallback_label):
                 fallback_label = f"{original_label}_v{counter}"
                 counter += 1
             
             fallback_subclusters[fallback_label] = {"keyphrases": chunk_keyphrases}
-            self.used_subcluster_labels.add(fallback_label)
         
         logger.info(f"Created {len(fallback_subclusters)} fallback subclusters for cluster {cluster_id}")
         return fallback_subclusters
 
+    async def _label_cluster(self, cluster_id, keyphrases):
+        """Generate labels for one cluster; returns its cluster UpdateOne, or None on failure"""
+        try:
+            logger.info(f"Processing cluster {cluster_id} with {len(keyphrases)} keyphrases")
+            
+            # Generate unique dominant topic (reserved on return)
+            dominant_topic = await self._ensure_unique_dominant_label(keyphrases)
+            
+            # Analyze unique subclusters
+            subclusters = await self.analyze_subclusters(cluster_id, keyphrases)
+            
+            if "error" in subclusters:
+                logger.error(f"Error in subcluster analysis for cluster {cluster_id}: {subclusters['error']}")
+                self.used_dominant_labels.discard(dominant_topic)
+                return None
+            
+            return self._cluster_update(cluster_id, keyphrases, dominant_topic, subclusters)
+            
+        except Exception as e:
+            logger.error(f"Error processing cluster {cluster_id}: {e}")
+            return None
+
+    def _cluster_update(self, cluster_id, keyphrases, dominant_topic, subclusters):
+        """Cluster UpdateOne storing the labels, with unassigned keyphrases in a fallback subcluster"""
+        # Validate all keyphrases are included
+        original_keyphrases_set = set(keyphrases)
+        all_subcluster_keyphrases = set()
+        
+        for label, content in subclusters.items():
+            if isinstance(content, dict):
+                all_subcluster_keyphrases.update(set(content.get("keyphrases", [])))
+            elif isinstance(content, list):
+                all_subcluster_keyphrases.update(set(content))
+        
+        missing_keyphrases = original_keyphrases_set - all_subcluster_keyphrases
+        
+        # If there are missing keyphrases, add them to a fallback subcluster
+        if missing_keyphrases:
+            logger.warning(f"Found {len(missing_keyphrases)} missing keyphrases in cluster {cluster_id}")
+            fallback_label = original_label = f"Additional Banking Operations {int(time.time())}"
+            counter = 1
+            while not self.used_subcluster_labels.reserve(fallback_label):
+                fallback_label = f"{original_label}_v{counter}"
+                counter += 1
+            subclusters[fallback_label] = {"keyphrases": list(missing_keyphrases)}
+        
+        # Format subclusters for storage
+        formatted_subclusters = {}
+        for subcluster_idx, (label, content) in enumerate(subclusters.items()):
+            if isinstance(content, dict):
+                keyphrases_list = content.get("keyphrases", [])
+            elif isinstance(content, list):
+                keyphrases_list = content
+            else:
+                keyphrases_list = []
+        
+            formatted_subclusters[str(subcluster_idx)] = {
+                "label": label,
+                "keyphrases": keyphrases_list
+            }
+        
+        update_doc = {
+            "dominant_label": dominant_topic,
+            "subclusters": formatted_subclusters,
+            "original_keyphrases_count": len(keyphrases),
+            "processing_date": datetime.now().isoformat(),
+            "uniqueness_validated": True
+        }
+        
+        logger.info(f"Successfully labelled cluster {cluster_id} as '{dominant_topic}'")
+        return UpdateOne({"cluster_id": cluster_id}, {"$set": update_doc})
+
+    @staticmethod
+    def _clean_label(text):
+        """Strip quotes, bullets and trailing punctuation from an LLM label"""
+        label = re.sub(r"^[^a-zA-Z0-9]+", "", str(text or "").strip())
+        label = re.sub(r"[^a-zA-Z0-9]+$", "", label)
+        return label.strip("\"'")
+
+    def _valid_subclusters(self, subclusters):
+        """Keep the {label: {"keyphrases": [...]}} entries of a parsed subcluster answer"""
+        valid_subclusters = {}
+        if not isinstance(subclusters, dict):
+            return valid_subclusters
+        for label, content in subclusters.items():
+            if isinstance(content, dict) and "keyphrases" in content:
+                keyphrases_list = content["keyphrases"]
+            elif isinstance(content, list):
+                keyphrases_list = content
+            else:
+                logger.warning(f"Invalid subcluster structure for label '{label}': {content}")
+                continue
+            
+            if isinstance(keyphrases_list, list) and all(isinstance(kp, str) for kp in keyphrases_list):
+                valid_subclusters[label] = {"keyphrases": keyphrases_list}
+            else:
+                logger.warning(f"Invalid keyphrases structure for label '{label}': {keyphrases_list}")
+        return valid_subclusters
+
+    @staticmethod
+    def _format_batch_clusters(pending):
+        return json.dumps([{"id": item_id, "keyphrases": keyphrases} for item_id, keyphrases in pending.items()],
+                          ensure_ascii=False, indent=2)
+
+    async def _generate_text(self, prompt):
+        response = await self._generate(prompt)
+        return response["response"]
+
+    async def _batch_dominant_labels(self, batch):
+        """Reserved dominant labels {str(cluster_id): label} for the clusters one batched prompt per round resolved"""
+        results, pending, cache_keys = {}, {}, {}
+        for cluster_id, keyphrases in batch:
+            item_id = str(cluster_id)
+            cache_keys[item_id] = self.llm_cache.key(self.model_name, DOMINANT_PROMPT_VERSION, keyphrases)
+            cached_label = self.llm_cache.get(cache_keys[item_id])
+            if cached_label and self.used_dominant_labels.reserve(cached_label):
+                results[item_id] = cached_label
+            else:
+                pending[item_id] = keyphrases
+        if not pending:
+            return results
+        
+        def build_prompt(pending, rejected):
+            existing = sorted(self.used_dominant_labels) + rejected
+            return BATCH_DOMINANT_PROMPT.format(
+                existing_dominant_labels="\n".join(f"- {label}" for label in existing),
+                clusters=self._format_batch_clusters(pending),
+                cluster_count=len(pending)
+            )
+        
+        def accept(item_id, entry):
+            label = self._clean_label(entry.get("label"))
+            # Reserving also catches duplicates between clusters of the same answer
+            if label and self.used_dominant_labels.reserve(label):
+                return label, []
+            return None, [label]
+        
+        labelled, unresolved, requests = await request_batch(pending, build_prompt, self._generate_text, accept)
+        for item_id, label in labelled.items():
+            self.llm_cache.put(cache_keys[item_id], label, self.model_name, DOMINANT_PROMPT_VERSION)
+        logger.info(f"Batched dominant labels: {len(labelled)}/{len(pending)} clusters in {requests} requests")
+        results.update(labelled)
+        return results
+
+    async def _batch_subclusters(self, batch):
+        """Reserved subclusters {str(cluster_id): {label: {"keyphrases": [...]}}} resolved by batched prompts"""
+        results, pending, cache_keys = {}, {}, {}
+        for cluster_id, keyphrases in batch:
+            item_id = str(cluster_id)
+            cache_keys[item_id] = self.llm_cache.key(self.model_name, SUBCLUSTER_PROMPT_VERSION, keyphrases)
+            cached_subclusters = self.llm_cache.get(cache_keys[item_id])
+            if cached_subclusters and not self.used_subcluster_labels.reserve_all(cached_subclusters.keys()):
+                results[item_id] = cached_subclusters
+            else:
+                pending[item_id] = keyphrases
+        if not pending:
+            return results
+        
+        def build_prompt(pending, rejected):
+            return BATCH_SUBCLUSTER_PROMPT.format(
+                existing_dominant_labels="\n".join(f"- {label}" for label in sorted(self.used_dominant_labels)),
+                existing_subcluster_labels="\n".join(f"- {label}" for label in sorted(self.used_subcluster_labels) + rejected),
+                clusters=self._format_batch_clusters(pending),
+                cluster_count=len(pending)
+            )
+        
+        def accept(item_id, entry):
+            subclusters = self._valid_subclusters(entry.get("subclusters"))
+            if not subclusters:
+                return None, []
+            conflicts = self.used_subcluster_labels.reserve_all(subclusters.keys())
+            if conflicts:
+                return None, conflicts
+            return subclusters, []
+        
+        labelled, unresolved, requests = await request_batch(pending, build_prompt, self._generate_text, accept)
+        for item_id, subclusters in labelled.items():
+            self.llm_cache.put(cache_keys[item_id], subclusters, self.model_name, SUBCLUSTER_PROMPT_VERSION)
+        logger.info(f"Batched subclusters: {len(labelled)}/{len(pending)} clusters in {requests} requests")
+        results.update(labelled)
+        return results
+
+    async def _label_cluster_batch(self, batch):
+        """Label several clusters with shared prompts; clusters left unresolved get their own prompts"""
+        logger.info(f"Processing batch of {len(batch)} clusters: {[cluster_id for cluster_id, _ in batch]}")
+        dominant_labels = await self._batch_dominant_labels(batch)
+        # Embedding subclusters are grouped per cluster, so only LLM partitioning is batched
+        subclusters = await self._batch_subclusters(batch) if self.subcluster_mode == "llm" else {}
+        
+        operations = []
+        for cluster_id, keyphrases in batch:
+            try:
+                item_id = str(cluster_id)
+                if item_id not in dominant_labels:
+                    logger.info(f"Cluster {cluster_id} unresolved by the batch, labelling it on its own")
+                dominant_topic = dominant_labels.get(item_id) or await self._ensure_unique_dominant_label(keyphrases)
+                cluster_subclusters = subclusters.get(item_id) or await self.analyze_subclusters(cluster_id, keyphrases)
+                operations.append(self._cluster_update(cluster_id, keyphrases, dominant_topic, cluster_subclusters))
+            except Exception as e:
+                logger.error(f"Error processing cluster {cluster_id}: {e}")
+        return operations
+
+    def _write_cluster_labels(self, operations):
+        """Write a batch of cluster label updates in bulk; returns how many were written"""
+        if not operations:
+            return 0
+        stats = bulk_write_chunked(self.db["cluster"], operations, label="cluster labels", verbose=False)
+        written = stats["operations"] - stats["failed_operations"]
+        logger.info(f"Wrote labels for {written} clusters ({stats['failed_operations']} failed)")
+        return written
+
     def collect_cluster_data(self):
         """Collect and organize cluster data from the cluster collection"""
         try:
@@ -574,7 +917,8 @@ class UniqueBankingClusterLabeler:
                             "keyphrases": keyphrases,
                             "count": len(keyphrases),
                             "cluster_name": cluster.get("cluster_name", ""),
-                            "_id": cluster.get("_id")
+                            "_id": cluster.get("_id"),
+                            "labelled": "dominant_label" in cluster and "subclusters" in cluster
                         }
                         logger.info(f"Cluster {cluster_id}: {len(keyphrases)} keyphrases")
             
@@ -742,106 +1086,37 @@ class UniqueBankingClusterLabeler:
             
             processed_count = 0
             skipped_count = 0
+            pending = {}
             
             for cluster_id, data in cluster_data.items():
-                try:
-                    keyphrases = data["keyphrases"]
-                    cluster_object_id = data["_id"]
-                    
-                    # Check if already processed (has both dominant_label and subclusters)
-                    existing_cluster = self.db["cluster"].find_one({"cluster_id": cluster_id})
-                    
-                    if (existing_cluster and 
-                        "dominant_label" in existing_cluster and 
-                        "subclusters" in existing_cluster):
-                        logger.info(f"Skipping already processed cluster {cluster_id}")
-                        # Add existing labels to our tracking sets
-                        if existing_cluster.get("dominant_label"):
-                            self.used_dominant_labels.add(existing_cluster["dominant_label"])
-                        
-                        subclusters = existing_cluster.get("subclusters", {})
-                        for subcluster_info in subclusters.values():
-                            if isinstance(subcluster_info, dict) and "label" in subcluster_info:
-                                self.used_subcluster_labels.add(subcluster_info["label"])
-                        
-                        skipped_count += 1
-                        continue
-                    
-                    logger.info(f"Processing cluster {cluster_id} with {len(keyphrases)} keyphrases")
-                    
-                    # Generate unique dominant topic
-                    dominant_topic = self._ensure_unique_dominant_label(keyphrases)
-                    self.used_dominant_labels.add(dominant_topic)
-                    
-                    # Analyze unique subclusters
-                    subclusters = await self.analyze_subclusters(cluster_id, keyphrases)
-                    
-                    if "error" in subclusters:
-                        logger.error(f"Error in subcluster analysis for cluster {cluster_id}: {subclusters['error']}")
-                        continue
-                    
-                    # Add new subcluster labels to tracking set
-                    for label in subclusters.keys():
-                        self.used_subcluster_labels.add(label)
-                    
-                    # Validate all keyphrases are included
-                    original_keyphrases_set = set(keyphrases)
-                    all_subcluster_keyphrases = set()
-                    
-                    for label, content in subclusters.items():
-                        if isinstance(content, dict):
-                            all_subcluster_keyphrases.update(set(content.get("keyphrases", [])))
-                        elif isinstance(content, list):
-                            all_subcluster_keyphrases.update(set(content))
-                    
-                    missing_keyphrases = original_keyphrases_set - all_subcluster_keyphrases
-                    
-                    # If there are missing keyphrases, add them to a fallback subcluster
-                    if missing_keyphrases:
-                        logger.warning(f"Found {len(missing_keyphrases)} missing keyphrases in cluster {cluster_id}")
-                        fallback_label = f"Additional Banking Operations {int(time.time())}"
-                        subclusters[fallback_label] = {"keyphrases": list(missing_keyphrases)}
-                        self.used_subcluster_labels.add(fallback_label)
-                    
-                    # Format subclusters for storage
-                    formatted_subclusters = {}
-                    for subcluster_idx, (label, content) in enumerate(subclusters.items()):
-                        if isinstance(content, dict):
-                            keyphrases_list = content.get("keyphrases", [])
-                        elif isinstance(content, list):
-                            keyphrases_list = content
-                        else:
-                            keyphrases_list = []
-                        
-                        formatted_subclusters[str(subcluster_idx)] = {
-                            "label": label,
-                            "keyphrases": keyphrases_list
-                        }
-                    
-                    # Update the cluster document
-                    update_doc = {
-                        "dominant_label": dominant_topic,
-                        "subclusters": formatted_subclusters,
-                        "original_keyphrases_count": len(keyphrases),
-                        "processing_date": datetime.now().isoformat(),
-                        "uniqueness_validated": True
-                    }
-                    
-                    # Update cluster collection
-                    self.db["cluster"].update_one(
-                        {"cluster_id": cluster_id},
-                        {"$set": update_doc}
-                    )
-                    
-                    processed_count += 1
-                    logger.info(f"Successfully processed cluster {cluster_id} as '{dominant_topic}'")
-                    
-                    # Small delay to avoid overwhelming the API
-                    await asyncio.sleep(0.5)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing cluster {cluster_id}: {e}")
-                    continue
+                # Already processed (has both dominant_label and subclusters); its labels were loaded above
+                if data["labelled"]:
+                    logger.info(f"Skipping already processed cluster {cluster_id}")
+                    skipped_count += 1
+                else:
+                    pending[cluster_id] = data
+            
+            # Label clusters concurrently; LLM capacity, not cluster order, bounds throughput
+            logger.info(f"Labelling {len(pending)} clusters with up to {self.concurrency} in flight")
+            semaphore = asyncio.BoundedSemaphore(self.concurrency)
+            
+            async def label_bounded(batch):
+                async with semaphore:
+                    if len(batch) == 1:
+                        return [await self._label_cluster(*batch[0])]
+                    return await self._label_cluster_batch(batch)
+            
+            # With LABEL_BATCH_SIZE > 1 each task labels several clusters with shared prompts
+            batches = label_batches([(cluster_id, data["keyphrases"]) for cluster_id, data in pending.items()],
+                                    self.batch_size)
+            tasks = [asyncio.create_task(label_bounded(batch)) for batch in batches]
+            operations = []
+            for task in asyncio.as_completed(tasks):
+                operations.extend(operation for operation in await task if operation is not None)
+                if len(operations) >= LABEL_WRITE_BATCH:
+                    processed_count += self._write_cluster_labels(operations)
+                    operations = []
+            processed_count += self._write_cluster_labels(operations)
             
             # Update emailmessages collection with labels
             logger.info("Updating emailmessages collection with labels...")
@@ -861,6 +1136,11 @@ class UniqueBankingClusterLabeler:
                 "execution_time_seconds": execution_time,
                 "unique_dominant_labels": len(self.used_dominant_labels),
                 "unique_subcluster_labels": len(self.used_subcluster_labels),
+                "concurrency": self.concurrency,
+                "batch_size": self.batch_size,
+                "subcluster_mode": self.subcluster_mode,
+                "llm_requests": self.llm.report(),
+                "llm_cache": self.llm_cache.report(),
                 "email_update_result": email_update_result
             }
             
@@ -1017,8 +1297,8 @@ class UniqueBankingClusterLabeler:
                             # Remove the duplicate label from tracking
                             self.used_dominant_labels.discard(duplicate_label)
                             
-                            # Generate new unique label
-                            new_label = self._ensure_unique_dominant_label(keyphrases)
+                            # Generate new unique label; the cached label is the duplicate itself
+                            new_label = await self._ensure_unique_dominant_label(keyphrases, use_cache=False)
                             
                             # Update database
                             self.db["cluster"].update_one(
@@ -1046,8 +1326,8 @@ class UniqueBankingClusterLabeler:
                             # Remove duplicate subcluster labels from tracking
                             self.used_subcluster_labels.discard(duplicate_label)
                             
-                            # Regenerate subclusters
-                            new_subclusters = await self.analyze_subclusters(cluster_id, keyphrases)
+                            # Regenerate subclusters, bypassing the cached (duplicate) ones
+                            new_subclusters = await self.analyze_subclusters(cluster_id, keyphrases, use_cache=False)
                             
                             # Format for storage
                             formatted_subclusters = {}
@@ -1248,7 +1528,8 @@ async def main():
         summary = await labeler.get_cluster_summary()
         logger.info(f"Final cluster summary: {summary}")
         
-        # Close MongoDB connection
+        # Close the Ollama session and MongoDB connection
+        await labeler.close()
         mongo_client.close()
         
         return {
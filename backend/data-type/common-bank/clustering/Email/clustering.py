@@ -1,21 +1,24 @@
 import warnings
 import re
-import spacy
 import gensim
-import hdbscan
 import numpy as np
 import pandas as pd
 import os
 import time
-import umap
-from gensim.corpora.dictionary import Dictionary
-from sklearn.metrics import silhouette_score
-from sklearn.metrics.pairwise import cosine_similarity
-from gensim.models.coherencemodel import CoherenceModel
 from pymongo import MongoClient
 from bson import ObjectId
 from dotenv import load_dotenv
 import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_common.embedding_loader import load_keyphrase_embeddings
+from pipeline_common.embedding_models import configured_model_id, embedding_model_filter
+from pipeline_common.experiments import REGISTRY_FILE, save_experiment
+from pipeline_common.preprocess import Lemmatizer
+from pipeline_common.coherence import COHERENCE_MODE
+from pipeline_common.sweep import reduce_cached, run_hdbscan_sweep
 
 warnings.filterwarnings("ignore")
 
@@ -39,75 +42,32 @@ print("Connecting to MongoDB...")
 print(f"Database: {DB_NAME}")
 print(f"Collection: {COLLECTION_NAME}")
 
-# Load spaCy model with only necessary components for speed
-nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-
-def preprocess_text(text):
-    """Lemmatize and filter text"""
-    if not isinstance(text, str):
-        text = str(text)
-    doc = nlp(text.lower())  
-    lemmatized_tokens = [
-        token.lemma_ for token in doc if not token.is_stop and not token.is_punct
-    ]
-    return " ".join(lemmatized_tokens)
+# Batched spaCy lemmatization backed by the shared lemma cache; spaCy loads only on cache misses
+preprocess_text = Lemmatizer()
 
-# Load data from MongoDB - only documents with embeddings
+# Load data from MongoDB - only documents with embeddings, streamed with a
+# projection straight into one float32 matrix
 print("Loading data from MongoDB...")
-cursor = collection.find({
+loaded = load_keyphrase_embeddings(collection, {
     "dominant_topic": {"$exists": True, "$ne": None},
-    "embeddings": {"$exists": True, "$ne": []}
-})
-documents = list(cursor)
-print(f"Found {len(documents)} documents with both dominant_topic and embeddings")
+    "embeddings": {"$exists": True, "$ne": []},
+    # Only vectors from the configured embedding model are comparable
+    **embedding_model_filter(configured_model_id())
+}, preprocess_text)
+num_documents = loaded.scanned
+print(f"Found {num_documents} documents with both dominant_topic and embeddings")
 
-if len(documents) == 0:
+if len(loaded.keyphrases) == 0:
     print("No documents found with both dominant_topic and embeddings fields. Exiting...")
     client.close()
     exit()
 
-# Extract keyphrases and embeddings from MongoDB documents
-keyphrases = []
-embeddings = []
-document_ids = []
+keyphrases = loaded.keyphrases
+embeddings = loaded.embeddings
+document_ids = [ids[0] for ids in loaded.document_ids]
 keyphrase_to_documents = {}
-document_to_keyphrase = {}
-
-print("Processing documents and extracting keyphrases with embeddings...")
-for doc in documents:
-    doc_id = doc["_id"]
-    dominant_topic = doc.get("dominant_topic", "")
-    embedding_data = doc.get("embeddings", [])
-    
-    if not dominant_topic or not isinstance(dominant_topic, str) or len(dominant_topic.strip()) == 0:
-        print(f"Skipping document {doc_id}: empty or invalid dominant_topic")
-        continue
-    
-    if not embedding_data or len(embedding_data) == 0:
-        print(f"Skipping document {doc_id}: empty embeddings")
-        continue
-        
-    # Preprocess the dominant topic
-    lemmatized_phrase = preprocess_text(dominant_topic)
-    if lemmatized_phrase.strip():
-        # Convert embedding list to numpy array
-        embedding_vector = np.array(embedding_data)
-        
-        # Store the data
-        keyphrases.append(lemmatized_phrase)
-        embeddings.append(embedding_vector)
-        document_ids.append(doc_id)
-        
-        # Create mappings
-        document_to_keyphrase[doc_id] = lemmatized_phrase
-        if lemmatized_phrase not in keyphrase_to_documents:
-            keyphrase_to_documents[lemmatized_phrase] = []
-        keyphrase_to_documents[lemmatized_phrase].append(doc_id)
-    else:
-        print(f"Skipping document {doc_id}: processed keyphrase is empty")
-
-# Convert embeddings to numpy array
-embeddings = np.array(embeddings)
+for phrase, doc_id in zip(keyphrases, document_ids):
+    keyphrase_to_documents.setdefault(phrase, []).append(doc_id)
 
 print(f"Total keyphrases with embeddings: {len(keyphrases)}")
 print(f"Embedding shape: {embeddings.shape}")
@@ -157,203 +117,118 @@ best_avg_similarity = -1
 best_umap_params = None
 best_hdbscan_params = None
 best_labels = None
-best_reduced_embeddings = None
+best_exp_id = None
 
-for umap_idx, umap_params in enumerate(umap_params_list):
-    print(f"\n--- UMAP Experiment {umap_idx+1}: {umap_params} ---")
+# UMAP reductions are cached on disk, so HDBSCAN variants and reruns reuse them;
+# the (UMAP, HDBSCAN) grid itself is evaluated on a process pool
+sweep_results = run_hdbscan_sweep(
+    embeddings, keyphrases, umap_params_list, hdbscan_params_list,
+    n_components=20,
+)
+
+for result in sweep_results:
+    exp_id = result['experiment_id']
+    umap_params = result['umap_params']
+    hdbscan_params = result['hdbscan_params']
+    labels = result['labels']
+    num_clusters = result['num_clusters']
+    noise_count = result['noise_count']
+    noise_percent = result['noise_percent']
+    print(f"\n-- Experiment {exp_id}: UMAP {umap_params}, HDBSCAN {hdbscan_params} ({result['seconds']}s) --")
+    print(f"Found {num_clusters} clusters with {noise_count} noise points ({noise_percent:.1f}%)")
+    
+    # Skip further analysis if we found only noise or a single cluster
+    if num_clusters <= 1:
+        print("Insufficient clusters found, skipping this parameter combination")
+        continue
+    
+    for error in result['errors']:
+        print(error)
+    silhouette_value = result['silhouette_score']
+    coherence_value = result['coherence_score']
+    overall_avg_similarity = result['avg_similarity']
     
-    # Apply UMAP dimensionality reduction
-    reducer = umap.UMAP(
-        n_components=20,
-        metric='cosine',
-        **umap_params
+    # Create dataframe with cluster assignments
+    clustered_df = pd.DataFrame({
+        'keyphrase': keyphrases, 
+        'cluster_id': labels,
+        'document_id': [str(doc_id) for doc_id in document_ids]
+    })
+    
+    # Group by cluster
+    final_df = clustered_df.groupby('cluster_id')['keyphrase'].apply(list).reset_index()
+    final_df['cluster_name'] = final_df['cluster_id'].apply(
+        lambda x: f'Cluster {x}' if x != -1 else 'Cluster -1 (Noise)'
     )
+    final_df.rename(columns={'keyphrase': 'keywords'}, inplace=True)
     
-    try:
-        reduced_embeddings = reducer.fit_transform(embeddings)
-        print(f"Reduced embedding dimensions from {embeddings.shape[1]} to {reduced_embeddings.shape[1]}")
-    except Exception as e:
-        print(f"UMAP reduction failed: {e}")
-        continue
+    # Show cluster sizes
+    cluster_sizes = clustered_df['cluster_id'].value_counts().sort_index()
+    print("\nCluster sizes:")
+    for cluster_id, size in cluster_sizes.items():
+        cluster_name = "Noise" if cluster_id == -1 else f"Cluster {cluster_id}"
+        print(f"{cluster_name}: {size} keyphrases")
     
-    for hdbscan_idx, hdbscan_params in enumerate(hdbscan_params_list):
-        exp_id = f"umap_{umap_idx+1}_hdbscan_{hdbscan_idx+1}"
-        print(f"\n-- HDBSCAN Experiment: {hdbscan_params} --")
-        
-        # Apply HDBSCAN clustering
-        clusterer = hdbscan.HDBSCAN(
-            metric='euclidean',
-            core_dist_n_jobs=-1,
-            **hdbscan_params
-        )
-        
-        labels = clusterer.fit_predict(reduced_embeddings)
-        
-        # Calculate clustering metrics
-        num_clusters = len(set(labels)) - (1 if -1 in labels else 0)
-        noise_count = np.sum(labels == -1)
-        noise_percent = noise_count / len(labels) * 100
-        
-        print(f"Found {num_clusters} clusters with {noise_count} noise points ({noise_percent:.1f}%)")
-        
-        # Skip further analysis if we found only noise or a single cluster
-        if num_clusters <= 1:
-            print("Insufficient clusters found, skipping this parameter combination")
-            continue
-        
-        # Calculate silhouette score
-        silhouette_value = np.nan
-        try:
-            valid_labels = labels != -1
-            if valid_labels.sum() > 1 and num_clusters > 1:
-                silhouette_value = silhouette_score(
-                    reduced_embeddings[valid_labels], 
-                    labels[valid_labels], 
-                    metric="cosine"
-                )
-                print(f"Silhouette score: {silhouette_value:.4f}")
-        except Exception as e:
-            print(f"Could not calculate silhouette score: {e}")
-        
-        # Create dataframe with cluster assignments
-        clustered_df = pd.DataFrame({
-            'keyphrase': keyphrases, 
-            'cluster_id': labels,
-            'document_id': [str(doc_id) for doc_id in document_ids]
-        })
-        
-        # Group by cluster
-        final_df = clustered_df.groupby('cluster_id')['keyphrase'].apply(list).reset_index()
-        final_df['cluster_name'] = final_df['cluster_id'].apply(
-            lambda x: f'Cluster {x}' if x != -1 else 'Cluster -1 (Noise)'
-        )
-        final_df.rename(columns={'keyphrase': 'keywords'}, inplace=True)
-        
-        # Show cluster sizes
-        cluster_sizes = clustered_df['cluster_id'].value_counts().sort_index()
-        print("\nCluster sizes:")
-        for cluster_id, size in cluster_sizes.items():
-            cluster_name = "Noise" if cluster_id == -1 else f"Cluster {cluster_id}"
-            print(f"{cluster_name}: {size} keyphrases")
-        
-        # Display cluster contents (up to 5 items per cluster)
-        print("\nCluster contents:")
-        for _, row in final_df.iterrows():
-            cluster_id = row['cluster_id']
-            keywords = row['keywords']
-            
-            print(f"\nCluster {cluster_id}")
-            print("  Sample phrases (up to 5):")
-            for phrase in keywords[:5]:
-                print(f"  - {phrase}")
-            if len(keywords) > 5:
-                print(f"  - ... and {len(keywords) - 5} more phrases")
-        
-        # Calculate coherence score if valid clusters exist
-        coherence_value = np.nan
-        noise_cluster = -1 in final_df['cluster_id'].values
-        valid_clusters = [row['keywords'] for _, row in final_df.iterrows() 
-                         if row['cluster_id'] != -1 or not noise_cluster]
-        
-        if len(valid_clusters) > 1:
-            print("\nCalculating coherence score...")
-            try:
-                # Prepare data for coherence model
-                clustered_tokens = [[word for phrase in cluster for word in phrase.split()] 
-                                    for cluster in valid_clusters]
-                
-                dictionary = Dictionary(clustered_tokens)
-                coherence_model_cv = CoherenceModel(
-                    topics=clustered_tokens, 
-                    texts=clustered_tokens, 
-                    dictionary=dictionary, 
-                    coherence="c_v"
-                )
-                coherence_value = coherence_model_cv.get_coherence()
-                print(f"C_V Coherence Score: {coherence_value:.4f}")
-            except Exception as e:
-                print(f"Error calculating coherence score: {e}")
-        
-        # Calculate average similarity within clusters
-        print("\nCalculating average similarity within clusters...")
-        
-        def average_cluster_similarity(cluster_embeddings):
-            """Calculate average cosine similarity within a cluster"""
-            if len(cluster_embeddings) < 2:
-                return np.nan  
-            similarities = cosine_similarity(cluster_embeddings)
-            np.fill_diagonal(similarities, 0)  # Exclude self-similarity
-            return np.mean(similarities)
-        
-        # Use original embeddings for similarity calculations
-        cluster_similarities = {}
-        for cluster_id in set(labels):
-            if cluster_id == -1:
-                continue  # Skip noise cluster
-            cluster_indices = np.where(labels == cluster_id)[0]
-            cluster_embeddings = embeddings[cluster_indices]
-            avg_sim = average_cluster_similarity(cluster_embeddings)
-            cluster_similarities[cluster_id] = avg_sim
-            print(f"Cluster {cluster_id}: Avg. Similarity = {avg_sim:.4f}")
-        
-        valid_similarities = [sim for sim in cluster_similarities.values() if not np.isnan(sim)]
-        overall_avg_similarity = np.mean(valid_similarities) if valid_similarities else np.nan
-        print(f"Overall Avg. Similarity Across Clusters: {overall_avg_similarity:.4f}")
-        
-        # Save experiment results
-        experiment_result = {
-            'experiment_id': exp_id,
-            'umap_params': umap_params,
-            'hdbscan_params': hdbscan_params,
-            'num_clusters': num_clusters,
-            'noise_percent': noise_percent,
-            'silhouette_score': silhouette_value,
-            'coherence_score': coherence_value,
-            'avg_similarity': overall_avg_similarity
-        }
-        all_experiment_results.append(experiment_result)
-        
-        # Save cluster results for this experiment
-        final_df['experiment_id'] = exp_id
-        final_df['umap_params'] = str(umap_params)
-        final_df['hdbscan_params'] = str(hdbscan_params)
-        clustered_df['experiment_id'] = exp_id
-        
-        output_folder = f"clustering_results/exp_{exp_id}"
-        os.makedirs(output_folder, exist_ok=True)
-        final_df.to_csv(f"{output_folder}/clusters.csv", index=False)
-        clustered_df.to_csv(f"{output_folder}/all_keyphrases_with_clusters.csv", index=False)
-        
-        # Save cluster visualization - create a 2D projection for visualization
-        try:
-            viz_reducer = umap.UMAP(n_components=2, **umap_params)
-            viz_embeddings = viz_reducer.fit_transform(embeddings)
-            
-            viz_df = pd.DataFrame({
-                'x': viz_embeddings[:, 0],
-                'y': viz_embeddings[:, 1],
-                'cluster': labels,
-                'keyphrase': keyphrases,
-                'document_id': [str(doc_id) for doc_id in document_ids]
-            })
-            viz_df.to_csv(f"{output_folder}/cluster_visualization.csv", index=False)
-        except Exception as e:
-            print(f"Error creating visualization data: {e}")
-        
-        # Check if this is the best result so far - prioritize silhouette score
-        is_best = False
-        if not np.isnan(silhouette_value) and silhouette_value > best_silhouette:
-            best_silhouette = silhouette_value
-            best_coherence = coherence_value
-            best_avg_similarity = overall_avg_similarity
-            best_umap_params = umap_params
-            best_hdbscan_params = hdbscan_params
-            best_labels = labels
-            best_reduced_embeddings = reduced_embeddings
-            is_best = True
+    # Display cluster contents (up to 5 items per cluster)
+    print("\nCluster contents:")
+    for _, row in final_df.iterrows():
+        cluster_id = row['cluster_id']
+        keywords = row['keywords']
         
-        if is_best:
-            print(f"\n*** New best result: {exp_id} ***")
+        print(f"\nCluster {cluster_id}")
+        print("  Sample phrases (up to 5):")
+        for phrase in keywords[:5]:
+            print(f"  - {phrase}")
+        if len(keywords) > 5:
+            print(f"  - ... and {len(keywords) - 5} more phrases")
+    
+    print(f"\nSilhouette score: {silhouette_value:.4f} (±{result['silhouette_stderr']:.4f}, n={result['silhouette_sample_size']})")
+    print(f"Coherence score ({COHERENCE_MODE}): {coherence_value:.4f}")
+    for cluster_id, avg_sim in result['cluster_similarities'].items():
+        print(f"Cluster {cluster_id}: Avg. Similarity = {avg_sim:.4f}")
+    print(f"Overall Avg. Similarity Across Clusters: {overall_avg_similarity:.4f}")
+    
+    # Save experiment results
+    experiment_result = {
+        'experiment_id': exp_id,
+        'umap_params': umap_params,
+        'hdbscan_params': hdbscan_params,
+        'num_clusters': num_clusters,
+        'noise_percent': noise_percent,
+        'silhouette_score': silhouette_value,
+        'silhouette_stderr': result['silhouette_stderr'],
+        'coherence_score': coherence_value,
+        'coherence_npmi': result['coherence_npmi'],
+        'coherence_c_v': result['coherence_c_v'],
+        'avg_similarity': overall_avg_similarity,
+        'seconds': result['seconds']
+    }
+    all_experiment_results.append(experiment_result)
+    
+    # Save labels and reduced coordinates as Parquet and register the run with its params and scores
+    save_experiment(
+        "clustering_results", exp_id, keyphrases, labels, loaded.document_ids,
+        reduced=np.load(result['reduction_file']),
+        cluster_similarities=result['cluster_similarities'],
+        record=dict(experiment_result, collection=COLLECTION_NAME, data_hash=result['data_hash'],
+                    n_components=result['n_components'], prereduce=result['prereduce'],
+                    documents=num_documents),
+    )
+    
+    # Check if this is the best result so far - prioritize silhouette score
+    is_best = False
+    if not np.isnan(silhouette_value) and silhouette_value > best_silhouette:
+        best_silhouette = silhouette_value
+        best_coherence = coherence_value
+        best_avg_similarity = overall_avg_similarity
+        best_umap_params = umap_params
+        best_hdbscan_params = hdbscan_params
+        best_labels = labels
+        best_exp_id = exp_id
+        is_best = True
+    
+    if is_best:
+        print(f"\n*** New best result: {exp_id} ***")
 
 # Save summary of all experiments
 pd.DataFrame(all_experiment_results).to_csv("clustering_results/all_experiments_summary.csv", index=False)
@@ -412,6 +287,21 @@ if best_umap_params is not None:
     final_df.to_csv("clustering_results/best_clusters.csv", index=False)
     clustered_df.to_csv("clustering_results/best_all_keyphrases_with_clusters.csv", index=False)
     
+    # 2-D projection for visualization, computed only for the winning configuration
+    try:
+        viz_embeddings = reduce_cached(embeddings, 2, best_umap_params, metric='euclidean')
+        viz_df = pd.DataFrame({
+            'x': viz_embeddings[:, 0],
+            'y': viz_embeddings[:, 1],
+            'cluster': best_labels,
+            'keyphrase': keyphrases,
+            'document_id': [str(doc_id) for doc_id in document_ids]
+        })
+        viz_df.to_csv(f"clustering_results/exp_{best_exp_id}/cluster_visualization.csv", index=False)
+        viz_df.to_csv("clustering_results/best_cluster_visualization.csv", index=False)
+    except Exception as e:
+        print(f"Error creating visualization data: {e}")
+    
     # Save keyphrase to document mapping
     mapping_data = []
     for phrase, doc_ids in keyphrase_to_documents.items():
@@ -440,7 +330,7 @@ if best_umap_params is not None:
     
     # Save final statistics
     stats = {
-        'total_documents_processed': len(documents),
+        'total_documents_processed': num_documents,
         'total_keyphrases_clustered': len(keyphrases),
         'best_num_clusters': len(set(best_labels)) - (1 if -1 in best_labels else 0),
         'best_silhouette_score': best_silhouette,
@@ -471,7 +361,7 @@ print("\n" + "="*60)
 print("CLUSTERING ANALYSIS COMPLETE")
 print("="*60)
 print(f"Total execution time: {execution_time:.2f} seconds")
-print(f"Documents processed: {len(documents)}")
+print(f"Documents processed: {num_documents}")
 print(f"Keyphrases clustered: {len(keyphrases)}")
 if best_umap_params is not None:
     print(f"Best configuration found with {len(set(best_labels)) - (1 if -1 in best_labels else 0)} clusters")
@@ -482,5 +372,8 @@ print("- best_clusters.csv: Final cluster results using best parameters")
 print("- best_all_keyphrases_with_clusters.csv: All keyphrases with their cluster assignments")
 print("- keyphrase_document_mapping.csv: Mapping between keyphrases and documents")
 print("- clustering_statistics.json: Overall clustering statistics")
-print("- exp_*/: Individual experiment results for each parameter combination")
+print("- best_cluster_visualization.csv: 2-D projection of the best configuration")
+print("- exp_*/: assignments.parquet (labels, UMAP coordinates) and clusters.parquet per parameter combination")
+print(f"- {REGISTRY_FILE}: Parameters, data hash, timings and scores of every run "
+      "(python -m pipeline_common.experiments list)")
 print("="*60)
\ No newline at end of file
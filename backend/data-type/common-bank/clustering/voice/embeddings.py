@@ -1,19 +1,26 @@
 import warnings
-import spacy
-import torch
 import numpy as np
 import pandas as pd
 import os
 import json
+import sys
 import time
-from transformers import AutoTokenizer, AutoModel
-from pymongo import MongoClient
+from pathlib import Path
+from pymongo import MongoClient, UpdateMany
 from bson import ObjectId
 from dotenv import load_dotenv
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 warnings.filterwarnings("ignore")
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline_common.embedding_backend import get_embedding_backend
+from pipeline_common.embedding_cache import EmbeddingCache
+from pipeline_common.embedding_models import embedding_model_filter
+from pipeline_common.preprocess import Lemmatizer
+from pipeline_common.mongo_bulk import bulk_write_chunked
+from pipeline_common.embedding_codec import decode_embedding, embedding_dimension, encode_embedding
+
 # Load environment variables
 load_dotenv()
 
@@ -34,18 +41,8 @@ print("Connecting to MongoDB...")
 print(f"Database: {DB_NAME}")
 print(f"Collection: {COLLECTION_NAME}")
 
-# Load spaCy model with only necessary components for speed
-nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-
-def preprocess_text(text):
-    """Lemmatize and filter text"""
-    if not isinstance(text, str):
-        text = str(text)
-    doc = nlp(text.lower())  
-    lemmatized_tokens = [
-        token.lemma_ for token in doc if not token.is_stop and not token.is_punct
-    ]
-    return " ".join(lemmatized_tokens)
+# Batched spaCy lemmatization backed by the shared lemma cache; spaCy loads only on cache misses
+preprocess_text = Lemmatizer()
 
 # Load data from MongoDB
 print("Loading data from MongoDB...")
@@ -66,6 +63,7 @@ document_to_keyphrase = {}  # Map each document to its keyphrase
 keyphrase_to_documents = {}  # Map each keyphrase to its documents
 
 print("Processing documents and extracting keyphrases...")
+preprocess_text.warm([doc.get("dominant_topic") for doc in documents if isinstance(doc.get("dominant_topic"), str)])
 for doc in documents:
     doc_id = doc["_id"]
     dominant_topic = doc.get("dominant_topic", "")
@@ -118,111 +116,102 @@ with open("embedding_results/extracted_keyphrases.txt", "w", encoding="utf-8") a
         f.write(f"{phrase}\n")
 print("Saved keyphrases to: embedding_results/extracted_keyphrases.txt")
 
-# Check for existing embeddings
+# Embedding backend (EMBEDDING_BACKEND=transformer|cpu); weights load only if something needs embedding
+embedding_backend = get_embedding_backend()
+print(f"Embedding model: {embedding_backend.model_id}")
+
+# Check for existing embeddings produced by the same model
 print("Checking for existing embeddings in MongoDB...")
-existing_embeddings_count = collection.count_documents({"embeddings": {"$exists": True}})
+existing_embeddings_query = {"embeddings": {"$exists": True}, **embedding_model_filter(embedding_backend.model_id)}
+existing_embeddings_count = collection.count_documents(existing_embeddings_query)
 print(f"Found {existing_embeddings_count} documents with existing embeddings")
 
 # Load existing embeddings if any
 keyphrase_to_embedding = {}
 if existing_embeddings_count > 0:
     docs_with_embeddings = list(collection.find(
-        {"embeddings": {"$exists": True}}, 
+        existing_embeddings_query,
         {"_id": 1, "dominant_topic": 1, "embeddings": 1}
     ))
     
+    preprocess_text.warm([doc.get("dominant_topic") for doc in docs_with_embeddings if isinstance(doc.get("dominant_topic"), str)])
     for doc in docs_with_embeddings:
         dominant_topic = doc.get("dominant_topic", "")
         if dominant_topic:
             lemmatized_phrase = preprocess_text(dominant_topic)
             if lemmatized_phrase in keyphrases:
-                embeddings_data = doc.get("embeddings", [])
-                if embeddings_data:
-                    keyphrase_to_embedding[lemmatized_phrase] = np.array(embeddings_data)
+                embedding_vector = decode_embedding(doc.get("embeddings"))
+                if embedding_vector is not None:
+                    keyphrase_to_embedding[lemmatized_phrase] = embedding_vector
 
 print(f"Loaded {len(keyphrase_to_embedding)} existing embeddings")
 
+# Cumulative write-back metrics, saved with the processing statistics
+write_back_stats = {"documents_updated": 0, "keyphrases": 0, "failed_operations": 0, "seconds": 0.0}
+
+def update_documents_with_embeddings(keyphrase_embedding_pairs):
+    """Update MongoDB documents with embeddings for specific keyphrases
+
+    One UpdateMany per keyphrase (the vector is sent once, not once per
+    document), sent as unordered bulk_write chunks.
+    """
+    if not keyphrase_embedding_pairs:
+        return 0
+
+    operations = []
+    expected_documents = 0
+    for keyphrase, embedding in keyphrase_embedding_pairs:
+        documents_to_update = keyphrase_to_documents.get(keyphrase, [])
+        if documents_to_update:
+            operations.append(UpdateMany(
+                {"_id": {"$in": documents_to_update}},
+                {"$set": {"embeddings": encode_embedding(embedding), "embedding_model": embedding_backend.model_id,
+                          # Stored so clustering scripts need not re-lemmatize
+                          "dominant_topic_lemma": keyphrase}}
+            ))
+            expected_documents += len(documents_to_update)
+
+    result = bulk_write_chunked(collection, operations, label="Embedding write-back")
+    write_back_stats["documents_updated"] += result["matched"]
+    write_back_stats["keyphrases"] += len(operations)
+    write_back_stats["failed_operations"] += result["failed_operations"]
+    write_back_stats["seconds"] += result["seconds"]
+
+    if result["matched"] < expected_documents:
+        print(f"Warning: {expected_documents - result['matched']} documents not found or not updated")
+
+    return result["matched"]
+
 # Determine which keyphrases need new embeddings
 keyphrases_needing_embeddings = [kp for kp in keyphrases if kp not in keyphrase_to_embedding]
+
+# Reuse vectors already computed for the same keyphrase by any channel or earlier run
+embedding_cache = EmbeddingCache(embedding_backend.cache_name, embedding_backend.revision)
+cached_embeddings = embedding_cache.get_many(keyphrases_needing_embeddings)
+if cached_embeddings:
+    print(f"Found {len(cached_embeddings)} keyphrases in the shared embedding cache")
+    keyphrase_to_embedding.update(cached_embeddings)
+    cached_updates = update_documents_with_embeddings(list(cached_embeddings.items()))
+    print(f"Updated {cached_updates} documents from cached embeddings")
+    keyphrases_needing_embeddings = [kp for kp in keyphrases_needing_embeddings if kp not in cached_embeddings]
+
 print(f"Need to compute embeddings for {len(keyphrases_needing_embeddings)} keyphrases")
 
 if keyphrases_needing_embeddings:
     print("Loading embedding model...")
-    
-    # Load model for embeddings
-    model_name = "Alibaba-NLP/gte-Qwen2-7B-instruct"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using device: {device}")
-    
     try:
-        model = AutoModel.from_pretrained(
-            model_name, torch_dtype=torch.float16, device_map="auto"
-        )
-        print("Model loaded with automatic device mapping")
+        embedding_backend.load()
     except Exception as e:
-        print(f"Auto device mapping failed: {e}")
-        try:
-            model = AutoModel.from_pretrained(model_name).to(device)
-            print("Model loaded with manual device assignment")
-        except Exception as e2:
-            print(f"Model loading failed completely: {e2}")
-            exit()
-    
-    def get_embedding(text):
-        """Get embedding for a single text"""
-        try:
-            inputs = tokenizer(f"query: {text}", return_tensors="pt", truncation=True, max_length=512).to(device)
-            with torch.no_grad():
-                output = model(**inputs).last_hidden_state.mean(dim=1)  
-            return output.cpu().numpy().flatten()
-        except Exception as e:
-            print(f"Error getting embedding for '{text}': {e}")
-            return None
+        print(f"Model loading failed completely: {e}")
+        exit()
     
-    def update_documents_with_embeddings(keyphrase_embedding_pairs):
-        """Update MongoDB documents with embeddings for specific keyphrases"""
-        if not keyphrase_embedding_pairs:
-            return 0
-            
-        total_updated = 0
-        failed_updates = 0
-        
-        for keyphrase, embedding in keyphrase_embedding_pairs:
-            try:
-                # Find all documents that have this keyphrase
-                documents_to_update = keyphrase_to_documents.get(keyphrase, [])
-                
-                for doc_id in documents_to_update:
-                    try:
-                        result = collection.update_one(
-                            {"_id": doc_id},
-                            {"$set": {"embeddings": embedding.tolist()}}
-                        )
-                        
-                        if result.modified_count > 0 or result.matched_count > 0:
-                            total_updated += 1
-                        else:
-                            print(f"Warning: Document {doc_id} not found for update")
-                            failed_updates += 1
-                            
-                    except Exception as e:
-                        print(f"Error updating document {doc_id}: {e}")
-                        failed_updates += 1
-                        
-            except Exception as e:
-                print(f"Error processing keyphrase '{keyphrase}': {e}")
-                failed_updates += 1
-        
-        if failed_updates > 0:
-            print(f"Batch update completed with {failed_updates} failed updates")
-            
-        return total_updated
+    # Length-bucketed batched inference; verified against the per-phrase path before the run
+    embedding_backend.check_parity(keyphrases_needing_embeddings)
     
     # Compute embeddings in batches and store after each batch
     print("Computing embeddings and storing in batches...")
-    batch_size = 16  # Reduced batch size for stability
+    # Phrases per write-back batch; the embedder splits each into token-budgeted forward passes
+    batch_size = 256
     new_embeddings = {}
     total_documents_updated = 0
     embedding_summary = []
@@ -235,8 +224,7 @@ if keyphrases_needing_embeddings:
         print(f"Keyphrases {i+1} to {min(i+batch_size, len(keyphrases_needing_embeddings))} of {len(keyphrases_needing_embeddings)}")
         
         # Compute embeddings for current batch
-        for phrase in batch:
-            embedding = get_embedding(phrase)
+        for phrase, embedding in zip(batch, embedding_backend.embed(batch)):
             if embedding is not None:
                 new_embeddings[phrase] = embedding
                 keyphrase_to_embedding[phrase] = embedding
@@ -256,6 +244,7 @@ if keyphrases_needing_embeddings:
         
         # Store embeddings in MongoDB immediately after batch completion
         if batch_embeddings:
+            embedding_cache.put_many(batch_embeddings)
             print("Storing batch embeddings in MongoDB...")
             batch_updates = update_documents_with_embeddings(batch_embeddings)
             total_documents_updated += batch_updates
@@ -359,7 +348,7 @@ sample_docs_with_embeddings = list(collection.find({"embeddings": {"$exists": Tr
 for i, doc in enumerate(sample_docs_with_embeddings):
     doc_id = doc["_id"]
     dominant_topic = doc.get("dominant_topic", "N/A")
-    embedding_length = len(doc.get("embeddings", []))
+    embedding_length = embedding_dimension(doc.get("embeddings"))
     print(f"  {i+1}. Doc {doc_id}: topic='{dominant_topic}', embedding_length={embedding_length}")
 
 # Check for documents that should have embeddings but don't
@@ -384,8 +373,15 @@ stats = {
     'documents_with_embeddings': final_embedding_count,
     'embedding_dimension': len(final_embeddings[0]) if final_embeddings else 0,
     'processing_time_seconds': time.time() - start_time,
-    'batch_size_used': 16,
-    'total_batches_processed': (len(keyphrases_needing_embeddings) + 15) // 16 if keyphrases_needing_embeddings else 0
+    'batch_size_used': 256,
+    'total_batches_processed': (len(keyphrases_needing_embeddings) + 255) // 256 if keyphrases_needing_embeddings else 0,
+    'embedding_model': embedding_backend.model_id,
+    'embedding_cache': embedding_cache.report(),
+    'lemmatizer': preprocess_text.report(),
+    'write_back': {
+        **write_back_stats,
+        'documents_per_sec': round(write_back_stats['documents_updated'] / write_back_stats['seconds'], 1) if write_back_stats['seconds'] > 0 else None
+    }
 }
 
 with open("embedding_results/processing_statistics.json", "w") as f:
@@ -14,11 +14,15 @@ from collections import Counter
 from pymongo import MongoClient
 from bson import ObjectId
 from dotenv import load_dotenv
+from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
 import threading
 from queue import Queue
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from pipeline_common.llm_cache import LLMCache, prompt_version
+
 # Load environment variables
 load_dotenv()
 
@@ -26,6 +30,26 @@ load_dotenv()
 MONGO_URI = os.getenv("MONGO_CONNECTION_STRING")
 DB_NAME = "sparzaai"
 TICKET_COLLECTION = "tickets"
+SUMMARY_PROMPT = """
+        # Text Summarization Task
+
+        Below is a long text that needs to be summarized. Please create a comprehensive summary of approximately 200-300 words 
+        that captures the main points, key details, and overall context. Maintain the essential information that would 
+        be needed for topic classification.
+
+        ## RULES:
+        1. Preserve key terminology, technical terms, and important references
+        2. Keep the most important discussions and topics
+        3. Maintain the overall tone and intent of the original
+        4. Aim for about 200-300 words in your summary
+        5. Include only the summary in your response, no additional commentary
+
+        ## TEXT TO SUMMARIZE:
+
+        {text}
+        """
+# Cached summaries are invalidated whenever the summarization prompt changes
+SUMMARY_PROMPT_VERSION = prompt_version("summary", SUMMARY_PROMPT)
 
 # Set up logging - modified for MongoDB processing
 logging.basicConfig(
@@ -57,6 +81,9 @@ class MongoDBTopicExtractionProcessor:
         self.ollama_url = f"{base_url}/api/generate"
         self.tags_url = f"{base_url}/api/tags"
         self.prompt_template = self._load_prompt_template()
+        self.prompt_version = prompt_version("ticket-topics", self.prompt_template)
+        # Successful responses are reused across reruns; LLM_CACHE_BYPASS=1 asks the model again
+        self.llm_cache = LLMCache()
         self.max_workers = max_workers
         
         # MongoDB setup
@@ -388,6 +415,28 @@ class MongoDBTopicExtractionProcessor:
             logger.error(f"Remote Ollama API error: {e}")
             raise
 
+    def _cached_ollama_request(self, cleaned_text, prompt, version):
+        """
+        Execute an Ollama request through the persistent response cache, keyed by
+        (model, prompt version, input text). A fresh response is not stored here;
+        the caller passes it to _cache_response once it has parsed successfully
+        """
+        cache_key = self.llm_cache.key(self.model_name, version, cleaned_text)
+        cached = self.llm_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Using cached LLM response")
+            return {"response": cached}
+        response = self._execute_ollama_request(cleaned_text, prompt)
+        return {"response": response["response"], "cache_key": cache_key, "version": version}
+
+    def _cache_response(self, response):
+        """
+        Store a validated response from _cached_ollama_request; responses served
+        from the cache are not written again
+        """
+        if response.get("cache_key"):
+            self.llm_cache.put(response["cache_key"], response["response"], self.model_name, response["version"])
+
     def summarize_long_text(self, text):
         """
         Summarize long text using the LLM to reduce it to around 1000 words
@@ -398,31 +447,16 @@ class MongoDBTopicExtractionProcessor:
         logger.info(f"Text exceeds 1000 words. Summarizing before topic extraction...")
 
         # Create the summarization prompt
-        summarize_prompt = f"""
-        # Text Summarization Task
-
-        Below is a long text that needs to be summarized. Please create a comprehensive summary of approximately 200-300 words 
-        that captures the main points, key details, and overall context. Maintain the essential information that would 
-        be needed for topic classification.
-
-        ## RULES:
-        1. Preserve key terminology, technical terms, and important references
-        2. Keep the most important discussions and topics
-        3. Maintain the overall tone and intent of the original
-        4. Aim for about 200-300 words in your summary
-        5. Include only the summary in your response, no additional commentary
-
-        ## TEXT TO SUMMARIZE:
-
-        {text}
-        """
+        summarize_prompt = SUMMARY_PROMPT.format(text=text)
 
         try:
             # Use the retry-enabled function with the summarization prompt
-            response = self._execute_ollama_request(text, summarize_prompt)
+            response = self._cached_ollama_request(text, summarize_prompt, SUMMARY_PROMPT_VERSION)
 
             # Extract the summarized text
             summarized_text = response['response'].strip()
+            if summarized_text:
+                self._cache_response(response)
 
             # Log summarization results
             original_word_count = len(text.split())
@@ -478,7 +512,7 @@ class MongoDBTopicExtractionProcessor:
 
         try:
             # Use the retry-enabled function
-            response = self._execute_ollama_request(text_for_extraction, prompt)
+            response = self._cached_ollama_request(text_for_extraction, prompt, self.prompt_version)
 
             # Extract the response text
             response_text = response['response'].strip()
@@ -496,6 +530,8 @@ class MongoDBTopicExtractionProcessor:
             dominant_topic = self._extract_dominant_topic(response_text)
             subtopics = self._extract_subtopics(response_text)
             urgent = self._extract_urgency(response_text)
+            if dominant_topic and dominant_topic != "Unknown Topic":
+                self._cache_response(response)
 
             return {
                 "dominant_topic": dominant_topic,
@@ -912,6 +948,8 @@ class MongoDBTopicExtractionProcessor:
         Close MongoDB connection
         """
         try:
+            logger.info(f"LLM response cache: {self.llm_cache.report()}")
+            self.llm_cache.close()
             self.client.close()
             logger.info("MongoDB connection closed successfully")
         except Exception as e:
@@ -0,0 +1,11 @@
+"""Shared helpers for the data generation and clustering pipelines.
+
+The generator and clustering scripts under EU-bank/ and common-bank/ are run
+as standalone scripts, so they put ``backend/data-type`` on ``sys.path`` and
+import from this package directly.
+"""
+from dotenv import find_dotenv, load_dotenv
+
+# Settings in these modules are read from the environment at import time, which
+# happens before the calling script reaches its own load_dotenv() call.
+load_dotenv(find_dotenv(usecwd=True))
@@ -0,0 +1,146 @@
+"""Compare embedding backends on speed and clustering agreement.
+
+    python -m pipeline_common.benchmark_embeddings --candidate cpu --limit 2000
+    python -m pipeline_common.benchmark_embeddings --reference-cache-only
+
+Phrases come from an ``extracted_keyphrases.txt`` written by the embedding
+scripts (already lemmatized). Reference vectors are taken from the shared
+embedding cache where available, so the 7B model does not have to run on the
+benchmark box; ``--reference-cache-only`` restricts the comparison to those.
+
+Quality parity is measured by clustering both embedding sets with the same
+KMeans settings and comparing the assignments (ARI, NMI), plus the overlap of
+each phrase's nearest neighbours.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+from pipeline_common.embedding_backend import get_embedding_backend
+from pipeline_common.embedding_cache import EmbeddingCache
+
+NEIGHBOUR_K = 10
+# Neighbour overlap needs an n x n similarity matrix; sample above this size
+NEIGHBOUR_SAMPLE = 5000
+
+
+def load_phrases(path, limit):
+    with open(path, "r", encoding="utf-8") as f:
+        phrases = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    return phrases[:limit] if limit else phrases
+
+
+def run_backend(backend, phrases):
+    """Embed phrases and return (vectors by phrase, timing dict)"""
+    load_start = time.time()
+    backend.load()
+    load_seconds = time.time() - load_start
+
+    embed_start = time.time()
+    vectors = backend.embed(phrases)
+    embed_seconds = time.time() - embed_start
+    embedded = {phrase: vector for phrase, vector in zip(phrases, vectors) if vector is not None}
+    return embedded, {
+        "model_id": backend.model_id,
+        "phrases": len(phrases),
+        "embedded": len(embedded),
+        "load_seconds": round(load_seconds, 2),
+        "embed_seconds": round(embed_seconds, 2),
+        "phrases_per_sec": round(len(embedded) / embed_seconds, 2) if embed_seconds > 0 else None,
+    }
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.clip(norms, 1e-12, None)
+
+
+def neighbour_overlap(reference, candidate, k=NEIGHBOUR_K, seed=42):
+    """Mean fraction of each phrase's top-k cosine neighbours shared by both embeddings"""
+    n = reference.shape[0]
+    if n <= k:
+        return None
+    if n > NEIGHBOUR_SAMPLE:
+        idx = np.random.default_rng(seed).choice(n, NEIGHBOUR_SAMPLE, replace=False)
+        reference, candidate = reference[idx], candidate[idx]
+    overlaps = []
+    for sims in (reference @ reference.T, candidate @ candidate.T):
+        np.fill_diagonal(sims, -np.inf)
+        overlaps.append(np.argpartition(-sims, k, axis=1)[:, :k])
+    shared = [len(set(a) & set(b)) / k for a, b in zip(*overlaps)]
+    return round(float(np.mean(shared)), 4)
+
+
+def clustering_parity(reference, candidate, k, seed=42):
+    ref_labels = KMeans(n_clusters=k, random_state=seed, n_init=10).fit_predict(reference)
+    cand_labels = KMeans(n_clusters=k, random_state=seed, n_init=10).fit_predict(candidate)
+    return {
+        "k": k,
+        "adjusted_rand_index": round(float(adjusted_rand_score(ref_labels, cand_labels)), 4),
+        "normalized_mutual_info": round(float(normalized_mutual_info_score(ref_labels, cand_labels)), 4),
+        "neighbour_overlap_at_10": neighbour_overlap(reference, candidate),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark embedding backends against the reference model")
+    parser.add_argument("--phrases-file", default="embedding_results/extracted_keyphrases.txt")
+    parser.add_argument("--limit", type=int, default=2000)
+    parser.add_argument("--reference", default="transformer")
+    parser.add_argument("--candidate", default="cpu")
+    parser.add_argument("--reference-cache-only", action="store_true",
+                        help="Use only phrases whose reference vectors are already cached")
+    parser.add_argument("--k", type=int, default=20, help="KMeans clusters for the parity check")
+    parser.add_argument("--output", default="embedding_results/embedding_benchmark.json")
+    args = parser.parse_args()
+
+    phrases = load_phrases(args.phrases_file, args.limit)
+    print(f"Loaded {len(phrases)} phrases from {args.phrases_file}")
+
+    reference_backend = get_embedding_backend(args.reference)
+    reference_cache = EmbeddingCache(reference_backend.cache_name, reference_backend.revision)
+    reference = reference_cache.get_many(phrases)
+    print(f"Reference vectors from cache: {len(reference)}/{len(phrases)}")
+    report = {"phrases_file": args.phrases_file, "reference_cached": len(reference)}
+
+    if args.reference_cache_only:
+        phrases = [p for p in phrases if p in reference]
+    else:
+        missing = [p for p in phrases if p not in reference]
+        if missing:
+            print(f"Embedding {len(missing)} phrases with reference backend {reference_backend.model_id}...")
+            computed, report["reference"] = run_backend(reference_backend, missing)
+            reference.update(computed)
+            reference_cache.put_many(computed.items())
+
+    candidate_backend = get_embedding_backend(args.candidate)
+    print(f"Embedding {len(phrases)} phrases with candidate backend {candidate_backend.model_id}...")
+    candidate, report["candidate"] = run_backend(candidate_backend, phrases)
+    print(f"Candidate throughput: {report['candidate']['phrases_per_sec']} phrases/sec")
+
+    common = [p for p in phrases if p in reference and p in candidate]
+    k = min(args.k, max(len(common) - 1, 1))
+    if len(common) < 3:
+        print("Not enough phrases embedded by both backends for a parity check")
+    else:
+        report["parity"] = clustering_parity(
+            normalize(np.stack([reference[p] for p in common]).astype(np.float32)),
+            normalize(np.stack([candidate[p] for p in common]).astype(np.float32)),
+            k,
+        )
+        report["parity"]["phrases"] = len(common)
+        print(f"Clustering parity on {len(common)} phrases (k={k}): "
+              f"ARI={report['parity']['adjusted_rand_index']}, NMI={report['parity']['normalized_mutual_info']}, "
+              f"neighbour overlap@{NEIGHBOUR_K}={report['parity']['neighbour_overlap_at_10']}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved benchmark report to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Benchmark the clustering stages on synthetic keyphrases with known clusters.
+
+    python -m pipeline_common.benchmark_pipeline --sizes 10000 50000 --dim 256 --clusters 40
+    python -m pipeline_common.benchmark_pipeline --sizes 200000 --mongo mongodb://localhost:27017
+
+For each size the harness generates ``n`` keyphrase embeddings around
+``--clusters`` random unit centers (each cluster with its own vocabulary, so
+coherence is meaningful), stores them in a MongoDB stand-in and runs the
+stages the scripts run:
+
+    insert, load, preprocess, prereduce, umap, hdbscan, kmeans, metrics, coherence, write_back
+
+Each stage records wall time, peak RSS (this process plus its worker
+processes, sampled every RSS_SAMPLE_SECONDS) and its quality scores: ARI and
+NMI against the true clusters, noise, silhouette, similarity and coherence.
+The report goes to one JSON file.
+
+It runs offline. ``--mongo mongomock`` (the default) uses an in-memory
+stand-in; pass a URI for a local mongod, where a throwaway database is
+dropped afterwards. UMAP reductions go to a temporary cache, so every run
+measures a cold UMAP. A stage whose dependency is missing (spaCy for
+``preprocess``) is recorded as skipped; ``prereduce`` only runs with
+PREREDUCE_MODE set, so the UMAP stage is timed on the projection alone.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from pipeline_common.cluster_metrics import cluster_similarities, sampled_silhouette
+from pipeline_common.coherence import CoherenceScorer
+from pipeline_common.embedding_codec import encode_embedding
+from pipeline_common.embedding_loader import load_keyphrase_embeddings
+from pipeline_common.k_selection import select_k
+from pipeline_common.prereduction import prereduce, prereduce_config
+from pipeline_common.sweep import reduce_cached
+
+RSS_SAMPLE_SECONDS = 0.05
+BENCHMARK_MODEL_ID = "synthetic@benchmark:f32"
+VOCABULARY_PER_CLUSTER = 12
+WORDS_PER_KEYPHRASE = 3
+# Mirrors the scripts' first UMAP and HDBSCAN configurations
+UMAP_PARAMS = {"n_neighbors": 15, "min_dist": 0.1}
+HDBSCAN_PARAMS = {"min_cluster_size": 5, "min_samples": 3, "cluster_selection_method": "eom"}
+
+
+def _rss_bytes():
+    import psutil
+
+    process = psutil.Process()
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+class PeakRSS:
+    """Samples RSS in a background thread while a stage runs"""
+
+    def __init__(self):
+        self.peak = self.start = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+
+def run_stage(report, name, fn, *args):
+    """Run one stage, record its time, memory and returned scores; returns its output or None"""
+    entry = report.setdefault("stages", {})[name] = {}
+    start = time.time()
+    try:
+        with PeakRSS() as rss:
+            output, scores = fn(*args)
+        entry.update(scores or {})
+        entry["status"] = "ok"
+    except ImportError as e:
+        output, entry["status"], entry["reason"] = None, "skipped", str(e)
+        rss = None
+    except Exception as e:
+        output, entry["status"], entry["error"] = None, "failed", repr(e)
+        rss = None
+    entry["seconds"] = round(time.time() - start, 3)
+    if rss is not None:
+        entry["peak_rss_mb"] = round(rss.peak / 1e6, 1)
+        entry["rss_growth_mb"] = round((rss.peak - rss.start) / 1e6, 1)
+    print(f"  {name}: {entry['status']} in {entry['seconds']}s"
+          + (f", peak RSS {entry['peak_rss_mb']} MB" if "peak_rss_mb" in entry else "")
+          + (f" ({entry.get('reason') or entry.get('error')})" if entry["status"] != "ok" else ""))
+    return output
+
+
+def synthetic_keyphrases(n, dim, n_clusters, spread=0.35, seed=0):
+    """(embeddings, keyphrases, true labels) with ``n_clusters`` clusters of random sizes"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    labels = rng.choice(n_clusters, size=n, p=rng.dirichlet(np.full(n_clusters, 5.0)))
+    embeddings = centers[labels] + spread * rng.normal(size=(n, dim)) / np.sqrt(dim)
+    embeddings = embeddings.astype(np.float32)
+
+    vocabularies = [[f"c{c}w{w}" for w in range(VOCABULARY_PER_CLUSTER)] for c in range(n_clusters)]
+    words = rng.integers(0, VOCABULARY_PER_CLUSTER, size=(n, WORDS_PER_KEYPHRASE))
+    keyphrases = [" ".join(vocabularies[label][w] for w in row) + f" {i}" for i, (label, row) in enumerate(zip(labels, words))]
+    return embeddings, keyphrases, labels
+
+
+def _agreement(true_labels, labels):
+    from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+    return {"ari": round(float(adjusted_rand_score(true_labels, labels)), 4),
+            "nmi": round(float(normalized_mutual_info_score(true_labels, labels)), 4)}
+
+
+def _stage_insert(collection, embeddings, keyphrases):
+    docs = [{"dominant_topic": phrase, "dominant_topic_lemma": phrase, "embeddings": encode_embedding(vector),
+             "embedding_model": BENCHMARK_MODEL_ID} for phrase, vector in zip(keyphrases, embeddings)]
+    for offset in range(0, len(docs), 5000):
+        collection.insert_many(docs[offset:offset + 5000], ordered=False)
+    return None, {"documents": len(docs)}
+
+
+def _stage_load(collection):
+    loaded = load_keyphrase_embeddings(collection, {"embedding_model": BENCHMARK_MODEL_ID}, str.lower)
+    return loaded, loaded.summary()
+
+
+def _stage_preprocess(keyphrases, cache_dir):
+    import spacy  # noqa: F401 - skip the stage cleanly when spaCy is absent
+
+    from pipeline_common.preprocess import Lemmatizer
+
+    lemmatizer = Lemmatizer(cache_path=os.path.join(cache_dir, "lemmas.sqlite"))
+    lemmatizer.warm(keyphrases)
+    stats = lemmatizer.report()
+    lemmatizer.close()
+    return None, {"texts": len(keyphrases), "texts_per_sec": round(len(keyphrases) / max(stats["seconds"], 1e-9), 1)}
+
+
+def _stage_prereduce(embeddings, config, cache_dir):
+    # Fits into the UMAP cache directory, where reduce_cached picks the projection up
+    _, info = prereduce(embeddings, config, cache_dir=cache_dir)
+    return info, info
+
+
+def _stage_umap(embeddings, n_components, cache_dir):
+    reduced = reduce_cached(embeddings, n_components, UMAP_PARAMS, cache_dir=cache_dir)
+    return reduced, {"n_components": n_components}
+
+
+def _stage_hdbscan(reduced, true_labels):
+    import hdbscan
+
+    labels = hdbscan.HDBSCAN(metric="euclidean", **HDBSCAN_PARAMS).fit_predict(reduced)
+    found = len(set(labels)) - (1 if -1 in labels else 0)
+    return labels, {"clusters": found, "noise_percent": round(float(np.mean(labels == -1) * 100), 2),
+                    **_agreement(true_labels, labels)}
+
+
+def _stage_kmeans(reduced, true_labels, k_values):
+    chosen, results = select_k(reduced, k_values)
+    return chosen["labels"], {"k": chosen["k"], "k_values": k_values, **_agreement(true_labels, chosen["labels"])}
+
+
+def _stage_metrics(embeddings, reduced, labels):
+    silhouette = sampled_silhouette(reduced, labels, metric="cosine")
+    similarities = [s for s in cluster_similarities(embeddings, labels).values() if not np.isnan(s)]
+    return None, {"silhouette": round(silhouette["score"], 4), "silhouette_stderr": round(silhouette["stderr"], 4),
+                  "silhouette_sample_size": silhouette["sample_size"],
+                  "avg_similarity": round(float(np.mean(similarities)), 4) if similarities else None}
+
+
+def _stage_coherence(keyphrases, labels):
+    result = CoherenceScorer([" ".join(p.split()[:-1]) for p in keyphrases]).score(labels)
+    return None, {key: (None if np.isnan(value) else round(float(value), 4)) for key, value in result.items()}
+
+
+def _stage_write_back(collection, documents, labels):
+    # One update_many per cluster: works on mongomock, whose bulk_write lags behind pymongo's
+    ids_by_cluster = {}
+    for doc in documents:
+        ids_by_cluster.setdefault(int(labels[doc["row"]]), []).append(doc["_id"])
+    start = time.time()
+    updated = 0
+    for cluster_id, ids in ids_by_cluster.items():
+        updated += collection.update_many({"_id": {"$in": ids}},
+                                          {"$set": {"kmeans_cluster_id": cluster_id, "clustering_method": "kmeans"}}).matched_count
+    seconds = time.time() - start
+    return None, {"documents": updated, "clusters": len(ids_by_cluster),
+                  "docs_per_sec": round(updated / seconds, 1) if seconds else None}
+
+
+def benchmark_size(db, n, dim, n_clusters, n_components, k_values, work_dir, seed=0):
+    report = {"n": n, "dim": dim, "true_clusters": n_clusters}
+    print(f"\n== n={n}, d={dim}, clusters={n_clusters} ==")
+    embeddings, keyphrases, true_labels = synthetic_keyphrases(n, dim, n_clusters, seed=seed)
+    collection = db[f"benchmark_{n}_{dim}"]
+    collection.drop()
+
+    run_stage(report, "insert", _stage_insert, collection, embeddings, keyphrases)
+    loaded = run_stage(report, "load", _stage_load, collection)
+    if loaded is None:
+        return report
+    # Documents come back in insertion order, but map rows explicitly
+    row_truth = np.empty(len(loaded.keyphrases), dtype=int)
+    for doc in loaded.documents:
+        row_truth[doc["row"]] = true_labels[int(doc["original_keyphrase"].rsplit(" ", 1)[1])]
+    matrix = np.asarray(loaded.embeddings)
+
+    run_stage(report, "preprocess", _stage_preprocess, keyphrases, work_dir)
+    config = prereduce_config()
+    if config:
+        run_stage(report, "prereduce", _stage_prereduce, matrix, config, os.path.join(work_dir, "umap"))
+    reduced = run_stage(report, "umap", _stage_umap, matrix, n_components, os.path.join(work_dir, "umap"))
+    if reduced is None:
+        return report
+    hdbscan_labels = run_stage(report, "hdbscan", _stage_hdbscan, reduced, row_truth)
+    kmeans_labels = run_stage(report, "kmeans", _stage_kmeans, reduced, row_truth, k_values)
+    labels = kmeans_labels if kmeans_labels is not None else hdbscan_labels
+    if labels is None:
+        return report
+    run_stage(report, "metrics", _stage_metrics, matrix, reduced, labels)
+    run_stage(report, "coherence", _stage_coherence, loaded.keyphrases, labels)
+    run_stage(report, "write_back", _stage_write_back, collection, loaded.documents, labels)
+    collection.drop()
+    report["total_seconds"] = round(sum(stage["seconds"] for stage in report["stages"].values()), 2)
+    return report
+
+
+def _connect(mongo):
+    if mongo == "mongomock":
+        import mongomock
+
+        return mongomock.MongoClient()
+    from pymongo import MongoClient
+
+    return MongoClient(mongo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the clustering stages on synthetic keyphrases")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5000, 20000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=30)
+    parser.add_argument("--n-components", type=int, default=20, help="UMAP dimensions, as in the sweep")
+    parser.add_argument("--k-values", type=int, nargs="+", help="KMeans candidates (default: around --clusters)")
+    parser.add_argument("--mongo", default="mongomock", help="'mongomock' or a local MongoDB URI")
+    parser.add_argument("--db", default="clustering_benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="pipeline_benchmark.json")
+    args = parser.parse_args()
+
+    k_values = args.k_values or sorted({max(2, args.clusters + step) for step in (-10, -5, 0, 5, 10)})
+    client = _connect(args.mongo)
+    work_dir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    report = {"mongo": "mongomock" if args.mongo == "mongomock" else "mongodb", "cpu_count": os.cpu_count(),
+              "umap_params": UMAP_PARAMS, "hdbscan_params": HDBSCAN_PARAMS, "runs": []}
+    try:
+        for n in args.sizes:
+            report["runs"].append(benchmark_size(client[args.db], n, args.dim, args.clusters, args.n_components,
+                                                 k_values, work_dir, args.seed))
+    finally:
+        if args.mongo != "mongomock":
+            client.drop_database(args.db)
+        client.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("\nStage seconds by size:")
+    stages = list(dict.fromkeys(stage for run in report["runs"] for stage in run.get("stages", {})))
+    print("n".rjust(10) + "".join(stage.rjust(12) for stage in stages))
+    for run in report["runs"]:
+        print(str(run["n"]).rjust(10) + "".join(
+            str(run["stages"].get(stage, {}).get("seconds", "-")).rjust(12) for stage in stages))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=float)
+    print(f"Saved benchmark report to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
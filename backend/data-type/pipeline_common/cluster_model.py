@@ -0,0 +1,329 @@
+"""Persisted cluster model and incremental assignment of new documents.
+
+    python -m pipeline_common.cluster_model build --collection emailmessages --data email
+    python -m pipeline_common.cluster_model assign --collection emailmessages
+
+``build`` runs after k-means, labelling and mapping. It reads every clustered
+document's embedding, ``kmeans_cluster_id`` and ``subcluster_id`` and stores,
+under CLUSTER_MODEL_DIR/<collection>/:
+
+- the sum and count of normalized embeddings per cluster and per
+  (cluster, subcluster), so centroids can be updated as documents arrive;
+- each cluster's confidence threshold, a low percentile of its members'
+  similarity to their own centroid;
+- the dominant and subcluster labels from the cluster collection.
+
+Centroids live in the original embedding space, so assignment needs neither
+the UMAP reducer nor KMeans: cosine similarity to the centroids is enough.
+
+``assign`` takes documents that have embeddings from the configured model but
+no ``kmeans_cluster_id``. Each goes to its nearest cluster and, within it, its
+nearest subcluster, with the same fields mapping.py writes. Documents below
+their cluster's threshold go to the pending pool (``clustering_pending``). Once
+the pool reaches RECLUSTER_PENDING_MIN documents or RECLUSTER_PENDING_FRACTION
+of the clustered documents, a full reclustering is requested: a document
+goes into ``recluster_requests`` unless one is still open, and
+``--recluster-command`` runs if given. The K-means write-back
+(``out_of_core.write_assignments``) closes open requests.
+"""
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import time
+from pathlib import Path
+
+import numpy as np
+from pymongo import MongoClient, UpdateOne
+
+from pipeline_common.embedding_codec import decode_embedding, embedding_dimension
+from pipeline_common.embedding_models import configured_model_id, embedding_model_filter
+from pipeline_common.mongo_bulk import bulk_write_chunked
+
+CLUSTER_MODEL_DIR = Path(os.getenv("CLUSTER_MODEL_DIR", Path(__file__).resolve().parent.parent / "cluster_models"))
+# Members below this percentile of similarity to their centroid count as outliers
+ASSIGN_THRESHOLD_PERCENTILE = float(os.getenv("ASSIGN_THRESHOLD_PERCENTILE", "5"))
+ASSIGN_MIN_SIMILARITY = float(os.getenv("ASSIGN_MIN_SIMILARITY", "0.5"))
+RECLUSTER_PENDING_MIN = int(os.getenv("RECLUSTER_PENDING_MIN", "500"))
+RECLUSTER_PENDING_FRACTION = float(os.getenv("RECLUSTER_PENDING_FRACTION", "0.05"))
+ASSIGN_BATCH_SIZE = 1000
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class ClusterModel:
+    def __init__(self, collection_name, embedding_model, cluster_ids, sums, counts, thresholds,
+                 sub_keys, sub_sums, sub_counts, labels, created_at=None):
+        self.collection_name = collection_name
+        self.embedding_model = embedding_model
+        self.cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        self.sums = np.asarray(sums, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        # (cluster_id, subcluster_id) pairs; subcluster ids are strings as in mapping.py
+        self.sub_keys = [(int(c), str(s)) for c, s in sub_keys]
+        self.sub_sums = np.asarray(sub_sums, dtype=np.float64).reshape(len(self.sub_keys), self.sums.shape[1])
+        self.sub_counts = np.asarray(sub_counts, dtype=np.int64)
+        # {"clusters": {cluster_id: dominant_label}, "subclusters": {"cid/sid": label}}
+        self.labels = labels
+        self.created_at = created_at or time.time()
+        self._index = {int(c): i for i, c in enumerate(self.cluster_ids)}
+
+    @property
+    def centroids(self):
+        return _normalize(self.sums)
+
+    def subclusters_of(self, cluster_id):
+        return [i for i, (c, _) in enumerate(self.sub_keys) if c == cluster_id]
+
+    def path(self, root=CLUSTER_MODEL_DIR):
+        return Path(root) / self.collection_name
+
+    def save(self, root=CLUSTER_MODEL_DIR):
+        path = self.path(root)
+        path.mkdir(parents=True, exist_ok=True)
+        np.savez(path / "model.tmp.npz", cluster_ids=self.cluster_ids, sums=self.sums, counts=self.counts,
+                 thresholds=self.thresholds, sub_sums=self.sub_sums, sub_counts=self.sub_counts)
+        os.replace(path / "model.tmp.npz", path / "model.npz")
+        meta = {
+            "collection": self.collection_name,
+            "embedding_model": self.embedding_model,
+            "created_at": self.created_at,
+            "updated_at": time.time(),
+            "sub_keys": self.sub_keys,
+            "labels": self.labels,
+        }
+        with open(path / "meta.tmp.json", "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(path / "meta.tmp.json", path / "meta.json")
+
+    @classmethod
+    def load(cls, collection_name, root=CLUSTER_MODEL_DIR):
+        path = Path(root) / collection_name
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        arrays = np.load(path / "model.npz")
+        return cls(collection_name, meta["embedding_model"], arrays["cluster_ids"], arrays["sums"],
+                   arrays["counts"], arrays["thresholds"], meta["sub_keys"], arrays["sub_sums"],
+                   arrays["sub_counts"], meta["labels"], meta["created_at"])
+
+    def assign(self, embeddings):
+        """Nearest cluster and subcluster for each row.
+
+        Returns (cluster_ids, similarities, confident, sub_indices); a sub
+        index is -1 where the cluster has no subclusters.
+        """
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float64))
+        similarities = vectors @ self.centroids.T
+        best = np.argmax(similarities, axis=1)
+        best_similarity = similarities[np.arange(len(best)), best]
+        confident = best_similarity >= np.maximum(self.thresholds[best], ASSIGN_MIN_SIMILARITY)
+
+        sub_indices = np.full(len(best), -1)
+        if self.sub_keys:
+            sub_similarities = vectors @ _normalize(self.sub_sums).T
+            for cluster_index in np.unique(best):
+                members = self.subclusters_of(int(self.cluster_ids[cluster_index]))
+                if not members:
+                    continue
+                rows = np.flatnonzero(best == cluster_index)
+                sub_indices[rows] = np.array(members)[np.argmax(sub_similarities[np.ix_(rows, members)], axis=1)]
+        return self.cluster_ids[best], best_similarity, confident, sub_indices
+
+    def absorb(self, embeddings, cluster_ids, sub_indices):
+        """Fold newly assigned documents into the running centroid sums"""
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float64))
+        for vector, cluster_id, sub_index in zip(vectors, cluster_ids, sub_indices):
+            i = self._index[int(cluster_id)]
+            self.sums[i] += vector
+            self.counts[i] += 1
+            if sub_index >= 0:
+                self.sub_sums[sub_index] += vector
+                self.sub_counts[sub_index] += 1
+
+
+def _clustered_rows(collection, query, batch_size=ASSIGN_BATCH_SIZE):
+    projection = {"_id": 1, "embeddings": 1, "kmeans_cluster_id": 1, "subcluster_id": 1}
+    for doc in collection.find(query, projection).batch_size(batch_size):
+        if embedding_dimension(doc.get("embeddings")):
+            yield doc
+
+
+def build_cluster_model(db, collection_name, data=None, model_id=None):
+    """Fit centroids, thresholds and labels from the currently clustered documents"""
+    model_id = model_id or configured_model_id()
+    collection = db[collection_name]
+    query = {"kmeans_cluster_id": {"$exists": True, "$ne": None}, "embeddings": {"$exists": True},
+             **embedding_model_filter(model_id)}
+
+    members, sub_members = {}, {}
+    for doc in _clustered_rows(collection, query):
+        vector = _normalize(decode_embedding(doc["embeddings"]).astype(np.float64))
+        cluster_id = int(doc["kmeans_cluster_id"])
+        members.setdefault(cluster_id, []).append(vector)
+        if doc.get("subcluster_id") is not None:
+            sub_members.setdefault((cluster_id, str(doc["subcluster_id"])), []).append(vector)
+    if not members:
+        raise ValueError(f"No clustered documents with embeddings in {collection_name}")
+
+    cluster_ids = sorted(members)
+    sums, counts, thresholds = [], [], []
+    for cluster_id in cluster_ids:
+        matrix = np.stack(members[cluster_id])
+        vector_sum = matrix.sum(axis=0)
+        own_similarity = matrix @ _normalize(vector_sum)
+        sums.append(vector_sum)
+        counts.append(len(matrix))
+        thresholds.append(float(np.percentile(own_similarity, ASSIGN_THRESHOLD_PERCENTILE)))
+    sub_keys = sorted(sub_members)
+    sub_sums = [np.sum(sub_members[key], axis=0) for key in sub_keys]
+    sub_counts = [len(sub_members[key]) for key in sub_keys]
+
+    cluster_query = {"cluster_id": {"$in": cluster_ids}}
+    if data:
+        cluster_query["data"] = data
+    labels = {"clusters": {}, "subclusters": {}}
+    for cluster in db["cluster"].find(cluster_query, {"cluster_id": 1, "dominant_label": 1, "subclusters": 1}):
+        if cluster.get("dominant_label"):
+            labels["clusters"][str(cluster["cluster_id"])] = cluster["dominant_label"]
+        subclusters = cluster.get("subclusters") or {}
+        items = subclusters.items() if isinstance(subclusters, dict) else enumerate(subclusters)
+        for subcluster_id, subcluster in items:
+            if isinstance(subcluster, dict) and subcluster.get("label"):
+                labels["subclusters"][f"{cluster['cluster_id']}/{subcluster_id}"] = subcluster["label"]
+
+    model = ClusterModel(collection_name, model_id, cluster_ids, sums, counts, thresholds,
+                         sub_keys, sub_sums if sub_keys else np.empty((0, len(sums[0]))), sub_counts, labels)
+    model.save()
+    print(f"Built cluster model for {collection_name}: {len(cluster_ids)} clusters, {len(sub_keys)} subclusters, "
+          f"{int(np.sum(counts))} documents; median threshold {np.median(thresholds):.3f}")
+    return model
+
+
+def assign_new_documents(db, model, batch_size=ASSIGN_BATCH_SIZE, recluster_command=None):
+    """Assign unclustered documents, park outliers, and request reclustering if the pool is large"""
+    collection = db[model.collection_name]
+    query = {"kmeans_cluster_id": {"$exists": False}, "clustering_pending": {"$ne": True},
+             "embeddings": {"$exists": True}, **embedding_model_filter(model.embedding_model)}
+    projection = {"_id": 1, "embeddings": 1, "dominant_topic_lemma": 1}
+    stats = {"assigned": 0, "pending": 0, "seconds": 0.0}
+    start = time.time()
+
+    batch = []
+    cursor = collection.find(query, projection).batch_size(batch_size)
+    while True:
+        doc = next(cursor, None)
+        if doc is not None and embedding_dimension(doc.get("embeddings")):
+            batch.append(doc)
+        if batch and (doc is None or len(batch) >= batch_size):
+            _assign_batch(collection, model, batch, stats)
+            batch = []
+        if doc is None:
+            break
+
+    model.save()
+    stats["seconds"] = round(time.time() - start, 2)
+    pool = collection.count_documents({"clustering_pending": True})
+    clustered = int(model.counts.sum())
+    stats["pending_pool"] = pool
+    print(f"Assigned {stats['assigned']} documents, {stats['pending']} sent to pending "
+          f"(pool {pool}) in {stats['seconds']}s")
+
+    if pool >= max(RECLUSTER_PENDING_MIN, RECLUSTER_PENDING_FRACTION * clustered):
+        stats["recluster_requested"] = True
+        if db["recluster_requests"].find_one({"collection": model.collection_name, "status": "requested"}):
+            print(f"Pending pool of {pool} exceeds the reclustering threshold; a reclustering request is already open")
+        else:
+            db["recluster_requests"].insert_one({
+                "collection": model.collection_name, "pending": pool, "clustered": clustered,
+                "requested_at": time.time(), "status": "requested",
+            })
+            print(f"Pending pool of {pool} exceeds the reclustering threshold; reclustering requested")
+            if recluster_command:
+                subprocess.run(shlex.split(recluster_command), check=False)
+    return stats
+
+
+def _assign_batch(collection, model, docs, stats):
+    embeddings = np.stack([decode_embedding(doc["embeddings"]) for doc in docs])
+    cluster_ids, similarities, confident, sub_indices = model.assign(embeddings)
+    now = time.time()
+    operations = []
+    for doc, cluster_id, similarity, ok, sub_index in zip(docs, cluster_ids, similarities, confident, sub_indices):
+        if not ok:
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {
+                "clustering_pending": True,
+                "clustering_candidate": {"cluster_id": int(cluster_id), "similarity": round(float(similarity), 4)},
+                "clustering_updated_at": now,
+            }}))
+            continue
+        update = {
+            "kmeans_cluster_id": int(cluster_id),
+            "clustering_method": "incremental",
+            "clustering_confidence": round(float(similarity), 4),
+            "clustering_updated_at": now,
+        }
+        if isinstance(doc.get("dominant_topic_lemma"), str):
+            update["kmeans_cluster_keyphrase"] = doc["dominant_topic_lemma"]
+        dominant_label = model.labels["clusters"].get(str(int(cluster_id)))
+        if dominant_label:
+            update["dominant_cluster_label"] = dominant_label
+        if sub_index >= 0:
+            _, subcluster_id = model.sub_keys[sub_index]
+            update["subcluster_id"] = subcluster_id
+            subcluster_label = model.labels["subclusters"].get(f"{int(cluster_id)}/{subcluster_id}")
+            if subcluster_label:
+                update["subcluster_label"] = subcluster_label
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+
+    result = bulk_write_chunked(collection, operations, label="Incremental assignment", verbose=False)
+    if result["failed_operations"]:
+        print(f"Warning: {result['failed_operations']} assignment updates failed")
+    model.absorb(embeddings[confident], cluster_ids[confident], sub_indices[confident])
+    stats["assigned"] += int(confident.sum())
+    stats["pending"] += int((~confident).sum())
+
+
+def release_pending(collection):
+    """Return pending documents to the unassigned state, e.g. after a full reclustering"""
+    return collection.update_many({"clustering_pending": True},
+                                  {"$unset": {"clustering_pending": "", "clustering_candidate": ""}}).modified_count
+
+
+def close_recluster_requests(db, collection_name, status="done"):
+    """Close the collection's open reclustering requests, e.g. once a full reclustering has written back"""
+    return db["recluster_requests"].update_many(
+        {"collection": collection_name, "status": "requested"},
+        {"$set": {"status": status, "completed_at": time.time()}},
+    ).modified_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a cluster model or assign new documents to it")
+    parser.add_argument("command", choices=["build", "assign", "release-pending"])
+    parser.add_argument("--collection", default="emailmessages")
+    parser.add_argument("--data", help="cluster collection 'data' tag for this channel (e.g. email)")
+    parser.add_argument("--db", default="sparzaai")
+    parser.add_argument("--batch-size", type=int, default=ASSIGN_BATCH_SIZE)
+    parser.add_argument("--recluster-command", help="command to run when reclustering is requested")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_CONNECTION_STRING"))
+    try:
+        db = client[args.db]
+        if args.command == "build":
+            build_cluster_model(db, args.collection, data=args.data)
+        elif args.command == "assign":
+            assign_new_documents(db, ClusterModel.load(args.collection), args.batch_size, args.recluster_command)
+        else:
+            print(f"Released {release_pending(db[args.collection])} pending documents")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
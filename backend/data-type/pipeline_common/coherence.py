@@ -0,0 +1,160 @@
+"""Topic coherence for clustering experiments, with statistics built once per dataset.
+
+The reference corpus is the dataset's keyphrases, one text per document
+(``phrase_repeats`` says how many documents share a deduplicated keyphrase).
+``CoherenceScorer`` builds the dictionary, the weighted document-term matrix
+and the word co-occurrence matrix once; in the fast mode every experiment then
+only picks each cluster's top words and looks up the pairs it needs.
+
+Modes (COHERENCE_MODE):
+
+- ``fast``: mean NPMI over each cluster's top-word pairs, computed from the
+  sparse co-occurrence matrix (range -1..1);
+- ``exact``: gensim's c_v over the same topics and reference corpus. Only
+  the gensim Dictionary and the expanded texts are reused: gensim recounts
+  its sliding-window co-occurrences on every call, so this mode still costs
+  a pass over the corpus per experiment;
+- ``both``: compute both; c_v is reported as the coherence score and
+  ``compare_modes`` shows where the two rank experiments differently.
+"""
+import os
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+COHERENCE_MODE = os.getenv("COHERENCE_MODE", "fast")
+COHERENCE_TOPN = int(os.getenv("COHERENCE_TOPN", "10"))
+
+
+class CoherenceScorer:
+    def __init__(self, keyphrases, phrase_repeats=None, topn=COHERENCE_TOPN):
+        self.topn = topn
+        self.texts = [phrase.split() for phrase in keyphrases]
+        self.weights = np.asarray(phrase_repeats if phrase_repeats is not None else [1] * len(self.texts), dtype=np.float64)
+        self.vocabulary = {}
+        rows, cols = [], []
+        for row, tokens in enumerate(self.texts):
+            for token in set(tokens):
+                rows.append(row)
+                cols.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+        self.id_to_token = list(self.vocabulary)
+
+        # Binary document-term matrix; documents sharing a keyphrase enter via the weights
+        doc_term = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(self.texts), len(self.vocabulary)))
+        weighted = sparse.diags(self.weights) @ doc_term
+        self.num_documents = self.weights.sum()
+        self.doc_freq = np.asarray(weighted.sum(axis=0)).ravel()
+        self.cooccurrence = (doc_term.T @ weighted).tocsr()
+        self._gensim = None
+
+    def topics(self, labels):
+        """Top words of each non-noise cluster, ordered by cluster id"""
+        counts = {}
+        for tokens, weight, label in zip(self.texts, self.weights, labels):
+            if label == -1:
+                continue
+            counter = counts.setdefault(label, Counter())
+            for token in tokens:
+                counter[token] += weight
+        return [[token for token, _ in counts[label].most_common(self.topn)] for label in sorted(counts)]
+
+    def npmi(self, topics):
+        """Mean over topics of the mean pairwise NPMI of their top words"""
+        scores = []
+        for topic in topics:
+            ids = np.array([self.vocabulary[token] for token in topic])
+            if len(ids) < 2:
+                continue
+            joint = self.cooccurrence[ids][:, ids].toarray() / self.num_documents
+            marginal = self.doc_freq[ids] / self.num_documents
+            upper = np.triu_indices(len(ids), k=1)
+            p_ij = joint[upper]
+            expected = np.outer(marginal, marginal)[upper]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                npmi = np.log(p_ij / expected) / -np.log(p_ij)
+            # Never co-occurring is -1 by definition; always co-occurring (p_ij == 1) is 1
+            npmi = np.where(p_ij == 0, -1.0, np.where(p_ij >= 1, 1.0, npmi))
+            scores.append(float(np.mean(npmi)))
+        return float(np.mean(scores)) if scores else np.nan
+
+    def c_v(self, topics):
+        """gensim c_v coherence of the topics against the shared reference corpus.
+
+        The Dictionary is built once, but CoherenceModel re-accumulates its
+        window statistics over ``texts`` on each call.
+        """
+        from gensim.corpora.dictionary import Dictionary
+        from gensim.models.coherencemodel import CoherenceModel
+
+        if self._gensim is None:
+            # Repeat texts so documents sharing a keyphrase count as in the fast mode
+            texts = [tokens for tokens, weight in zip(self.texts, self.weights) for _ in range(int(weight))]
+            self._gensim = (texts, Dictionary(texts))
+        texts, dictionary = self._gensim
+        topics = [topic for topic in topics if len(topic) > 1]
+        if len(topics) <= 1:
+            return np.nan
+        coherence_model_cv = CoherenceModel(
+            topics=topics,
+            texts=texts,
+            dictionary=dictionary,
+            coherence="c_v",
+            topn=self.topn,
+            processes=1
+        )
+        return coherence_model_cv.get_coherence()
+
+    def score(self, labels, mode=COHERENCE_MODE):
+        """{"coherence", "npmi", "c_v"} for a labelling; NaN where not computed"""
+        topics = self.topics(labels)
+        result = {"coherence": np.nan, "npmi": np.nan, "c_v": np.nan}
+        if len(topics) <= 1:
+            return result
+        if mode in ("fast", "both"):
+            result["npmi"] = self.npmi(topics)
+        if mode in ("exact", "both"):
+            result["c_v"] = self.c_v(topics)
+        result["coherence"] = result["npmi"] if mode == "fast" else result["c_v"]
+        return result
+
+
+def _ranks(values):
+    order = np.argsort(-np.asarray(values), kind="stable")
+    ranks = np.empty(len(values), dtype=int)
+    ranks[order] = np.arange(1, len(values) + 1)
+    return ranks
+
+
+def compare_modes(experiment_ids, npmi_scores, c_v_scores):
+    """Rank agreement between fast and exact coherence across experiments.
+
+    Returns the Spearman correlation of the two rankings, whether both pick
+    the same best experiment, and the experiments whose rank differs.
+    """
+    rows = [(e, f, x) for e, f, x in zip(experiment_ids, npmi_scores, c_v_scores)
+            if not (np.isnan(f) or np.isnan(x))]
+    if len(rows) < 2:
+        return {"compared": len(rows)}
+    ids, fast, exact = zip(*rows)
+    fast_ranks, exact_ranks = _ranks(fast), _ranks(exact)
+    spearman = float(np.corrcoef(fast_ranks, exact_ranks)[0, 1])
+    return {
+        "compared": len(rows),
+        "spearman": round(spearman, 4),
+        "same_best": ids[int(np.argmin(fast_ranks))] == ids[int(np.argmin(exact_ranks))],
+        "disagreements": [
+            {"experiment_id": e, "npmi": f, "npmi_rank": int(fr), "c_v": x, "c_v_rank": int(xr)}
+            for e, f, x, fr, xr in zip(ids, fast, exact, fast_ranks, exact_ranks) if fr != xr
+        ],
+    }
+
+
+def print_mode_comparison(report):
+    if report.get("compared", 0) < 2:
+        return
+    print(f"\nCoherence fast vs exact: Spearman={report['spearman']:.3f} over {report['compared']} experiments, "
+          f"same best: {report['same_best']}")
+    for row in report["disagreements"]:
+        print(f"  {row['experiment_id']}: NPMI {row['npmi']:.4f} (rank {row['npmi_rank']}) vs "
+              f"c_v {row['c_v']:.4f} (rank {row['c_v_rank']})")
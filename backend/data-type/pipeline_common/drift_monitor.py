@@ -0,0 +1,301 @@
+"""Measure whether recent documents still fit the persisted clusters.
+
+    python -m pipeline_common.drift_monitor --collection emailmessages chat-chunks tickets
+    python -m pipeline_common.drift_monitor --collection tickets --window-hours 72 \\
+        --data ticket --recluster-command "python -m pipeline_common.run_pipeline --channels ticket --stages cluster label map"
+
+Reclustering ran on a fixed schedule whether or not the data had moved. This
+job compares the documents of the last DRIFT_WINDOW_HOURS (by ObjectId
+creation time) against the cluster model of ``cluster_model build``, without
+writing to them:
+
+- nearest-centroid similarity: quantiles, the Kolmogorov-Smirnov statistic
+  and the population stability index (PSI, over the baseline's deciles)
+  against a baseline sample of the documents clustered before the model was
+  built;
+- noise share: documents below their nearest cluster's confidence threshold,
+  the ones ``assign`` would park in the pending pool;
+- volume: each cluster's share of the recent documents against its share of
+  the model, with a PSI over all clusters and the clusters whose share moved
+  by DRIFT_VOLUME_RATIO or more.
+
+The baseline profile is computed once per model and kept next to it as
+``drift_baseline.json``. Baseline documents helped fit the centroids, so
+their similarities run slightly high; the thresholds below allow for that.
+Reclustering is flagged when any of them is crossed. The report goes to
+DRIFT_REPORT_DIR and the ``cluster_drift_reports`` collection; a flag also
+files a ``recluster_requests`` document, as the incremental assigner does,
+unless one is still open, and runs ``--recluster-command`` if given. Once
+the command succeeds the cluster model is rebuilt (``cluster_model build``,
+with the channel's ``--data`` tag) so later checks compare against the new
+clusters, and the request is closed; a failed command closes it as
+``failed``. When reclustering happens outside this job, the K-means
+write-back closes the request, but the model must still be rebuilt.
+"""
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+from bson import ObjectId
+from pymongo import MongoClient
+
+from pipeline_common.cluster_model import ASSIGN_BATCH_SIZE, ClusterModel, build_cluster_model, close_recluster_requests
+from pipeline_common.embedding_codec import decode_embedding, embedding_dimension
+from pipeline_common.embedding_models import embedding_model_filter
+
+DRIFT_WINDOW_HOURS = float(os.getenv("DRIFT_WINDOW_HOURS", "168"))
+DRIFT_BASELINE_SAMPLE = int(os.getenv("DRIFT_BASELINE_SAMPLE", "20000"))
+DRIFT_MIN_DOCUMENTS = int(os.getenv("DRIFT_MIN_DOCUMENTS", "200"))
+DRIFT_REPORT_DIR = Path(os.getenv("DRIFT_REPORT_DIR", Path(__file__).resolve().parent.parent / "pipeline_logs" / "drift"))
+# Reclustering thresholds
+DRIFT_NOISE_DELTA = float(os.getenv("DRIFT_NOISE_DELTA", "0.05"))
+DRIFT_SIMILARITY_DROP = float(os.getenv("DRIFT_SIMILARITY_DROP", "0.05"))
+DRIFT_PSI_THRESHOLD = float(os.getenv("DRIFT_PSI_THRESHOLD", "0.2"))
+DRIFT_VOLUME_RATIO = float(os.getenv("DRIFT_VOLUME_RATIO", "2.0"))
+DRIFT_VOLUME_MIN_DOCUMENTS = 20
+QUANTILES = (5, 25, 50, 75, 95)
+# Floor for shares in the PSI, so empty bins do not make it infinite
+PSI_EPSILON = 1e-4
+
+
+def psi(expected, actual):
+    """Population stability index between two share vectors"""
+    expected = np.clip(np.asarray(expected, dtype=np.float64), PSI_EPSILON, None)
+    actual = np.clip(np.asarray(actual, dtype=np.float64), PSI_EPSILON, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def _nearest(model, docs):
+    """(nearest cluster ids, similarities, confident) for a batch of documents"""
+    embeddings = np.stack([decode_embedding(doc["embeddings"]) for doc in docs])
+    cluster_ids, similarities, confident, _ = model.assign(embeddings)
+    return cluster_ids, similarities.astype(np.float32), confident
+
+
+def _profile(similarities, confident):
+    return {
+        "documents": int(len(similarities)),
+        "mean_similarity": round(float(np.mean(similarities)), 4),
+        "quantiles": {f"p{q}": round(float(v), 4) for q, v in zip(QUANTILES, np.percentile(similarities, QUANTILES))},
+        "noise_share": round(float(np.mean(~confident)), 4),
+    }
+
+
+def baseline_profile(db, model, sample_size=DRIFT_BASELINE_SAMPLE):
+    """Similarity profile of a sample of the documents clustered before ``model`` was built (cached)"""
+    path = model.path() / "drift_baseline.json"
+    if path.exists():
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline.get("model_created_at") == model.created_at:
+            return baseline
+
+    cutoff = ObjectId.from_datetime(datetime.fromtimestamp(model.created_at, tz=timezone.utc))
+    pipeline = [
+        {"$match": {"_id": {"$lt": cutoff}, "kmeans_cluster_id": {"$exists": True, "$ne": None},
+                    "embeddings": {"$exists": True}, **embedding_model_filter(model.embedding_model)}},
+        {"$sample": {"size": sample_size}},
+        {"$project": {"embeddings": 1}},
+    ]
+    docs = [doc for doc in db[model.collection_name].aggregate(pipeline, allowDiskUse=True)
+            if embedding_dimension(doc.get("embeddings"))]
+    if not docs:
+        raise ValueError(f"No clustered documents in {model.collection_name} predate the cluster model")
+    similarities, confident = [], []
+    for offset in range(0, len(docs), ASSIGN_BATCH_SIZE):
+        _, batch_similarities, batch_confident = _nearest(model, docs[offset:offset + ASSIGN_BATCH_SIZE])
+        similarities.append(batch_similarities)
+        confident.append(batch_confident)
+    similarities, confident = np.concatenate(similarities), np.concatenate(confident)
+
+    baseline = _profile(similarities, confident)
+    baseline["model_created_at"] = model.created_at
+    # Decile edges for the similarity PSI; the baseline holds 10% of its documents in each bin
+    baseline["decile_edges"] = [float(v) for v in np.percentile(similarities, np.arange(10, 100, 10))]
+    baseline["similarities"] = [round(float(v), 4) for v in np.sort(similarities)]
+    with open(path.with_suffix(".tmp.json"), "w") as f:
+        json.dump(baseline, f)
+    os.replace(path.with_suffix(".tmp.json"), path)
+    return baseline
+
+
+def recent_profile(db, model, since, batch_size=ASSIGN_BATCH_SIZE):
+    """Nearest-centroid similarities and cluster volumes of documents created since ``since``"""
+    query = {"_id": {"$gte": ObjectId.from_datetime(since)}, "embeddings": {"$exists": True},
+             **embedding_model_filter(model.embedding_model)}
+    similarities, confident, volumes = [], [], {}
+    batch = []
+    cursor = db[model.collection_name].find(query, {"embeddings": 1}).batch_size(batch_size)
+    while True:
+        doc = next(cursor, None)
+        if doc is not None and embedding_dimension(doc.get("embeddings")):
+            batch.append(doc)
+        if batch and (doc is None or len(batch) >= batch_size):
+            cluster_ids, batch_similarities, batch_confident = _nearest(model, batch)
+            similarities.append(batch_similarities)
+            confident.append(batch_confident)
+            for cluster_id, count in zip(*np.unique(cluster_ids, return_counts=True)):
+                volumes[int(cluster_id)] = volumes.get(int(cluster_id), 0) + int(count)
+            batch = []
+        if doc is None:
+            break
+    if not similarities:
+        return np.empty(0, dtype=np.float32), np.empty(0, dtype=bool), volumes
+    return np.concatenate(similarities), np.concatenate(confident), volumes
+
+
+def volume_shifts(model, volumes):
+    """Per-cluster share of the model's documents against the share of recent documents"""
+    model_shares = model.counts / max(int(model.counts.sum()), 1)
+    total = max(sum(volumes.values()), 1)
+    recent_shares = np.array([volumes.get(int(c), 0) / total for c in model.cluster_ids])
+    shifts = []
+    for cluster_id, model_share, recent_share in zip(model.cluster_ids, model_shares, recent_shares):
+        ratio = recent_share / model_share if model_share > 0 else float("inf")
+        shifts.append({
+            "cluster_id": int(cluster_id),
+            "label": model.labels["clusters"].get(str(int(cluster_id))),
+            "model_share": round(float(model_share), 4),
+            "recent_share": round(float(recent_share), 4),
+            "recent_documents": volumes.get(int(cluster_id), 0),
+            "ratio": round(float(ratio), 3),
+        })
+    shifts.sort(key=lambda s: -abs(np.log(max(s["ratio"], PSI_EPSILON))))
+    return shifts, psi(model_shares, recent_shares)
+
+
+def check_drift(db, collection_name, window_hours=DRIFT_WINDOW_HOURS):
+    """Build the drift report of ``collection_name``; ``report["recluster"]`` says whether to recluster"""
+    from scipy.stats import ks_2samp
+
+    start = time.time()
+    model = ClusterModel.load(collection_name)
+    since = datetime.now(timezone.utc) - timedelta(hours=window_hours)
+    report = {
+        "collection": collection_name,
+        "checked_at": time.time(),
+        "window_hours": window_hours,
+        "model_created_at": model.created_at,
+        "clusters": len(model.cluster_ids),
+        "recluster": False,
+        "reasons": [],
+    }
+    similarities, confident, volumes = recent_profile(db, model, since)
+    if len(similarities) < DRIFT_MIN_DOCUMENTS:
+        report["status"] = "insufficient_data"
+        report["recent"] = {"documents": int(len(similarities))}
+        print(f"[{collection_name}] {len(similarities)} documents in the last {window_hours:g}h; "
+              f"at least {DRIFT_MIN_DOCUMENTS} are needed to measure drift")
+        return report
+
+    baseline = baseline_profile(db, model)
+    recent = _profile(similarities, confident)
+    recent_bins = np.bincount(np.searchsorted(baseline["decile_edges"], similarities), minlength=10) / len(similarities)
+    report["baseline"] = {key: value for key, value in baseline.items() if key not in ("similarities", "decile_edges")}
+    report["recent"] = recent
+    report["similarity"] = {
+        "median_drop": round(baseline["quantiles"]["p50"] - recent["quantiles"]["p50"], 4),
+        "ks_statistic": round(float(ks_2samp(baseline["similarities"], similarities).statistic), 4),
+        "psi": round(psi(np.full(10, 0.1), recent_bins), 4),
+        "recent_decile_shares": [round(float(v), 4) for v in recent_bins],
+    }
+    report["noise_share_delta"] = round(recent["noise_share"] - baseline["noise_share"], 4)
+    shifts, volume_psi = volume_shifts(model, volumes)
+    report["volume"] = {
+        "psi": round(volume_psi, 4),
+        "shifted_clusters": [s for s in shifts if s["recent_documents"] >= DRIFT_VOLUME_MIN_DOCUMENTS
+                             and not 1 / DRIFT_VOLUME_RATIO < s["ratio"] < DRIFT_VOLUME_RATIO],
+        "per_cluster": shifts,
+    }
+
+    checks = [
+        (report["noise_share_delta"] > DRIFT_NOISE_DELTA,
+         f"noise share rose by {report['noise_share_delta']:.3f} (> {DRIFT_NOISE_DELTA})"),
+        (report["similarity"]["median_drop"] > DRIFT_SIMILARITY_DROP,
+         f"median centroid similarity fell by {report['similarity']['median_drop']:.3f} (> {DRIFT_SIMILARITY_DROP})"),
+        (report["similarity"]["psi"] > DRIFT_PSI_THRESHOLD,
+         f"similarity PSI {report['similarity']['psi']:.3f} (> {DRIFT_PSI_THRESHOLD})"),
+        (volume_psi > DRIFT_PSI_THRESHOLD, f"cluster volume PSI {volume_psi:.3f} (> {DRIFT_PSI_THRESHOLD})"),
+    ]
+    report["reasons"] = [reason for crossed, reason in checks if crossed]
+    report["recluster"] = bool(report["reasons"])
+    report["status"] = "drift" if report["recluster"] else "stable"
+    report["seconds"] = round(time.time() - start, 2)
+    print(f"[{collection_name}] {recent['documents']} recent documents: noise {recent['noise_share']:.3f} "
+          f"(baseline {baseline['noise_share']:.3f}), median similarity {recent['quantiles']['p50']:.3f} "
+          f"(baseline {baseline['quantiles']['p50']:.3f}), similarity PSI {report['similarity']['psi']:.3f}, "
+          f"volume PSI {volume_psi:.3f}, {len(report['volume']['shifted_clusters'])} shifted clusters: "
+          f"{report['status']}")
+    for reason in report["reasons"]:
+        print(f"[{collection_name}]   {reason}")
+    return report
+
+
+def _recluster(db, collection_name, recluster_command, data=None):
+    """Run the reclustering command, then rebuild the cluster model and close the request"""
+    returncode = subprocess.run(shlex.split(recluster_command), check=False).returncode
+    if returncode != 0:
+        close_recluster_requests(db, collection_name, status="failed")
+        print(f"[{collection_name}] Reclustering command failed ({returncode}); request closed as failed")
+        return
+    build_cluster_model(db, collection_name, data=data)
+    close_recluster_requests(db, collection_name)
+    print(f"[{collection_name}] Reclustered; cluster model rebuilt")
+
+
+def record_report(db, report, report_dir=DRIFT_REPORT_DIR, recluster_command=None, data=None):
+    """Save the report and, on drift, file a reclustering request; returns the report path"""
+    report_dir = Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+    path = report_dir / f"{report['collection']}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    db["cluster_drift_reports"].insert_one(dict(report))
+
+    if report["recluster"]:
+        if db["recluster_requests"].find_one({"collection": report["collection"], "status": "requested"}):
+            print(f"[{report['collection']}] A reclustering request is already open")
+        else:
+            db["recluster_requests"].insert_one({
+                "collection": report["collection"], "reason": "drift", "drift_reasons": report["reasons"],
+                "requested_at": time.time(), "status": "requested",
+            })
+            print(f"[{report['collection']}] Reclustering requested")
+            if recluster_command:
+                _recluster(db, report["collection"], recluster_command, data)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check recent documents against the persisted clusters")
+    parser.add_argument("--collection", nargs="+", default=["emailmessages"])
+    parser.add_argument("--db", default="sparzaai")
+    parser.add_argument("--window-hours", type=float, default=DRIFT_WINDOW_HOURS)
+    parser.add_argument("--report-dir", default=DRIFT_REPORT_DIR)
+    parser.add_argument("--data", nargs="+", help="cluster collection 'data' tag per collection (e.g. email), "
+                                                  "used when rebuilding the cluster model")
+    parser.add_argument("--recluster-command", help="command to run when reclustering is requested")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_CONNECTION_STRING"))
+    try:
+        db = client[args.db]
+        data_tags = args.data or [None] * len(args.collection)
+        if len(data_tags) != len(args.collection):
+            parser.error("--data needs one tag per --collection")
+        for collection_name, data in zip(args.collection, data_tags):
+            report = check_drift(db, collection_name, args.window_hours)
+            path = record_report(db, report, args.report_dir, args.recluster_command, data)
+            print(f"[{collection_name}] Drift report: {path}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Embedding backends and batched transformer inference for the clustering scripts.
+
+``get_embedding_backend()`` returns the backend selected by EMBEDDING_BACKEND:
+
+    transformer  gte-Qwen2-7B-instruct in float16 across available GPUs (default)
+    cpu          a small sentence-embedding model, int8 dynamically quantized,
+                 using EMBEDDING_CPU_THREADS threads
+
+Backends know their model id before loading weights, so callers can check the
+embedding cache first and skip loading entirely when everything is cached.
+
+Phrases are tokenized once to get their lengths, sorted by length and grouped
+into buckets whose padded size (rows x longest row) stays under a token budget.
+Each bucket is padded only to its own longest phrase (right padding) and pooled
+with an attention-masked mean, which matches the old per-phrase
+``last_hidden_state.mean(dim=1)`` because padding never enters the average.
+"""
+import os
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+from pipeline_common.embedding_models import EMBEDDING_BACKEND, backend_identity, make_model_id
+
+EMBEDDING_PREFIX = "query: "
+EMBEDDING_MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", "512"))
+# Padded tokens per forward pass; lower this if the GPU runs out of memory
+EMBEDDING_MAX_TOKENS_PER_BATCH = int(os.getenv("EMBEDDING_MAX_TOKENS_PER_BATCH", "8192"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "128"))
+# Phrases re-embedded one at a time before a run to confirm the batched path matches
+EMBEDDING_PARITY_SAMPLE = int(os.getenv("EMBEDDING_PARITY_SAMPLE", "8"))
+# float16 models drift slightly with padding shape; cosine is the check that matters for clustering
+EMBEDDING_PARITY_MIN_COSINE = float(os.getenv("EMBEDDING_PARITY_MIN_COSINE", "0.9995"))
+EMBEDDING_CPU_THREADS = int(os.getenv("EMBEDDING_CPU_THREADS", str(os.cpu_count() or 1)))
+
+
+def masked_mean_pool(last_hidden_state, attention_mask):
+    """Mean over real tokens only, accumulated in float32"""
+    mask = attention_mask.unsqueeze(-1).to(torch.float32)
+    summed = (last_hidden_state.to(torch.float32) * mask).sum(dim=1)
+    counts = mask.sum(dim=1).clamp(min=1.0)
+    return summed / counts
+
+
+def length_buckets(lengths, max_tokens_per_batch=EMBEDDING_MAX_TOKENS_PER_BATCH,
+                   max_batch_size=EMBEDDING_MAX_BATCH_SIZE):
+    """Group indices longest-first so each bucket's padded size stays under the token budget.
+
+    The longest bucket runs first, so an out-of-memory budget fails immediately
+    rather than hours into a run.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    buckets = []
+    current = []
+    current_width = 0
+    for idx in order:
+        width = max(current_width, lengths[idx])
+        if current and ((len(current) + 1) * width > max_tokens_per_batch or len(current) >= max_batch_size):
+            buckets.append(current)
+            current = []
+            width = lengths[idx]
+        current.append(idx)
+        current_width = width
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+class BatchedEmbedder:
+    """Embed phrases with dynamic padding and length-sorted bucketing."""
+
+    def __init__(self, model, tokenizer, device, max_length=EMBEDDING_MAX_LENGTH,
+                 max_tokens_per_batch=EMBEDDING_MAX_TOKENS_PER_BATCH,
+                 max_batch_size=EMBEDDING_MAX_BATCH_SIZE, prefix=EMBEDDING_PREFIX):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_length = max_length
+        self.max_tokens_per_batch = max(max_tokens_per_batch, max_length)
+        self.max_batch_size = max_batch_size
+        self.prefix = prefix
+        self.batched = True
+
+        # Right padding keeps real-token positions identical to the unpadded call
+        self.tokenizer.padding_side = "right"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def _inputs(self, texts, padding):
+        return self.tokenizer(
+            [f"{self.prefix}{text}" for text in texts],
+            return_tensors="pt" if padding else None,
+            padding=padding,
+            truncation=True,
+            max_length=self.max_length,
+        )
+
+    def embed_one(self, text):
+        """Original per-phrase path; returns None on failure like the scripts did"""
+        try:
+            inputs = self._inputs([text], padding=True).to(self.device)
+            with torch.no_grad():
+                output = self.model(**inputs).last_hidden_state.mean(dim=1)
+            return output.float().cpu().numpy().flatten()
+        except Exception as e:
+            print(f"Error getting embedding for '{text}': {e}")
+            return None
+
+    def _embed_bucket(self, texts):
+        inputs = self._inputs(texts, padding="longest").to(self.device)
+        with torch.no_grad():
+            hidden = self.model(**inputs).last_hidden_state
+        return masked_mean_pool(hidden, inputs["attention_mask"]).cpu().numpy()
+
+    def embed(self, texts):
+        """Embed ``texts`` and return a list aligned with the input (None where a phrase failed)"""
+        results = [None] * len(texts)
+        if not texts:
+            return results
+        if not self.batched:
+            return [self.embed_one(text) for text in texts]
+
+        lengths = [len(ids) for ids in self._inputs(texts, padding=False)["input_ids"]]
+        for bucket in length_buckets(lengths, self.max_tokens_per_batch, self.max_batch_size):
+            bucket_texts = [texts[i] for i in bucket]
+            try:
+                vectors = self._embed_bucket(bucket_texts)
+                for i, vector in zip(bucket, vectors):
+                    results[i] = vector
+            except Exception as e:
+                # Typically OOM on an oversized bucket: finish it phrase by phrase
+                print(f"Batched embedding failed for {len(bucket)} phrases ({e}); falling back to per-phrase")
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                for i in bucket:
+                    results[i] = self.embed_one(texts[i])
+        return results
+
+    def check_parity(self, texts, sample_size=EMBEDDING_PARITY_SAMPLE, min_cosine=EMBEDDING_PARITY_MIN_COSINE):
+        """Compare batched vs per-phrase embeddings on a sample.
+
+        Disables batching for this embedder when they disagree, so a model
+        that does not honour the attention mask cannot silently change results.
+        """
+        sample = texts[:sample_size]
+        if not sample:
+            return True
+        batched = self.embed(sample)
+        worst_cosine = 1.0
+        worst_abs = 0.0
+        for text, vector in zip(sample, batched):
+            reference = self.embed_one(text)
+            if reference is None or vector is None:
+                continue
+            cosine = float(np.dot(reference, vector) / (np.linalg.norm(reference) * np.linalg.norm(vector) + 1e-12))
+            worst_cosine = min(worst_cosine, cosine)
+            worst_abs = max(worst_abs, float(np.max(np.abs(reference - vector))))
+
+        print(f"Batched vs per-phrase parity on {len(sample)} phrases: min cosine={worst_cosine:.6f}, max abs diff={worst_abs:.6f}")
+        if worst_cosine < min_cosine:
+            print(f"Parity below {min_cosine}; falling back to per-phrase embedding for this run")
+            self.batched = False
+            return False
+        return True
+
+
+class EmbeddingBackend:
+    """A named embedding model whose weights load lazily on first use."""
+
+    name = None
+    # Batched vs per-phrase agreement required before batching is trusted
+    parity_min_cosine = EMBEDDING_PARITY_MIN_COSINE
+
+    def __init__(self):
+        self.model_name, self.revision, self.variant = backend_identity(self.name)
+        # Recorded on every document as embedding_model
+        self.model_id = make_model_id(self.model_name, self.revision, self.variant)
+        # Cache namespace: vectors differ between variants of the same weights
+        self.cache_name = f"{self.model_name}:{self.variant}"
+        self._embedder = None
+
+    def _load_model(self):
+        """Return (model, tokenizer, device)"""
+        raise NotImplementedError
+
+    def load(self):
+        if self._embedder is None:
+            model, tokenizer, device = self._load_model()
+            self._embedder = BatchedEmbedder(model, tokenizer, device)
+        return self._embedder
+
+    def embed(self, texts):
+        return self.load().embed(texts)
+
+    def check_parity(self, texts):
+        return self.load().check_parity(texts, min_cosine=self.parity_min_cosine)
+
+
+class TransformerBackend(EmbeddingBackend):
+    """gte-Qwen2-7B-instruct in float16, spread over available devices."""
+
+    name = "transformer"
+
+    def _load_model(self):
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name, revision=self.revision)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        print(f"Using device: {device}")
+        try:
+            model = AutoModel.from_pretrained(
+                self.model_name, revision=self.revision, torch_dtype=torch.float16, device_map="auto"
+            )
+            print("Model loaded with automatic device mapping")
+        except Exception as e:
+            print(f"Auto device mapping failed: {e}")
+            # Same dtype as the mapped load: model_id and the cache namespace already say fp16
+            model = AutoModel.from_pretrained(
+                self.model_name, revision=self.revision, torch_dtype=torch.float16
+            ).to(device)
+            print("Model loaded with manual device assignment")
+        return model, tokenizer, device
+
+
+class CPUBackend(EmbeddingBackend):
+    """Small sentence-embedding model for CPU-only nodes.
+
+    Linear layers are quantized to int8 with torch dynamic quantization, which
+    needs no calibration data or export step.
+    """
+
+    name = "cpu"
+    # Dynamic int8 quantization scales activations per batch, so padding shifts results slightly
+    parity_min_cosine = min(EMBEDDING_PARITY_MIN_COSINE, 0.995)
+
+    def _load_model(self):
+        torch.set_num_threads(EMBEDDING_CPU_THREADS)
+        print(f"Using device: cpu ({EMBEDDING_CPU_THREADS} threads)")
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name, revision=self.revision)
+        model = AutoModel.from_pretrained(self.model_name, revision=self.revision, torch_dtype=torch.float32)
+        model.eval()
+        if self.variant == "int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            print("Model quantized to int8 (dynamic)")
+        return model, tokenizer, "cpu"
+
+
+EMBEDDING_BACKENDS = {
+    TransformerBackend.name: TransformerBackend,
+    CPUBackend.name: CPUBackend,
+}
+
+
+def get_embedding_backend(name=EMBEDDING_BACKEND):
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}', expected one of {sorted(EMBEDDING_BACKENDS)}")
+    return EMBEDDING_BACKENDS[name]()
@@ -0,0 +1,251 @@
+"""Content-addressed on-disk embedding cache shared by every channel's embedding script.
+
+Vectors are keyed by sha256(model name, model revision, preprocessed text), so the
+same lemmatized ``dominant_topic`` is embedded once no matter which collection
+or run it comes from. Each (model, revision) pair gets its own store directory:
+
+    meta.json     model, revision, dimension, dtype
+    vectors.f32   append-only float32 rows, read through np.memmap
+    index.tsv     append-only "<key>\\t<row>" lines
+
+Rows are only ever appended; ``compact`` rewrites the store without orphaned
+rows and duplicate index entries. Run it while no embedding job is running:
+
+    python -m pipeline_common.embedding_cache stats
+    python -m pipeline_common.embedding_cache compact
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+
+EMBEDDING_CACHE_DIR = Path(os.getenv("EMBEDDING_CACHE_DIR", Path(__file__).resolve().parent.parent / "embedding_cache"))
+CACHE_DTYPE = np.float32
+# A writer that died while holding the lock leaves the lock file behind; ignore it after this long
+LOCK_STALE_SECONDS = 300
+
+
+def cache_key(model_name, revision, text):
+    return hashlib.sha256(f"{model_name}\x00{revision}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class _StoreLock:
+    """Cross-process lock via exclusive file creation (works on Windows and Linux)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > LOCK_STALE_SECONDS:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class EmbeddingCache:
+    """Append-only memory-mapped vector store with a key -> row index."""
+
+    def __init__(self, model_name, revision, cache_dir=EMBEDDING_CACHE_DIR):
+        self.model_name = model_name
+        self.revision = revision
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", f"{model_name}@{revision}")
+        self.store_dir = Path(cache_dir) / slug
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.meta_path = self.store_dir / "meta.json"
+        self.vectors_path = self.store_dir / "vectors.f32"
+        self.index_path = self.store_dir / "index.tsv"
+        self.lock_path = self.store_dir / ".lock"
+
+        self.dim = None
+        self.index = {}
+        self._mmap = None
+        self._mapped_rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._load()
+
+    def _load(self):
+        if self.meta_path.exists():
+            with open(self.meta_path, "r") as f:
+                self.dim = json.load(f)["dim"]
+        self.index = {}
+        if self.dim and self.index_path.exists():
+            rows_on_disk = self._rows_on_disk()
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    # A torn last line or a row whose vector never landed is skipped
+                    if len(parts) == 2 and parts[1].isdigit() and int(parts[1]) < rows_on_disk:
+                        self.index[parts[0]] = int(parts[1])
+
+    def _rows_on_disk(self):
+        if not self.dim or not self.vectors_path.exists():
+            return 0
+        return self.vectors_path.stat().st_size // (self.dim * np.dtype(CACHE_DTYPE).itemsize)
+
+    def _vectors(self, needed_rows):
+        if self._mmap is None or needed_rows > self._mapped_rows:
+            rows = self._rows_on_disk()
+            self._mmap = np.memmap(self.vectors_path, dtype=CACHE_DTYPE, mode="r", shape=(rows, self.dim)) if rows else None
+            self._mapped_rows = rows
+        return self._mmap
+
+    def key(self, text):
+        return cache_key(self.model_name, self.revision, text)
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_many(self, texts):
+        """Return {text: vector} for every cached text; vectors are copies, safe to keep"""
+        found = {}
+        rows = {}
+        for text in texts:
+            row = self.index.get(self.key(text))
+            if row is None:
+                self.misses += 1
+            else:
+                rows[text] = row
+        if rows:
+            vectors = self._vectors(max(rows.values()) + 1)
+            for text, row in rows.items():
+                found[text] = np.array(vectors[row])
+            self.hits += len(found)
+        return found
+
+    def put_many(self, pairs):
+        """Append (text, vector) pairs that are not cached yet; returns the number written"""
+        pending = {}
+        for text, vector in pairs:
+            key = self.key(text)
+            if key not in self.index and key not in pending:
+                pending[key] = np.asarray(vector, dtype=CACHE_DTYPE).reshape(-1)
+        if not pending:
+            return 0
+
+        with _StoreLock(self.lock_path):
+            # Another process may have appended since we loaded
+            self._load()
+            pending = {k: v for k, v in pending.items() if k not in self.index}
+            if not pending:
+                return 0
+            if self.dim is None:
+                self.dim = len(next(iter(pending.values())))
+                with open(self.meta_path, "w") as f:
+                    json.dump({"model": self.model_name, "revision": self.revision,
+                               "dim": self.dim, "dtype": np.dtype(CACHE_DTYPE).name}, f, indent=2)
+
+            block = np.stack(list(pending.values()))
+            if block.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {block.shape[1]} does not match cache dimension {self.dim}")
+            start_row = self._rows_on_disk()
+            # Drop a partial row left by a crashed writer, or every appended row would be misaligned
+            row_end = start_row * self.dim * np.dtype(CACHE_DTYPE).itemsize
+            if self.vectors_path.exists() and self.vectors_path.stat().st_size > row_end:
+                os.truncate(self.vectors_path, row_end)
+            with open(self.vectors_path, "ab") as f:
+                f.write(block.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            # Index lines go in only after their vectors are durable
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                for offset, key in enumerate(pending):
+                    f.write(f"{key}\t{start_row + offset}\n")
+                    self.index[key] = start_row + offset
+        self.writes += len(pending)
+        return len(pending)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "revision": self.revision,
+            "entries": len(self.index),
+            "rows_on_disk": self._rows_on_disk(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+    def report(self):
+        stats = self.stats()
+        hit_rate = f"{stats['hit_rate'] * 100:.1f}%" if stats["hit_rate"] is not None else "N/A"
+        print(f"Embedding cache ({self.store_dir}): {stats['hits']} hits, {stats['misses']} misses "
+              f"(hit rate {hit_rate}), {stats['writes']} new vectors, {stats['entries']} entries total")
+        return stats
+
+    def compact(self):
+        """Rewrite the store keeping one row per indexed key; returns rows reclaimed"""
+        with _StoreLock(self.lock_path):
+            self._load()
+            before = self._rows_on_disk()
+            if not self.index:
+                return 0
+            vectors = self._vectors(before)
+            keys = list(self.index)
+            tmp_vectors = self.vectors_path.with_suffix(".f32.tmp")
+            tmp_index = self.index_path.with_suffix(".tsv.tmp")
+            with open(tmp_vectors, "wb") as f:
+                f.write(np.ascontiguousarray(vectors[[self.index[k] for k in keys]]).tobytes())
+            with open(tmp_index, "w", encoding="utf-8") as f:
+                for row, key in enumerate(keys):
+                    f.write(f"{key}\t{row}\n")
+            # Release the map before replacing the file underneath it (required on Windows)
+            self._mmap = None
+            del vectors
+            os.replace(tmp_vectors, self.vectors_path)
+            os.replace(tmp_index, self.index_path)
+            self.index = {key: row for row, key in enumerate(keys)}
+            self._mapped_rows = 0
+        return before - len(keys)
+
+
+def iter_stores(cache_dir=EMBEDDING_CACHE_DIR):
+    for meta_path in sorted(Path(cache_dir).glob("*/meta.json")):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        yield EmbeddingCache(meta["model"], meta["revision"], cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or compact the shared embedding cache")
+    parser.add_argument("command", choices=["stats", "compact"])
+    parser.add_argument("--cache-dir", default=str(EMBEDDING_CACHE_DIR))
+    args = parser.parse_args()
+
+    stores = list(iter_stores(args.cache_dir))
+    if not stores:
+        print(f"No embedding cache stores found in {args.cache_dir}")
+        return
+    for store in stores:
+        if args.command == "compact":
+            reclaimed = store.compact()
+            print(f"{store.store_dir.name}: compacted, reclaimed {reclaimed} rows")
+        stats = store.stats()
+        print(f"{store.store_dir.name}: {stats['entries']} entries, {stats['rows_on_disk']} rows on disk, dim={store.dim}")
+
+
+if __name__ == "__main__":
+    main()
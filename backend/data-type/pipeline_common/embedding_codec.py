@@ -0,0 +1,80 @@
+"""Compact binary storage for document embeddings.
+
+Embeddings used to be stored as BSON arrays of doubles (9 bytes per dimension
+on the wire, one Python float per value on decode). They are now stored as a
+BSON Binary with a 16-byte header followed by the raw little-endian vector:
+
+    offset 0   4s   magic b"EMB1"
+    offset 4   B    dtype code (1 = float32, 2 = float16)
+    offset 5   3x   reserved
+    offset 8   I    dimension
+    offset 12  4x   reserved (keeps the payload 8-byte aligned)
+
+``decode_embedding`` wraps the payload with ``np.frombuffer`` (no copy) and
+still accepts the legacy list format, so readers work during a migration.
+"""
+import os
+import struct
+
+import numpy as np
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+EMBEDDING_MAGIC = b"EMB1"
+EMBEDDING_HEADER = struct.Struct("<4sB3xI4x")
+EMBEDDING_DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f2")}
+EMBEDDING_DTYPE_CODES = {"float32": 1, "float16": 2}
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float32")
+
+
+def encode_embedding(vector, dtype=EMBEDDING_STORAGE_DTYPE):
+    """Pack a vector as BSON Binary with a dtype/dimension header"""
+    code = EMBEDDING_DTYPE_CODES[dtype]
+    array = np.ascontiguousarray(np.asarray(vector).reshape(-1), dtype=EMBEDDING_DTYPES[code])
+    header = EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, code, array.shape[0])
+    return Binary(header + array.tobytes(), USER_DEFINED_SUBTYPE)
+
+
+def is_encoded_embedding(value):
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:4]) == EMBEDDING_MAGIC
+
+
+def decode_embedding(value):
+    """Return the stored vector as a numpy array.
+
+    Binary values are viewed in place (read-only, no copy). Legacy lists of
+    floats are converted to float32, which holds the original float16 model
+    output exactly. Returns None for missing or empty values.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        if len(value) < EMBEDDING_HEADER.size:
+            return None
+        magic, code, dim = EMBEDDING_HEADER.unpack_from(value, 0)
+        if magic != EMBEDDING_MAGIC or code not in EMBEDDING_DTYPES:
+            raise ValueError("Unrecognised embedding encoding")
+        return np.frombuffer(value, dtype=EMBEDDING_DTYPES[code], count=dim, offset=EMBEDDING_HEADER.size)
+    if len(value) == 0:
+        return None
+    return np.asarray(value, dtype=np.float32)
+
+
+def embedding_dimension(value):
+    """Dimension of a stored embedding without decoding it"""
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        if len(value) < EMBEDDING_HEADER.size:
+            return 0
+        return EMBEDDING_HEADER.unpack_from(value, 0)[2]
+    return len(value)
+
+
+def stack_embeddings(vectors):
+    """Copy decoded vectors into one preallocated float32 matrix"""
+    if not vectors:
+        return np.empty((0, 0), dtype=np.float32)
+    matrix = np.empty((len(vectors), len(vectors[0])), dtype=np.float32)
+    for row, vector in enumerate(vectors):
+        matrix[row] = vector
+    return matrix
@@ -0,0 +1,194 @@
+"""Stream keyphrase embeddings from MongoDB into one preallocated float32 matrix.
+
+The clustering scripts used to ``list(collection.find(...))`` whole documents
+and then stack per-document arrays, holding the raw documents, the decoded
+vectors and the stacked copy at the same time. ``load_keyphrase_embeddings``
+projects only the fields it needs, streams the cursor in large batches,
+decodes each vector straight into its row of a preallocated matrix (a
+disk-backed memmap above LOADER_MEMMAP_THRESHOLD_MB, unlinked as soon as it
+is mapped so nothing is left behind) and can deduplicate keyphrases as it
+goes, so peak memory stays close to the matrix itself.
+
+Keyphrases come from the ``dominant_topic_lemma`` stored by the embedding
+scripts when present; otherwise each cursor batch's topics are lemmatized
+together (``preprocess.warm``) before the rows are filled.
+"""
+import atexit
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from pipeline_common.embedding_codec import decode_embedding, embedding_dimension
+
+LOADER_BATCH_SIZE = int(os.getenv("LOADER_BATCH_SIZE", "2000"))
+LOADER_MEMMAP_THRESHOLD_MB = int(os.getenv("LOADER_MEMMAP_THRESHOLD_MB", "2048"))
+LOADER_MEMMAP_DIR = os.getenv("LOADER_MEMMAP_DIR", tempfile.gettempdir())
+
+
+class LoadedEmbeddings:
+    """Rows of ``embeddings`` line up with ``keyphrases`` and ``document_ids``.
+
+    ``document_ids[i]`` lists every document whose keyphrase is row i (a
+    single id unless deduplicating); ``documents`` holds one record per
+    accepted document with its row, original topic and any extra fields.
+    """
+
+    def __init__(self, embeddings, keyphrases, document_ids, documents, scanned, skipped, seconds):
+        self.embeddings = embeddings
+        self.keyphrases = keyphrases
+        self.document_ids = document_ids
+        self.documents = documents
+        self.scanned = scanned
+        self.skipped = skipped
+        self.seconds = seconds
+
+    @property
+    def keyphrase_to_documents(self):
+        return dict(zip(self.keyphrases, self.document_ids))
+
+    def summary(self):
+        return {
+            "documents_scanned": self.scanned,
+            "documents_loaded": len(self.documents),
+            "rows": len(self.keyphrases),
+            "skipped": self.skipped,
+            "matrix_mb": round(self.embeddings.nbytes / 1e6, 1),
+            "memmap": isinstance(self.embeddings, np.memmap),
+            "seconds": round(self.seconds, 1),
+        }
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _allocate(rows, dim, name):
+    if rows * dim * 4 > LOADER_MEMMAP_THRESHOLD_MB * 1024 * 1024:
+        # A fresh file per allocation: a grow must never reopen (and empty) the file it copies from
+        fd, path = tempfile.mkstemp(prefix=f"{name}_", suffix=".f32", dir=LOADER_MEMMAP_DIR)
+        os.close(fd)
+        print(f"Allocating {rows}x{dim} embedding memmap at {path}")
+        matrix = np.memmap(path, dtype=np.float32, mode="w+", shape=(rows, dim))
+        try:
+            # The mapping outlives the directory entry on POSIX, so the space is freed with the matrix
+            os.remove(path)
+        except OSError:
+            atexit.register(_remove, path)
+        return matrix
+    return np.empty((rows, dim), dtype=np.float32)
+
+
+def _grow(matrix, rows, name):
+    grown = _allocate(rows, matrix.shape[1], name)
+    grown[:len(matrix)] = matrix
+    return grown
+
+
+def _needs_lemma(doc):
+    return isinstance(doc.get("dominant_topic"), str) and not isinstance(doc.get("dominant_topic_lemma"), str)
+
+
+def warmed(cursor, preprocess, batch_size):
+    """Yield documents from ``cursor``, lemmatizing each batch's unlemmatized topics together"""
+    warm = getattr(preprocess, "warm", None)
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            if warm:
+                warm([d["dominant_topic"] for d in batch if _needs_lemma(d)])
+            yield from batch
+            batch = []
+    if warm and batch:
+        warm([d["dominant_topic"] for d in batch if _needs_lemma(d)])
+    yield from batch
+
+
+def load_keyphrase_embeddings(collection, query, preprocess, dedupe=False, extra_fields=(),
+                              skip_topics=(), batch_size=LOADER_BATCH_SIZE, verbose=False):
+    """Load (lemmatized keyphrase, embedding) rows for documents matching ``query``.
+
+    ``preprocess`` maps a dominant_topic to its lemmatized keyphrase: a
+    ``Lemmatizer`` (its ``warm`` lemmatizes each batch at once) or any
+    callable. Documents with an empty topic, empty embedding, a topic in
+    ``skip_topics`` (compared lower-cased) or an empty keyphrase are skipped
+    and counted in ``skipped``.
+    """
+    start = time.time()
+    capacity = collection.count_documents(query)
+    projection = {"_id": 1, "dominant_topic": 1, "dominant_topic_lemma": 1, "embeddings": 1,
+                  **{field: 1 for field in extra_fields}}
+    skip_topics = {topic.lower() for topic in skip_topics}
+
+    matrix = None
+    keyphrases, document_ids, documents = [], [], []
+    row_of_keyphrase, lemma_of_topic = {}, {}
+    skipped = {"invalid_topic": 0, "empty_embedding": 0, "skipped_topic": 0,
+               "empty_keyphrase": 0, "dimension_mismatch": 0}
+    scanned = 0
+
+    for doc in warmed(collection.find(query, projection).batch_size(batch_size), preprocess, batch_size):
+        scanned += 1
+        doc_id = doc["_id"]
+        dominant_topic = doc.get("dominant_topic", "")
+        embedding_data = doc.get("embeddings")
+
+        if not dominant_topic or not isinstance(dominant_topic, str) or not dominant_topic.strip():
+            skipped["invalid_topic"] += 1
+            continue
+        if dominant_topic.strip().lower() in skip_topics:
+            skipped["skipped_topic"] += 1
+            continue
+        dim = embedding_dimension(embedding_data)
+        if not dim:
+            skipped["empty_embedding"] += 1
+            continue
+
+        stored_lemma = doc.get("dominant_topic_lemma")
+        if isinstance(stored_lemma, str):
+            keyphrase = stored_lemma
+        else:
+            if dominant_topic not in lemma_of_topic:
+                lemma_of_topic[dominant_topic] = preprocess(dominant_topic)
+            keyphrase = lemma_of_topic[dominant_topic]
+        if not keyphrase.strip():
+            skipped["empty_keyphrase"] += 1
+            continue
+
+        if dedupe and keyphrase in row_of_keyphrase:
+            row = row_of_keyphrase[keyphrase]
+            document_ids[row].append(doc_id)
+        else:
+            if matrix is None:
+                matrix = _allocate(max(capacity, 1), dim, collection.name)
+            if dim != matrix.shape[1]:
+                skipped["dimension_mismatch"] += 1
+                if verbose:
+                    print(f"Skipping document {doc_id}: embedding dimension {dim} != {matrix.shape[1]}")
+                continue
+            row = len(keyphrases)
+            if row == len(matrix):
+                # Documents inserted after count_documents(); grow by half
+                matrix = _grow(matrix, len(matrix) + max(len(matrix) // 2, 1), collection.name)
+            matrix[row] = decode_embedding(embedding_data)
+            keyphrases.append(keyphrase)
+            document_ids.append([doc_id])
+            row_of_keyphrase.setdefault(keyphrase, row)
+
+        record = {"_id": doc_id, "row": row, "original_keyphrase": dominant_topic, "processed_keyphrase": keyphrase}
+        record.update({field: doc.get(field, "") for field in extra_fields})
+        documents.append(record)
+
+        if verbose and scanned % (batch_size * 10) == 0:
+            print(f"Loaded {scanned}/{capacity} documents ({len(keyphrases)} rows)")
+
+    embeddings = matrix[:len(keyphrases)] if matrix is not None else np.empty((0, 0), dtype=np.float32)
+    loaded = LoadedEmbeddings(embeddings, keyphrases, document_ids, documents, scanned, skipped, time.time() - start)
+    print(f"Loaded {len(documents)}/{scanned} documents into a {embeddings.shape} float32 matrix "
+          f"in {loaded.seconds:.1f}s (skipped: {sum(skipped.values())})")
+    return loaded
@@ -0,0 +1,43 @@
+"""Identity of the embedding model behind a stored vector.
+
+Every vector is written with an ``embedding_model`` id of the form
+``name@revision:variant`` so caches, clustering readers and incremental
+assignment never mix vectors from different models. This module has no torch
+dependency, so clustering scripts can filter on the configured model without
+loading it.
+"""
+import os
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "transformer")
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "Alibaba-NLP/gte-Qwen2-7B-instruct")
+EMBEDDING_MODEL_REVISION = os.getenv("EMBEDDING_MODEL_REVISION", "main")
+EMBEDDING_CPU_MODEL_NAME = os.getenv("EMBEDDING_CPU_MODEL_NAME", "intfloat/e5-small-v2")
+EMBEDDING_CPU_MODEL_REVISION = os.getenv("EMBEDDING_CPU_MODEL_REVISION", "main")
+EMBEDDING_CPU_QUANTIZE = os.getenv("EMBEDDING_CPU_QUANTIZE", "1") == "1"
+
+# Vectors written before embedding_model was recorded all came from this model
+LEGACY_MODEL_ID = "Alibaba-NLP/gte-Qwen2-7B-instruct@main:fp16"
+
+
+def make_model_id(model_name, revision, variant):
+    return f"{model_name}@{revision}:{variant}"
+
+
+def backend_identity(backend=EMBEDDING_BACKEND):
+    """(model name, revision, variant) for a backend name, without loading anything"""
+    if backend == "transformer":
+        return EMBEDDING_MODEL_NAME, EMBEDDING_MODEL_REVISION, "fp16"
+    if backend == "cpu":
+        return EMBEDDING_CPU_MODEL_NAME, EMBEDDING_CPU_MODEL_REVISION, "int8" if EMBEDDING_CPU_QUANTIZE else "fp32"
+    raise ValueError(f"Unknown embedding backend '{backend}'")
+
+
+def configured_model_id(backend=EMBEDDING_BACKEND):
+    return make_model_id(*backend_identity(backend))
+
+
+def embedding_model_filter(model_id):
+    """Mongo filter selecting documents whose embeddings came from ``model_id``"""
+    if model_id == LEGACY_MODEL_ID:
+        return {"embedding_model": {"$in": [model_id, None]}}
+    return {"embedding_model": model_id}
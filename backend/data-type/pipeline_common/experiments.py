@@ -0,0 +1,183 @@
+"""Columnar clustering experiment artifacts and a registry to compare them.
+
+The sweep scripts wrote each experiment as ``clusters.csv`` and
+``all_keyphrases_with_clusters.csv``, and runs were compared by reading the
+CSVs back. ``save_experiment`` writes, under the experiment folder:
+
+- ``assignments.parquet``: one row per keyphrase with its ``cluster_id``,
+  ``document_ids`` and reduced coordinates (``umap_0`` ... ``umap_<n-1>``);
+- ``clusters.parquet``: one row per cluster with its size, mean intra-cluster
+  similarity and keyphrases;
+
+compressed with EXPERIMENT_PARQUET_COMPRESSION, and appends one line to the
+registry (``registry.jsonl`` in the results folder) with the parameters, the
+input data hash, timings, scores and artifact paths. Runs reuse experiment
+folders, so the registry keeps only the latest record per folder.
+
+    python -m pipeline_common.experiments list --results clustering_results
+    python -m pipeline_common.experiments best --results clustering_results --metric silhouette_score
+
+``load_assignments`` reads a record's labels and coordinates back without
+recomputing UMAP or HDBSCAN.
+"""
+import argparse
+import json
+import math
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+EXPERIMENT_PARQUET_COMPRESSION = os.getenv("EXPERIMENT_PARQUET_COMPRESSION", "zstd")
+REGISTRY_FILE = "registry.jsonl"
+# Metrics where lower is better; everything else is maximized by ``best``
+LOWER_IS_BETTER = {"noise_percent", "seconds"}
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def save_experiment(results_dir, experiment_id, keyphrases, labels, document_ids, reduced=None,
+                    cluster_similarities=None, record=None):
+    """Write an experiment's Parquet artifacts and register it; returns the registry record.
+
+    ``document_ids[i]`` lists the documents of keyphrase i; ``record`` carries
+    the parameters, data hash, timings and scores to register.
+    """
+    # Absolute artifact paths, so records load from any working directory
+    folder = Path(results_dir).resolve() / f"exp_{experiment_id}"
+    folder.mkdir(parents=True, exist_ok=True)
+    labels = np.asarray(labels, dtype=np.int32)
+
+    assignments = pd.DataFrame({
+        "keyphrase": list(keyphrases),
+        "cluster_id": labels,
+        "document_ids": [[str(doc_id) for doc_id in ids] for ids in document_ids],
+    })
+    if reduced is not None:
+        reduced = np.asarray(reduced, dtype=np.float32)
+        for dim in range(reduced.shape[1]):
+            assignments[f"umap_{dim}"] = reduced[:, dim]
+    assignments_path = folder / "assignments.parquet"
+    assignments.to_parquet(assignments_path, index=False, compression=EXPERIMENT_PARQUET_COMPRESSION)
+
+    cluster_similarities = cluster_similarities or {}
+    clusters = assignments.groupby("cluster_id")["keyphrase"].apply(list).reset_index(name="keyphrases")
+    clusters["size"] = clusters["keyphrases"].str.len()
+    clusters["avg_similarity"] = [float(cluster_similarities.get(c, np.nan)) for c in clusters["cluster_id"]]
+    clusters_path = folder / "clusters.parquet"
+    clusters[["cluster_id", "size", "avg_similarity", "keyphrases"]].to_parquet(
+        clusters_path, index=False, compression=EXPERIMENT_PARQUET_COMPRESSION
+    )
+
+    entry = dict(record or {})
+    entry.update({
+        "experiment_id": experiment_id,
+        "registered_at": time.time(),
+        "rows": len(assignments),
+        "reduced_dims": 0 if reduced is None else int(reduced.shape[1]),
+        "artifacts": {"assignments": str(assignments_path), "clusters": str(clusters_path)},
+    })
+    entry = _jsonable(entry)
+    with open(Path(results_dir) / REGISTRY_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+    return entry
+
+
+def _resolve_artifacts(entry, results_dir):
+    """Make the artifact paths of older records, stored relative to the run's cwd, absolute"""
+    for name, artifact in entry["artifacts"].items():
+        artifact = Path(artifact)
+        if not artifact.is_absolute():
+            # <results_dir>/exp_<id>/<file>: keep the experiment folder and file name
+            artifact = Path(results_dir) / artifact.parent.name / artifact.name
+        entry["artifacts"][name] = str(artifact.resolve())
+    return entry
+
+
+def read_registry(results_dir):
+    """Registered experiments, latest record per artifact folder, oldest first"""
+    path = Path(results_dir) / REGISTRY_FILE
+    if not path.exists():
+        return []
+    latest = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = _resolve_artifacts(json.loads(line), results_dir)
+                latest[entry["artifacts"]["assignments"]] = entry
+    return sorted(latest.values(), key=lambda entry: entry["registered_at"])
+
+
+def best_experiment(results_dir, metric="silhouette_score", data_hash=None):
+    """The registered experiment with the best ``metric``, optionally for one input data hash"""
+    entries = [e for e in read_registry(results_dir)
+               if e.get(metric) is not None and (data_hash is None or e.get("data_hash") == data_hash)]
+    if not entries:
+        return None
+    pick = min if metric in LOWER_IS_BETTER else max
+    return pick(entries, key=lambda e: e[metric])
+
+
+def load_assignments(entry, columns=None):
+    return pd.read_parquet(entry["artifacts"]["assignments"], columns=columns)
+
+
+def load_clusters(entry):
+    return pd.read_parquet(entry["artifacts"]["clusters"])
+
+
+def reduced_coordinates(assignments):
+    """The ``umap_*`` columns of an assignments frame as a float32 matrix"""
+    columns = sorted((c for c in assignments.columns if c.startswith("umap_")), key=lambda c: int(c[5:]))
+    return assignments[columns].to_numpy(dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or pick registered clustering experiments")
+    parser.add_argument("command", choices=["list", "best"])
+    parser.add_argument("--results", default="clustering_results", help="results folder holding the registry")
+    parser.add_argument("--metric", default="silhouette_score")
+    parser.add_argument("--data-hash", help="only consider runs on this input data")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        entries = [e for e in read_registry(args.results) if args.data_hash in (None, e.get("data_hash"))]
+        table = pd.DataFrame([{
+            "experiment_id": e["experiment_id"],
+            "data_hash": (e.get("data_hash") or "")[:12],
+            "registered_at": time.strftime("%Y-%m-%d %H:%M", time.localtime(e["registered_at"])),
+            "num_clusters": e.get("num_clusters"),
+            "noise_percent": e.get("noise_percent"),
+            "silhouette_score": e.get("silhouette_score"),
+            "coherence_score": e.get("coherence_score"),
+            "avg_similarity": e.get("avg_similarity"),
+            "seconds": e.get("seconds"),
+        } for e in entries])
+        if table.empty:
+            print(f"No experiments registered in {args.results}")
+        else:
+            if args.metric in table:
+                table = table.sort_values(args.metric, ascending=args.metric in LOWER_IS_BETTER)
+            print(table.to_string(index=False))
+    else:
+        entry = best_experiment(args.results, args.metric, args.data_hash)
+        if entry is None:
+            print(f"No experiments with {args.metric} registered in {args.results}")
+        else:
+            print(json.dumps(entry, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Choose the number of KMeans clusters by evaluating candidate k in parallel.
+
+``select_k`` fits every candidate k at once on a loky process pool, scores each
+with the inertia elbow (KneeLocator) and the sampled silhouette, and returns
+the chosen k's already-fitted model and labels, so the scripts no longer refit
+it. At KSELECT_MINIBATCH_MIN points or more it switches to MiniBatchKMeans.
+
+    python -m pipeline_common.k_selection --embeddings reduced.npy --k-min 10 --k-max 50
+    python -m pipeline_common.k_selection --synthetic 50000 --dim 25
+
+The command line compares the engine against the sequential path the scripts
+used (full KMeans per k, full silhouette, then a refit of the chosen k):
+wall time, chosen k and agreement (ARI) of the final labels.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from kneed import KneeLocator
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from pipeline_common.cluster_metrics import sampled_silhouette
+
+KSELECT_WORKERS = int(os.getenv("KSELECT_WORKERS", str(os.cpu_count() or 1)))
+KSELECT_MINIBATCH_MIN = int(os.getenv("KSELECT_MINIBATCH_MIN", "50000"))
+KSELECT_MINIBATCH_BATCH_SIZE = int(os.getenv("KSELECT_MINIBATCH_BATCH_SIZE", "4096"))
+
+
+def _fit_k(embeddings, k, minibatch, random_state, n_init):
+    start = time.time()
+    if minibatch:
+        model = MiniBatchKMeans(n_clusters=k, random_state=random_state, n_init=3,
+                                batch_size=KSELECT_MINIBATCH_BATCH_SIZE)
+    else:
+        model = KMeans(n_clusters=k, random_state=random_state, n_init=n_init)
+    labels = model.fit_predict(embeddings)
+    silhouette = sampled_silhouette(embeddings, labels, metric="cosine")
+    return {
+        "k": k,
+        "inertia": float(model.inertia_),
+        "silhouette": silhouette["score"],
+        "silhouette_stderr": silhouette["stderr"],
+        "seconds": round(time.time() - start, 2),
+        "model": model,
+        "labels": labels,
+    }
+
+
+def elbow_k(k_values, inertia_values):
+    try:
+        return KneeLocator(k_values, inertia_values, curve="convex", direction="decreasing").elbow
+    except Exception as e:
+        print(f"Could not automatically detect optimal K: {e}")
+        return None
+
+
+def select_k(embeddings, k_values, n_jobs=KSELECT_WORKERS, minibatch=None, random_state=42, n_init=10):
+    """Fit all candidate k and pick one by elbow, falling back to the best silhouette.
+
+    Returns (chosen, results): ``chosen`` holds the fitted ``model`` and its
+    ``labels``; ``results`` is the per-k summary without models.
+    """
+    if minibatch is None:
+        minibatch = len(embeddings) >= KSELECT_MINIBATCH_MIN
+    n_jobs = max(1, min(n_jobs, len(k_values)))
+    print(f"Evaluating K in {k_values} on {n_jobs} workers ({'MiniBatchKMeans' if minibatch else 'KMeans'})...")
+    fits = Parallel(n_jobs=n_jobs, backend="loky")(
+        delayed(_fit_k)(embeddings, k, minibatch, random_state, n_init) for k in k_values
+    )
+    for fit in fits:
+        print(f"K={fit['k']}, Silhouette={fit['silhouette']:.4f} (±{fit['silhouette_stderr']:.4f}), "
+              f"inertia={fit['inertia']:.1f} ({fit['seconds']}s)")
+
+    optimal_k = elbow_k([f["k"] for f in fits], [f["inertia"] for f in fits])
+    if optimal_k is not None:
+        print(f"Automatically detected optimal K: {optimal_k}")
+    else:
+        optimal_k = max(fits, key=lambda f: f["silhouette"])["k"]
+        print(f"Using K with best silhouette score: {optimal_k}")
+
+    chosen = next(f for f in fits if f["k"] == optimal_k)
+    results = [{key: value for key, value in f.items() if key not in ("model", "labels")} for f in fits]
+    return chosen, results
+
+
+def legacy_select_k(embeddings, k_values, random_state=42, n_init=10):
+    """The scripts' original sequential path, kept for benchmarking"""
+    from sklearn.metrics import silhouette_score
+
+    results, inertia_values = [], []
+    for k in k_values:
+        kmeans = KMeans(n_clusters=k, random_state=random_state, n_init=n_init).fit(embeddings)
+        inertia_values.append(kmeans.inertia_)
+        results.append({"k": k, "silhouette": silhouette_score(embeddings, kmeans.labels_, metric="cosine")})
+    optimal_k = elbow_k(k_values, inertia_values)
+    if optimal_k is None:
+        optimal_k = max(results, key=lambda x: x["silhouette"])["k"]
+    labels = KMeans(n_clusters=optimal_k, random_state=random_state, n_init=n_init).fit_predict(embeddings)
+    return optimal_k, labels
+
+
+def main():
+    from sklearn.datasets import make_blobs
+    from sklearn.metrics import adjusted_rand_score
+
+    parser = argparse.ArgumentParser(description="Benchmark parallel k selection against the sequential path")
+    parser.add_argument("--embeddings", help=".npy matrix, e.g. a cached UMAP reduction")
+    parser.add_argument("--synthetic", type=int, default=20000, help="number of synthetic points if no matrix is given")
+    parser.add_argument("--dim", type=int, default=25)
+    parser.add_argument("--k-min", type=int, default=10)
+    parser.add_argument("--k-max", type=int, default=50)
+    parser.add_argument("--step", type=int, default=5)
+    parser.add_argument("--minibatch", choices=["auto", "yes", "no"], default="auto")
+    parser.add_argument("--skip-legacy", action="store_true", help="only time the engine")
+    parser.add_argument("--output", default="k_selection_benchmark.json")
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = np.load(args.embeddings)
+    else:
+        embeddings, _ = make_blobs(n_samples=args.synthetic, n_features=args.dim, centers=30, random_state=0)
+    k_values = list(range(args.k_min, args.k_max + 1, args.step))
+    minibatch = {"auto": None, "yes": True, "no": False}[args.minibatch]
+    report = {"n": len(embeddings), "dim": embeddings.shape[1], "k_values": k_values}
+
+    start = time.time()
+    chosen, results = select_k(embeddings, k_values, minibatch=minibatch)
+    report["engine"] = {"seconds": round(time.time() - start, 2), "k": chosen["k"], "per_k": results}
+    print(f"Engine: K={chosen['k']} in {report['engine']['seconds']}s")
+
+    if not args.skip_legacy:
+        start = time.time()
+        legacy_k, legacy_labels = legacy_select_k(embeddings, k_values)
+        report["legacy"] = {"seconds": round(time.time() - start, 2), "k": legacy_k}
+        report["speedup"] = round(report["legacy"]["seconds"] / max(report["engine"]["seconds"], 1e-9), 2)
+        report["label_agreement_ari"] = round(float(adjusted_rand_score(legacy_labels, chosen["labels"])), 4)
+        print(f"Legacy: K={legacy_k} in {report['legacy']['seconds']}s; speedup {report['speedup']}x, "
+              f"ARI {report['label_agreement_ari']}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=float)
+    print(f"Saved benchmark report to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Copy cluster and subcluster labels onto messages with server-side updates.
+
+mapping.py used to load every message, look its labels up in Python dicts and
+send one ``update_one`` per message. ``propagate_labels`` instead writes the
+keyphrase -> (subcluster label, subcluster id) mapping to a small lookup
+collection (``<LABEL_LOOKUP_PREFIX><collection>``, keyed by keyphrase) and,
+for each batch of clusters:
+
+- sets ``dominant_cluster_label`` with one pipeline ``update_many`` that
+  switches on ``kmeans_cluster_id``;
+- sets ``subcluster_label``/``subcluster_id`` with one aggregation that
+  ``$lookup``s each message's keyphrase and ``$merge``s the result back into
+  the collection (MongoDB 4.4+); ``subcluster_id`` is only written for
+  keyphrases that have one, as mapping.py did.
+
+Messages whose cluster has no dominant label still get their subcluster labels
+in a final pass. Label precedence matches the dicts built by mapping.py: a
+keyphrase listed under several subclusters keeps the last one.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+LABEL_LOOKUP_PREFIX = os.getenv("LABEL_LOOKUP_PREFIX", "label_lookup_")
+PROPAGATION_BATCH_CLUSTERS = int(os.getenv("PROPAGATION_BATCH_CLUSTERS", "25"))
+LOOKUP_INSERT_CHUNK = 5000
+
+
+def build_label_lookup(db, collection_name, keyphrase_to_label, keyphrase_to_subcluster_id):
+    """Rebuild the keyphrase lookup collection for ``collection_name`` and return it"""
+    lookup = db[f"{LABEL_LOOKUP_PREFIX}{collection_name}"]
+    lookup.drop()
+    docs = [
+        {"_id": keyphrase, "label": label, "subcluster_id": keyphrase_to_subcluster_id.get(keyphrase)}
+        for keyphrase, label in keyphrase_to_label.items() if keyphrase
+    ]
+    for offset in range(0, len(docs), LOOKUP_INSERT_CHUNK):
+        lookup.insert_many(docs[offset:offset + LOOKUP_INSERT_CHUNK], ordered=False)
+    logger.info(f"Wrote {len(docs)} keyphrase labels to lookup collection '{lookup.name}'")
+    return lookup
+
+
+def _subcluster_pipeline(match, lookup_name, collection_name):
+    return [
+        {"$match": match},
+        {"$project": {"kmeans_cluster_keyphrase": 1}},
+        {"$lookup": {"from": lookup_name, "localField": "kmeans_cluster_keyphrase",
+                     "foreignField": "_id", "as": "lookup"}},
+        {"$unwind": "$lookup"},
+        # Keyphrases without a subcluster id leave the message's subcluster_id untouched
+        {"$project": {"subcluster_label": "$lookup.label",
+                      "subcluster_id": {"$ifNull": ["$lookup.subcluster_id", "$$REMOVE"]}}},
+        {"$merge": {"into": collection_name, "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ]
+
+
+def _count_subcluster_matches(collection, match, keyphrase_to_label, keyphrase_to_subcluster_id):
+    """(messages matching a labelled keyphrase, messages whose keyphrase also has a subcluster id)"""
+    # Group by keyphrase so only the distinct keyphrases come back, not the messages
+    counts = collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$kmeans_cluster_keyphrase", "n": {"$sum": 1}}},
+    ])
+    labels = ids = 0
+    for row in counts:
+        if row["_id"] and row["_id"] in keyphrase_to_label:
+            labels += row["n"]
+            if keyphrase_to_subcluster_id.get(row["_id"]) is not None:
+                ids += row["n"]
+    return labels, ids
+
+
+def _set_subcluster_labels(collection, match, lookup_name, keyphrase_to_label, keyphrase_to_subcluster_id):
+    matched = _count_subcluster_matches(collection, match, keyphrase_to_label, keyphrase_to_subcluster_id)
+    if matched[0]:
+        collection.aggregate(_subcluster_pipeline(match, lookup_name, collection.name))
+    return matched
+
+
+def propagate_labels(db, collection_name, cluster_dominant_labels, keyphrase_to_label,
+                     keyphrase_to_subcluster_id, batch_clusters=PROPAGATION_BATCH_CLUSTERS):
+    """Label every message of ``collection_name``; returns the counts mapping.py reports.
+
+    (messages labelled, dominant cluster labels set, subcluster labels set,
+    subcluster ids set); "set" counts matched messages, including ones that
+    already carried the same label.
+    """
+    start = time.time()
+    collection = db[collection_name]
+    collection.create_index("kmeans_cluster_id")
+    lookup = build_label_lookup(db, collection_name, keyphrase_to_label, keyphrase_to_subcluster_id)
+
+    cluster_ids = list(cluster_dominant_labels)
+    dominant_updates = 0
+    subcluster_updates = 0
+    subcluster_id_updates = 0
+    for offset in range(0, len(cluster_ids), batch_clusters):
+        batch = cluster_ids[offset:offset + batch_clusters]
+        match = {"kmeans_cluster_id": {"$in": batch}}
+        result = collection.update_many(match, [{"$set": {"dominant_cluster_label": {"$switch": {
+            "branches": [{"case": {"$eq": ["$kmeans_cluster_id", cluster_id]},
+                          "then": {"$literal": cluster_dominant_labels[cluster_id]}}
+                         for cluster_id in batch],
+            "default": "$dominant_cluster_label",
+        }}}}])
+        dominant_updates += result.matched_count
+        labels_set, ids_set = _set_subcluster_labels(
+            collection, dict(match, kmeans_cluster_keyphrase={"$type": "string"}), lookup.name,
+            keyphrase_to_label, keyphrase_to_subcluster_id
+        )
+        subcluster_updates += labels_set
+        subcluster_id_updates += ids_set
+        logger.info(f"Clusters {min(offset + batch_clusters, len(cluster_ids))}/{len(cluster_ids)}: "
+                    f"{dominant_updates} dominant labels, {subcluster_updates} subcluster labels "
+                    f"({time.time() - start:.1f}s)")
+
+    # Messages outside any labelled cluster can still match a keyphrase
+    orphans, orphan_ids = _set_subcluster_labels(
+        collection, {"kmeans_cluster_id": {"$nin": cluster_ids}, "kmeans_cluster_keyphrase": {"$type": "string"}},
+        lookup.name, keyphrase_to_label, keyphrase_to_subcluster_id
+    )
+    if orphans:
+        logger.info(f"Labelled {orphans} messages outside the labelled clusters by keyphrase")
+    subcluster_updates += orphans
+    subcluster_id_updates += orphan_ids
+
+    labelled = dominant_updates + orphans
+    logger.info(f"Propagated labels to {labelled} messages of '{collection_name}' in {time.time() - start:.1f}s")
+    return labelled, dominant_updates, subcluster_updates, subcluster_id_updates
@@ -0,0 +1,129 @@
+"""Persistent cache of successful LLM responses, shared by labelling and topic extraction.
+
+Reruns after a crash or a parameter tweak used to resend prompts that had
+already succeeded. ``LLMCache`` stores each accepted response in a SQLite file
+keyed by a hash of (model, prompt template version, normalized input):
+
+- ``prompt_version(name, template)`` derives the version from the template
+  text, so editing a prompt invalidates its entries without a manual bump;
+- inputs are normalized before hashing (whitespace collapsed, JSON with sorted
+  keys for structured inputs), so cosmetic differences still hit;
+- the file is bounded to LLM_CACHE_MAX_ENTRIES rows, evicting the least
+  recently used;
+- ``bypass`` (LLM_CACHE_BYPASS=1) skips lookups but still stores the fresh
+  responses, to force a rerun against the model.
+
+Callers store a response only once they have validated it, so failures and
+rejected answers are never replayed.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+LLM_CACHE_PATH = Path(os.getenv("LLM_CACHE_PATH", Path(__file__).resolve().parent.parent / "llm_cache" / "responses.sqlite"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "200000"))
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "").lower() in ("1", "true", "yes")
+# Eviction runs after this many writes rather than on every one
+EVICT_EVERY = 500
+
+
+def prompt_version(name, template):
+    return f"{name}:{hashlib.sha1(template.encode('utf-8')).hexdigest()[:12]}"
+
+
+def normalize_input(value):
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, (list, tuple)):
+        return [normalize_input(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): normalize_input(v) for k, v in value.items()}
+    return value
+
+
+class LLMCache:
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES, bypass=LLM_CACHE_BYPASS):
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "bypassed": 0}
+        self._writes_since_evict = 0
+        # Topic extraction scripts share one cache across worker threads
+        self._lock = threading.Lock()
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, version TEXT, "
+            "response TEXT NOT NULL, created_at REAL, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def key(model, version, inputs):
+        normalized = json.dumps(normalize_input(inputs), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f"{model}\0{version}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Cached response for ``key`` (decoded from JSON), or None"""
+        if key is None:
+            return None
+        if self.bypass:
+            self.stats["bypassed"] += 1
+            return None
+        with self._lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            self.stats["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key, response, model=None, version=None):
+        if key is None:
+            return
+        now = time.time()
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, version, response, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, version, json.dumps(response, ensure_ascii=False), now, now),
+            )
+            self.stats["writes"] += 1
+            self._writes_since_evict += 1
+            if self._writes_since_evict >= EVICT_EVERY:
+                self._evict()
+            self.db.commit()
+
+    def discard(self, key):
+        if key is None:
+            return
+        with self._lock:
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.db.commit()
+
+    def _evict(self):
+        self._writes_since_evict = 0
+        excess = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            self.stats["evictions"] += excess
+
+    def report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, hit_rate=round(self.stats["hits"] / lookups, 3) if lookups else 0.0)
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,229 @@
+"""Shared pieces for labelling clusters concurrently with an LLM.
+
+- ``AsyncOllamaClient`` posts to Ollama's ``/api/generate`` over one aiohttp
+  session, at most ``concurrency`` requests in flight, retrying connection
+  errors, timeouts, 429 and 5xx responses with exponential backoff.
+- ``LabelReservations`` is the set of labels already taken. ``reserve`` checks
+  and claims a label in one step, so concurrent cluster tasks cannot both
+  accept the same label; comparisons are case-insensitive, as before.
+
+The labelling scripts run one task per cluster under a bounded semaphore and
+write the results back in bulk. With LABEL_BATCH_SIZE > 1 a task labels
+several clusters at once: ``request_batch`` sends one structured prompt for
+the whole batch, parses the JSON array answer, accepts each item locally
+(reserving its labels) and re-requests only the items that were missing or
+conflicted.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+LABEL_CONCURRENCY = int(os.getenv("LABEL_CONCURRENCY", "4"))
+LABEL_REQUEST_TIMEOUT = float(os.getenv("LABEL_REQUEST_TIMEOUT", "300"))
+LABEL_MAX_RETRIES = int(os.getenv("LABEL_MAX_RETRIES", "5"))
+# Cluster updates are flushed to Mongo in bulk every this many labelled clusters
+LABEL_WRITE_BATCH = int(os.getenv("LABEL_WRITE_BATCH", "25"))
+# Clusters per batched prompt (1 keeps one prompt per cluster) and the keyphrase budget of one prompt
+LABEL_BATCH_SIZE = int(os.getenv("LABEL_BATCH_SIZE", "1"))
+LABEL_BATCH_MAX_KEYPHRASES = int(os.getenv("LABEL_BATCH_MAX_KEYPHRASES", "300"))
+# Batched prompts per batch before unresolved clusters fall back to their own prompts
+LABEL_BATCH_ROUNDS = int(os.getenv("LABEL_BATCH_ROUNDS", "3"))
+
+
+def label_key(label):
+    return label.lower().strip()
+
+
+class LabelReservations:
+    """Case-insensitive set of used labels with an atomic check-and-claim"""
+
+    def __init__(self, labels=()):
+        self._labels = {}
+        self._lock = threading.Lock()
+        for label in labels:
+            self.add(label)
+
+    def add(self, label):
+        with self._lock:
+            self._labels.setdefault(label_key(label), label)
+
+    def discard(self, label):
+        with self._lock:
+            self._labels.pop(label_key(label), None)
+
+    def reserve(self, label):
+        """Claim ``label``; False if it (or a case variant) is already taken"""
+        key = label_key(label)
+        with self._lock:
+            if key in self._labels:
+                return False
+            self._labels[key] = label
+            return True
+
+    def reserve_all(self, labels):
+        """Claim every label or none; returns the conflicting labels (empty on success)"""
+        labels = list(labels)
+        with self._lock:
+            seen = set()
+            conflicts = []
+            for label in labels:
+                key = label_key(label)
+                if key in self._labels or key in seen:
+                    conflicts.append(label)
+                seen.add(key)
+            if not conflicts:
+                for label in labels:
+                    self._labels[label_key(label)] = label
+            return conflicts
+
+    def __contains__(self, label):
+        return label_key(label) in self._labels
+
+    def __iter__(self):
+        return iter(list(self._labels.values()))
+
+    def __len__(self):
+        return len(self._labels)
+
+
+class AsyncOllamaClient:
+    def __init__(self, host=OLLAMA_HOST, model=None, headers=None, concurrency=LABEL_CONCURRENCY,
+                 timeout=LABEL_REQUEST_TIMEOUT, max_retries=LABEL_MAX_RETRIES, options=None):
+        self.url = f"{host.rstrip('/')}/api/generate"
+        self.model = model
+        self.headers = headers or {}
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.options = options or {"num_ctx": 30000, "num_predict": -1}
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "seconds": 0.0}
+        self._semaphore = None
+        self._session = None
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers=self.headers,
+            )
+        return self._session
+
+    async def generate(self, prompt, model=None):
+        """Return Ollama's response document ({"response": ..., ...}) for ``prompt``"""
+        session = await self._get_session()
+        payload = {"model": model or self.model, "prompt": prompt, "stream": False, "options": self.options}
+        async with self._semaphore:
+            for attempt in range(1, self.max_retries + 1):
+                start = time.time()
+                try:
+                    async with session.post(self.url, json=payload) as response:
+                        if response.status == 429 or response.status >= 500:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history, status=response.status,
+                                message=await response.text()
+                            )
+                        response.raise_for_status()
+                        result = await response.json()
+                    self.stats["requests"] += 1
+                    self.stats["seconds"] += time.time() - start
+                    return result
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status = getattr(e, "status", None)
+                    if (status is not None and status < 500 and status != 429) or attempt == self.max_retries:
+                        self.stats["failures"] += 1
+                        logger.error(f"Ollama request failed after {attempt} attempt(s): {e!r}")
+                        raise
+                    wait = min(60, 2 ** attempt)
+                    self.stats["retries"] += 1
+                    logger.info(f"Ollama request failed ({e!r}), retrying in {wait} seconds... "
+                                f"(Attempt {attempt}/{self.max_retries})")
+                    await asyncio.sleep(wait)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def report(self):
+        return dict(self.stats, seconds=round(self.stats["seconds"], 1))
+
+
+def label_batches(items, batch_size=LABEL_BATCH_SIZE, max_keyphrases=LABEL_BATCH_MAX_KEYPHRASES):
+    """Group (cluster_id, keyphrases) pairs into batches of at most ``batch_size`` clusters
+    and, unless a single cluster exceeds it alone, ``max_keyphrases`` keyphrases"""
+    batch, size = [], 0
+    for cluster_id, keyphrases in items:
+        if batch and (len(batch) >= batch_size or size + len(keyphrases) > max_keyphrases):
+            yield batch
+            batch, size = [], 0
+        batch.append((cluster_id, keyphrases))
+        size += len(keyphrases)
+    if batch:
+        yield batch
+
+
+def parse_json_array(text):
+    """The JSON array in an LLM answer (code fences and surrounding prose allowed), or []"""
+    fenced = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", text)
+    if fenced:
+        text = fenced.group(1)
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end <= start:
+        return []
+    candidate = text[start:end + 1]
+    for attempt in (candidate, re.sub(r",\s*([}\]])", r"\1", candidate)):
+        try:
+            parsed = json.loads(attempt)
+            return parsed if isinstance(parsed, list) else []
+        except json.JSONDecodeError:
+            continue
+    logger.warning(f"Could not parse JSON array from response: {text[:200]!r}")
+    return []
+
+
+async def request_batch(items, build_prompt, generate, accept, max_rounds=LABEL_BATCH_ROUNDS):
+    """Label ``items`` ({item_id: payload}) with batched prompts.
+
+    ``build_prompt(pending, rejected)`` formats one prompt for the pending
+    items, listing labels rejected so far; ``generate(prompt)`` returns the
+    answer text, a JSON array of objects carrying the item's ``id``;
+    ``accept(item_id, entry)`` returns ``(result, rejected_labels)``, with
+    ``result`` None when the entry is unusable or its labels are taken.
+    Returns ({item_id: result}, {item_id: payload} still unresolved, requests sent).
+    """
+    pending = dict(items)
+    results = {}
+    rejected = []
+    requests = 0
+    for round_number in range(1, max_rounds + 1):
+        if not pending:
+            break
+        try:
+            requests += 1
+            entries = parse_json_array(await generate(build_prompt(pending, rejected)))
+        except Exception as e:
+            logger.error(f"Batch request failed (round {round_number}): {e}")
+            continue
+        for entry in entries:
+            if not isinstance(entry, dict) or str(entry.get("id")) not in pending:
+                continue
+            item_id = str(entry["id"])
+            result, rejected_labels = accept(item_id, entry)
+            if result is None:
+                rejected.extend(label for label in rejected_labels if label)
+                continue
+            results[item_id] = result
+            del pending[item_id]
+        if pending:
+            logger.info(f"Batch round {round_number}: {len(results)} labelled, re-requesting {len(pending)}")
+    return results, pending, requests
@@ -0,0 +1,90 @@
+"""Migrate stored embeddings from BSON double arrays to the binary format.
+
+    python -m pipeline_common.migrate_embeddings --collections emailmessages chat-chunks
+    python -m pipeline_common.migrate_embeddings --dtype float16 --dry-run
+
+Only documents whose field is still an array are touched, and each update is
+conditional on that, so the migration can be interrupted and re-run, and can
+run while embedding scripts write new (already binary) vectors.
+"""
+import argparse
+import os
+import time
+
+import bson
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from pipeline_common.embedding_codec import EMBEDDING_DTYPE_CODES, EMBEDDING_STORAGE_DTYPE, encode_embedding
+from pipeline_common.mongo_bulk import BULK_CHUNK_SIZE, bulk_write_chunked
+
+DEFAULT_COLLECTIONS = ["emailmessages", "chat-chunks", "tickets", "twitter", "voice"]
+
+
+def migrate_collection(collection, field="embeddings", dtype=EMBEDDING_STORAGE_DTYPE,
+                       batch_size=BULK_CHUNK_SIZE, dry_run=False):
+    query = {field: {"$type": "array"}}
+    pending = collection.count_documents(query)
+    print(f"{collection.name}: {pending} documents with array '{field}'")
+    stats = {"collection": collection.name, "pending": pending, "migrated": 0,
+             "failed": 0, "bytes_before": 0, "bytes_after": 0, "seconds": 0.0}
+    if pending == 0:
+        return stats
+
+    start = time.time()
+    operations = []
+
+    def flush():
+        if dry_run or not operations:
+            operations.clear()
+            return
+        result = bulk_write_chunked(collection, operations, chunk_size=batch_size, label=f"{collection.name} migration", verbose=False)
+        stats["migrated"] += result["modified"]
+        stats["failed"] += result["failed_operations"]
+        operations.clear()
+
+    for doc in collection.find(query, {field: 1}).batch_size(batch_size):
+        values = doc.get(field)
+        if not values:
+            continue
+        encoded = encode_embedding(values, dtype=dtype)
+        stats["bytes_before"] += len(bson.encode({field: values}))
+        stats["bytes_after"] += len(bson.encode({field: encoded}))
+        operations.append(UpdateOne({"_id": doc["_id"], field: {"$type": "array"}}, {"$set": {field: encoded}}))
+        if len(operations) >= batch_size:
+            flush()
+            print(f"{collection.name}: {stats['migrated']}/{pending} migrated")
+    flush()
+
+    stats["seconds"] = round(time.time() - start, 1)
+    ratio = stats["bytes_before"] / stats["bytes_after"] if stats["bytes_after"] else 0
+    action = "would migrate" if dry_run else "migrated"
+    print(f"{collection.name}: {action} {pending if dry_run else stats['migrated']} documents, "
+          f"{stats['failed']} failed, field size {stats['bytes_before'] / 1e6:.1f} MB -> "
+          f"{stats['bytes_after'] / 1e6:.1f} MB ({ratio:.1f}x smaller) in {stats['seconds']}s")
+    return stats
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Convert array embeddings to packed binary embeddings")
+    parser.add_argument("--collections", nargs="+", default=DEFAULT_COLLECTIONS)
+    parser.add_argument("--field", default="embeddings")
+    parser.add_argument("--dtype", choices=sorted(EMBEDDING_DTYPE_CODES), default=EMBEDDING_STORAGE_DTYPE)
+    parser.add_argument("--batch-size", type=int, default=BULK_CHUNK_SIZE)
+    parser.add_argument("--db", default="sparzaai")
+    parser.add_argument("--dry-run", action="store_true", help="Report sizes without writing")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_CONNECTION_STRING"))
+    try:
+        db = client[args.db]
+        for name in args.collections:
+            migrate_collection(db[name], field=args.field, dtype=args.dtype,
+                               batch_size=args.batch_size, dry_run=args.dry_run)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Chunked unordered bulk writes with per-chunk failure accounting.
+
+Clustering scripts used to issue one ``update_one`` per document. Sending the
+operations as unordered ``bulk_write`` chunks costs one round trip per chunk,
+and a failing chunk (or document) is counted and reported without stopping the
+rest of the write-back.
+"""
+import os
+import time
+
+from pymongo.errors import BulkWriteError
+
+BULK_CHUNK_SIZE = int(os.getenv("MONGO_BULK_CHUNK_SIZE", "200"))
+
+
+def bulk_write_chunked(collection, operations, chunk_size=BULK_CHUNK_SIZE, label="bulk write", verbose=True):
+    """Send ``operations`` in unordered chunks and return throughput and failure stats"""
+    stats = {
+        "operations": len(operations),
+        "chunks": 0,
+        "matched": 0,
+        "modified": 0,
+        "upserted": 0,
+        "failed_chunks": 0,
+        "failed_operations": 0,
+        "errors": [],
+        "seconds": 0.0,
+        "ops_per_sec": 0.0,
+    }
+    if not operations:
+        return stats
+
+    start = time.time()
+    for offset in range(0, len(operations), chunk_size):
+        chunk = operations[offset:offset + chunk_size]
+        stats["chunks"] += 1
+        try:
+            result = collection.bulk_write(chunk, ordered=False)
+            stats["matched"] += result.matched_count
+            stats["modified"] += result.modified_count
+            stats["upserted"] += result.upserted_count
+        except BulkWriteError as e:
+            # Unordered: everything except the reported write errors was applied
+            details = e.details
+            write_errors = details.get("writeErrors", [])
+            stats["matched"] += details.get("nMatched", 0)
+            stats["modified"] += details.get("nModified", 0)
+            stats["upserted"] += details.get("nUpserted", 0)
+            stats["failed_chunks"] += 1
+            stats["failed_operations"] += len(write_errors)
+            stats["errors"].append({"chunk": stats["chunks"], "write_errors": len(write_errors),
+                                    "first_error": write_errors[0].get("errmsg") if write_errors else None})
+            print(f"{label}: chunk {stats['chunks']} had {len(write_errors)} failed operations")
+        except Exception as e:
+            stats["failed_chunks"] += 1
+            stats["failed_operations"] += len(chunk)
+            stats["errors"].append({"chunk": stats["chunks"], "write_errors": len(chunk), "first_error": str(e)})
+            print(f"{label}: chunk {stats['chunks']} failed entirely: {e}")
+
+    stats["seconds"] = round(time.time() - start, 3)
+    stats["ops_per_sec"] = round(len(operations) / stats["seconds"], 1) if stats["seconds"] > 0 else 0.0
+    if verbose:
+        print(f"{label}: {stats['operations']} operations in {stats['chunks']} chunks, "
+              f"{stats['matched']} matched, {stats['failed_operations']} failed, "
+              f"{stats['seconds']:.2f}s ({stats['ops_per_sec']:.0f} ops/sec)")
+    return stats
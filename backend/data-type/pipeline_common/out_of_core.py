@@ -0,0 +1,494 @@
+"""Out-of-core KMeans clustering for collections larger than RAM.
+
+The KMeans scripts hold every embedding and document record in memory, UMAP
+the whole matrix and send one update per document, so a million-document
+channel needs more memory than a batch node has. With CLUSTERING_OUT_OF_CORE
+set to ``on`` (or ``auto``, from OOC_AUTO_MIN_DOCUMENTS matching documents)
+``cluster_out_of_core`` instead:
+
+- streams the normalized embeddings into a disk-backed memmap under
+  OOC_WORK_DIR, keeping per document only its id, a keyphrase code, one
+  code per extra field and later its label (about 24 bytes);
+- fits IncrementalPCA to OOC_PCA_COMPONENTS dimensions chunk by chunk and
+  writes the projection to a second memmap (UMAP needs the whole matrix in
+  memory, so this mode skips it);
+- fits MiniBatchKMeans for every candidate k with ``partial_fit`` over
+  OOC_KMEANS_EPOCHS shuffled passes, picks k by the inertia elbow (falling
+  back to the sampled silhouette, as ``select_k`` does) and assigns labels
+  chunk by chunk.
+
+Chunks are sized so that a chunk and its working copies fit in
+OOC_MEMORY_MB. ``write_assignments`` streams the labels back as unordered
+bulk chunks of OOC_WRITE_CHUNK operations; the scripts use it in both modes.
+
+    python -m pipeline_common.out_of_core --rows 1000000 --dim 256 --clusters 40 --memory-mb 512
+
+clusters a synthetic memmap and reports time, peak RSS and agreement (ARI)
+with the true clusters.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from pipeline_common.cluster_metrics import SILHOUETTE_SAMPLE_SIZE, sampled_silhouette
+from pipeline_common.cluster_model import close_recluster_requests
+from pipeline_common.embedding_codec import decode_embedding, embedding_dimension
+from pipeline_common.embedding_loader import LOADER_BATCH_SIZE, LOADER_MEMMAP_DIR, warmed
+from pipeline_common.k_selection import KSELECT_MINIBATCH_BATCH_SIZE, elbow_k
+from pipeline_common.mongo_bulk import bulk_write_chunked
+
+OUT_OF_CORE = os.getenv("CLUSTERING_OUT_OF_CORE", "off")
+OOC_AUTO_MIN_DOCUMENTS = int(os.getenv("OOC_AUTO_MIN_DOCUMENTS", "500000"))
+OOC_MEMORY_MB = int(os.getenv("OOC_MEMORY_MB", "1024"))
+OOC_PCA_COMPONENTS = int(os.getenv("OOC_PCA_COMPONENTS", "50"))
+OOC_KMEANS_EPOCHS = int(os.getenv("OOC_KMEANS_EPOCHS", "3"))
+OOC_WORK_DIR = os.getenv("OOC_WORK_DIR", LOADER_MEMMAP_DIR)
+OOC_WRITE_CHUNK = int(os.getenv("OOC_WRITE_CHUNK", "5000"))
+# Copies of a chunk alive at once while fitting (slice, centered copy, SVD workspace, projection)
+CHUNK_COPIES = 4
+
+
+def use_out_of_core(collection, query, mode=OUT_OF_CORE):
+    """Whether to cluster ``query``'s documents out of core under ``mode`` (off, on or auto)"""
+    if mode not in ("off", "on", "auto"):
+        raise ValueError(f"Unknown CLUSTERING_OUT_OF_CORE '{mode}', expected off, on or auto")
+    if mode != "auto":
+        return mode == "on"
+    count = collection.count_documents(query)
+    print(f"{count} documents to cluster; out-of-core mode from {OOC_AUTO_MIN_DOCUMENTS}")
+    return count >= OOC_AUTO_MIN_DOCUMENTS
+
+
+def chunk_rows(dim, memory_mb=OOC_MEMORY_MB, min_rows=1):
+    """Rows per chunk so that CHUNK_COPIES float32 copies of a chunk fit in ``memory_mb``"""
+    return max(min_rows, int(memory_mb * 1024 * 1024 // (dim * 4 * CHUNK_COPIES)))
+
+
+def _chunks(n, rows, min_last=1):
+    """(start, stop) ranges of ``rows`` rows; a tail shorter than ``min_last`` joins the previous range"""
+    bounds = list(range(0, n, rows)) + [n]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    if len(ranges) > 1 and ranges[-1][1] - ranges[-1][0] < min_last:
+        ranges[-2:] = [(ranges[-2][0], n)]
+    return ranges
+
+
+class _Codes:
+    """A column of repeated strings stored as int32 codes into a table of values"""
+
+    def __init__(self, capacity):
+        self.values = []
+        self.codes = np.empty(capacity, dtype=np.int32)
+        self._index = {}
+
+    def set(self, row, value):
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        self.codes[row] = code
+
+    def __getitem__(self, row):
+        return self.values[self.codes[row]]
+
+
+class _Ids:
+    """Document ids, as 12 raw bytes each while they are all ObjectIds"""
+
+    def __init__(self, capacity):
+        self._raw = np.zeros((capacity, 12), dtype=np.uint8)
+        self._objects = None
+
+    def set(self, row, doc_id):
+        if self._objects is None and isinstance(doc_id, ObjectId):
+            self._raw[row] = np.frombuffer(doc_id.binary, dtype=np.uint8)
+            return
+        if self._objects is None:
+            self._objects = [self[i] for i in range(row)]
+            self._raw = None
+        self._objects.append(doc_id)
+
+    def __getitem__(self, row):
+        if self._objects is not None:
+            return self._objects[row]
+        return ObjectId(self._raw[row].tobytes())
+
+
+class _Documents:
+    """Per-document records shaped like ``LoadedEmbeddings.documents``, built on access"""
+
+    def __init__(self, ids, keyphrases, fields, rows):
+        self._ids = ids
+        self._keyphrases = keyphrases
+        self._fields = fields
+        self._rows = rows
+
+    def __len__(self):
+        return self._rows
+
+    def __getitem__(self, row):
+        record = {"_id": self._ids[row], "row": row, "processed_keyphrase": self._keyphrases[row]}
+        record.update({field: column[row] for field, column in self._fields.items()})
+        return record
+
+    def __iter__(self):
+        return (self[row] for row in range(self._rows))
+
+
+def stream_embeddings(collection, query, preprocess, path, extra_fields=(), skip_topics=(),
+                      batch_size=LOADER_BATCH_SIZE):
+    """Stream normalized embeddings of ``query``'s documents into a memmap at ``path``.
+
+    Skips documents like ``load_keyphrase_embeddings``; documents inserted
+    after the initial count are left for the next run. Returns (matrix, ids,
+    keyphrases, fields, scanned, skipped) with ``fields`` a code column per
+    extra field.
+    """
+    capacity = collection.count_documents(query)
+    projection = {"_id": 1, "dominant_topic": 1, "dominant_topic_lemma": 1, "embeddings": 1,
+                  **{field: 1 for field in extra_fields}}
+    skip_topics = {topic.lower() for topic in skip_topics}
+    ids, keyphrases = _Ids(capacity), _Codes(capacity)
+    fields = {field: _Codes(capacity) for field in extra_fields}
+    skipped = {"invalid_topic": 0, "empty_embedding": 0, "skipped_topic": 0,
+               "empty_keyphrase": 0, "dimension_mismatch": 0, "inserted_after_count": 0}
+    matrix, rows, scanned = None, 0, 0
+
+    for doc in warmed(collection.find(query, projection).batch_size(batch_size), preprocess, batch_size):
+        scanned += 1
+        dominant_topic = doc.get("dominant_topic", "")
+        if not dominant_topic or not isinstance(dominant_topic, str) or not dominant_topic.strip():
+            skipped["invalid_topic"] += 1
+            continue
+        if dominant_topic.strip().lower() in skip_topics:
+            skipped["skipped_topic"] += 1
+            continue
+        dim = embedding_dimension(doc.get("embeddings"))
+        if not dim:
+            skipped["empty_embedding"] += 1
+            continue
+        stored_lemma = doc.get("dominant_topic_lemma")
+        keyphrase = stored_lemma if isinstance(stored_lemma, str) else preprocess(dominant_topic)
+        if not keyphrase.strip():
+            skipped["empty_keyphrase"] += 1
+            continue
+        if matrix is None:
+            print(f"Allocating {capacity}x{dim} embedding memmap at {path}")
+            matrix = np.memmap(path, dtype=np.float32, mode="w+", shape=(max(capacity, 1), dim))
+        if dim != matrix.shape[1]:
+            skipped["dimension_mismatch"] += 1
+            continue
+        if rows == capacity:
+            skipped["inserted_after_count"] += 1
+            continue
+
+        vector = decode_embedding(doc["embeddings"]).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        matrix[rows] = vector / norm if norm > 0 else vector
+        ids.set(rows, doc["_id"])
+        keyphrases.set(rows, keyphrase)
+        for field, column in fields.items():
+            column.set(rows, doc.get(field, ""))
+        rows += 1
+        if scanned % (batch_size * 50) == 0:
+            print(f"Streamed {scanned}/{capacity} documents ({rows} rows)")
+
+    if matrix is not None:
+        matrix.flush()
+    matrix = matrix[:rows] if matrix is not None else np.empty((0, 0), dtype=np.float32)
+    return matrix, ids, keyphrases, fields, scanned, skipped
+
+
+def fit_pca(matrix, n_components, rows):
+    from sklearn.decomposition import IncrementalPCA
+
+    pca = IncrementalPCA(n_components=n_components)
+    for start, stop in _chunks(len(matrix), max(rows, n_components), n_components):
+        pca.partial_fit(matrix[start:stop])
+    return pca
+
+
+def project(matrix, pca, rows, path):
+    """Write ``pca.transform(matrix)`` chunk by chunk to a memmap at ``path``"""
+    projected = np.memmap(path, dtype=np.float32, mode="w+", shape=(len(matrix), pca.n_components_))
+    for start, stop in _chunks(len(matrix), rows):
+        projected[start:stop] = pca.transform(matrix[start:stop])
+    projected.flush()
+    return projected
+
+
+def _fit_minibatch_k(projected, k, rows, epochs, seed, sample):
+    from sklearn.cluster import MiniBatchKMeans
+
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    ranges = _chunks(len(projected), rows)
+    batch_size = max(KSELECT_MINIBATCH_BATCH_SIZE, 3 * k)
+    model = MiniBatchKMeans(n_clusters=k, random_state=seed, n_init=3, batch_size=batch_size)
+    # Initialize the centers from a random sample rather than the first batch
+    init_rows = np.sort(rng.choice(len(projected), size=min(len(projected), rows, 20 * batch_size), replace=False))
+    model.partial_fit(projected[init_rows])
+    for _ in range(epochs):
+        for i in rng.permutation(len(ranges)):
+            chunk = np.asarray(projected[ranges[i][0]:ranges[i][1]])[rng.permutation(ranges[i][1] - ranges[i][0])]
+            for offset in range(0, len(chunk), batch_size):
+                batch = chunk[offset:offset + batch_size]
+                if len(batch) >= k:
+                    model.partial_fit(batch)
+
+    inertia = sum(-model.score(projected[a:b]) for a, b in ranges)
+    silhouette = sampled_silhouette(sample, model.predict(sample), metric="cosine")
+    return {
+        "k": k,
+        "inertia": float(inertia),
+        "silhouette": silhouette["score"],
+        "silhouette_stderr": silhouette["stderr"],
+        "seconds": round(time.time() - start, 2),
+        "model": model,
+    }
+
+
+def assign_labels(projected, model, rows):
+    labels = np.empty(len(projected), dtype=np.int32)
+    for start, stop in _chunks(len(projected), rows):
+        labels[start:stop] = model.predict(projected[start:stop])
+    return labels
+
+
+def cluster_matrix(matrix, k_values, work_path, memory_mb=OOC_MEMORY_MB, n_components=OOC_PCA_COMPONENTS,
+                   epochs=OOC_KMEANS_EPOCHS, seed=42):
+    """Reduce a (memmapped) matrix with IncrementalPCA and cluster it with MiniBatchKMeans in chunks.
+
+    The projection is written to ``work_path``. Returns (labels, chosen,
+    results) like ``select_k``, with ``chosen`` also holding the sampled
+    silhouette of the final labels and the PCA's explained variance.
+    """
+    from sklearn import config_context
+
+    n_components = min(n_components, matrix.shape[1], len(matrix))
+    rows = chunk_rows(matrix.shape[1], memory_mb, n_components)
+    start = time.time()
+    pca = fit_pca(matrix, n_components, rows)
+    explained_variance = round(float(pca.explained_variance_ratio_.sum()), 4)
+    print(f"IncrementalPCA {matrix.shape[1]} -> {n_components} dimensions in {time.time() - start:.1f}s "
+          f"({explained_variance * 100:.1f}% variance kept, {rows} rows per chunk)")
+    projected = project(matrix, pca, rows, work_path)
+
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(projected[np.sort(rng.choice(len(projected), min(len(projected), SILHOUETTE_SAMPLE_SIZE),
+                                                     replace=False))])
+    projected_rows = chunk_rows(n_components, memory_mb)
+    k_values = [k for k in k_values if k < len(projected)]
+    print(f"Evaluating K in {k_values} with MiniBatchKMeans over {epochs} streamed epochs...")
+    fits = []
+    # Silhouette's pairwise distance blocks default to 1 GB of working memory
+    with config_context(working_memory=memory_mb):
+        for k in k_values:
+            fit = _fit_minibatch_k(projected, k, projected_rows, epochs, seed, sample)
+            print(f"K={fit['k']}, Silhouette={fit['silhouette']:.4f} (±{fit['silhouette_stderr']:.4f}), "
+                  f"inertia={fit['inertia']:.1f} ({fit['seconds']}s)")
+            fits.append(fit)
+
+    optimal_k = elbow_k([f["k"] for f in fits], [f["inertia"] for f in fits])
+    if optimal_k is not None:
+        print(f"Automatically detected optimal K: {optimal_k}")
+    else:
+        optimal_k = max(fits, key=lambda f: f["silhouette"])["k"]
+        print(f"Using K with best silhouette score: {optimal_k}")
+    chosen = next(f for f in fits if f["k"] == optimal_k)
+    labels = assign_labels(projected, chosen["model"], projected_rows)
+    with config_context(working_memory=memory_mb):
+        chosen["final_silhouette"] = sampled_silhouette(projected, labels, metric="cosine")
+    chosen["explained_variance"] = explained_variance
+    results = [{key: value for key, value in f.items() if key != "model"} for f in fits]
+    return labels, chosen, results
+
+
+class OutOfCoreClustering:
+    """Labels of the streamed documents; ``documents`` yields their records in label order"""
+
+    def __init__(self, ids, keyphrases, fields, labels, chosen, results, scanned, skipped, seconds):
+        self.labels = labels
+        self.k = chosen["k"]
+        self.silhouette = chosen["final_silhouette"]["score"]
+        self.explained_variance = chosen["explained_variance"]
+        self.results = results
+        self.scanned = scanned
+        self.skipped = skipped
+        self.seconds = seconds
+        self._keyphrase_column = keyphrases
+        self.documents = _Documents(ids, keyphrases, fields, len(labels))
+
+    @property
+    def rows(self):
+        return len(self.labels)
+
+    @property
+    def keyphrases(self):
+        """Distinct keyphrases of the clustered documents"""
+        return self._keyphrase_column.values
+
+    def summary(self):
+        return {
+            "documents_scanned": self.scanned,
+            "rows": self.rows,
+            "distinct_keyphrases": len(self.keyphrases),
+            "skipped": self.skipped,
+            "k": self.k,
+            "silhouette": self.silhouette,
+            "explained_variance": self.explained_variance,
+            "seconds": round(self.seconds, 1),
+        }
+
+
+def cluster_out_of_core(collection, query, preprocess, k_values, extra_fields=(), skip_topics=(),
+                        memory_mb=OOC_MEMORY_MB, n_components=OOC_PCA_COMPONENTS, epochs=OOC_KMEANS_EPOCHS,
+                        work_dir=OOC_WORK_DIR, seed=42):
+    """Stream, reduce and KMeans-cluster ``query``'s documents within ``memory_mb`` of working memory.
+
+    Returns an ``OutOfCoreClustering``, or None if no document qualifies. The
+    memmaps under ``work_dir`` are removed afterwards.
+    """
+    start = time.time()
+    matrix_path = os.path.join(work_dir, f"{collection.name}_ooc_{os.getpid()}.f32")
+    projected_path = os.path.join(work_dir, f"{collection.name}_ooc_pca_{os.getpid()}.f32")
+    try:
+        matrix, ids, keyphrases, fields, scanned, skipped = stream_embeddings(
+            collection, query, preprocess, matrix_path, extra_fields, skip_topics)
+        print(f"Streamed {len(matrix)}/{scanned} documents into a {matrix.shape} memmap "
+              f"in {time.time() - start:.1f}s (skipped: {sum(skipped.values())})")
+        if len(matrix) == 0:
+            return None
+        labels, chosen, results = cluster_matrix(matrix, k_values, projected_path, memory_mb, n_components,
+                                                 epochs, seed)
+        del matrix
+    finally:
+        for path in (matrix_path, projected_path):
+            if os.path.exists(path):
+                os.remove(path)
+    clustered = OutOfCoreClustering(ids, keyphrases, fields, labels, chosen, results, scanned, skipped,
+                                    time.time() - start)
+    print(f"Out-of-core clustering: {clustered.summary()}")
+    return clustered
+
+
+def write_assignments(collection, documents, labels, offset=0, chunk_size=OOC_WRITE_CHUNK,
+                      label="K-means write-back"):
+    """Write each document's K-means cluster (label + ``offset``) back in unordered bulk chunks.
+
+    ``documents`` yields records with ``_id`` and ``processed_keyphrase``
+    (``LoadedEmbeddings.documents`` or ``OutOfCoreClustering.documents``);
+    at most ``chunk_size`` operations are held at once. Open reclustering
+    requests for the collection are marked done afterwards. Returns totals
+    of the ``bulk_write_chunked`` stats.
+    """
+    totals = {"operations": 0, "matched": 0, "modified": 0, "failed_operations": 0, "seconds": 0.0}
+    operations = []
+
+    def flush():
+        stats = bulk_write_chunked(collection, operations, label=label, verbose=False)
+        for key in totals:
+            totals[key] += stats[key]
+        operations.clear()
+
+    for doc_data, cluster_id in zip(documents, labels):
+        operations.append(UpdateOne({"_id": doc_data["_id"]}, {
+            "$set": {
+                "kmeans_cluster_id": int(cluster_id) + offset,
+                "kmeans_cluster_keyphrase": doc_data["processed_keyphrase"],
+                "clustering_method": "kmeans",
+                "clustering_updated_at": time.time(),
+            },
+            # A full reclustering empties the incremental assigner's pending pool
+            "$unset": {"clustering_pending": "", "clustering_candidate": ""},
+        }))
+        if len(operations) >= chunk_size:
+            flush()
+            print(f"{label}: {totals['operations']} documents written")
+    if operations:
+        flush()
+    print(f"{label}: {totals['operations']} operations, {totals['matched']} matched, "
+          f"{totals['failed_operations']} failed in {totals['seconds']:.2f}s")
+    # The pending pool is empty again, so any open reclustering request has been served
+    closed = close_recluster_requests(collection.database, collection.name)
+    if closed:
+        print(f"{label}: closed {closed} reclustering request(s)")
+    return totals
+
+
+def _synthetic_memmap(path, rows, dim, n_clusters, seed, memory_mb):
+    """Normalized points around random unit centers, written chunk by chunk; returns (matrix, labels)"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    labels = rng.integers(0, n_clusters, size=rows).astype(np.int32)
+    matrix = np.memmap(path, dtype=np.float32, mode="w+", shape=(rows, dim))
+    for start, stop in _chunks(rows, chunk_rows(dim, memory_mb)):
+        points = centers[labels[start:stop]] + rng.normal(scale=0.6 / np.sqrt(dim), size=(stop - start, dim))
+        matrix[start:stop] = points / np.linalg.norm(points, axis=1, keepdims=True)
+    matrix.flush()
+    return matrix, labels
+
+
+def main():
+    from sklearn.metrics import adjusted_rand_score
+
+    from pipeline_common.benchmark_pipeline import PeakRSS
+
+    parser = argparse.ArgumentParser(description="Benchmark out-of-core clustering on a synthetic memmap")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=40)
+    parser.add_argument("--k-values", type=int, nargs="+", help="KMeans candidates (default: around --clusters)")
+    parser.add_argument("--memory-mb", type=int, default=OOC_MEMORY_MB)
+    parser.add_argument("--pca-components", type=int, default=OOC_PCA_COMPONENTS)
+    parser.add_argument("--epochs", type=int, default=OOC_KMEANS_EPOCHS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="out_of_core_benchmark.json")
+    args = parser.parse_args()
+
+    k_values = args.k_values or sorted({max(2, args.clusters + step) for step in (-10, -5, 0, 5, 10)})
+    work_dir = tempfile.mkdtemp(prefix="out_of_core_", dir=OOC_WORK_DIR)
+    try:
+        matrix, truth = _synthetic_memmap(os.path.join(work_dir, "matrix.f32"), args.rows, args.dim, args.clusters,
+                                          args.seed, args.memory_mb)
+        start = time.time()
+        with PeakRSS() as rss:
+            labels, chosen, results = cluster_matrix(matrix, k_values, os.path.join(work_dir, "projected.f32"),
+                                                     args.memory_mb, args.pca_components, args.epochs, args.seed)
+        report = {
+            "rows": args.rows,
+            "dim": args.dim,
+            "true_clusters": args.clusters,
+            "memory_mb": args.memory_mb,
+            "matrix_mb": round(matrix.nbytes / 1e6, 1),
+            "seconds": round(time.time() - start, 2),
+            "peak_rss_mb": round(rss.peak / 1e6, 1),
+            "rss_growth_mb": round((rss.peak - rss.start) / 1e6, 1),
+            "k": chosen["k"],
+            "silhouette": chosen["final_silhouette"]["score"],
+            "explained_variance": chosen["explained_variance"],
+            "ari_vs_truth": round(float(adjusted_rand_score(truth, labels)), 4),
+            "per_k": results,
+        }
+    finally:
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+
+    print(f"Clustered {args.rows}x{args.dim} in {report['seconds']}s: K={report['k']}, "
+          f"ARI {report['ari_vs_truth']}, peak RSS {report['peak_rss_mb']} MB "
+          f"(+{report['rss_growth_mb']} MB, matrix {report['matrix_mb']} MB)")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=float)
+    print(f"Saved benchmark report to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
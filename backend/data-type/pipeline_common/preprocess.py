@@ -0,0 +1,131 @@
+"""Batched spaCy lemmatization with a persistent lemma cache.
+
+Every embedding and clustering script lemmatizes the same dominant_topic
+strings with one ``nlp(text)`` call per document. ``Lemmatizer`` keeps the
+same output (lower-cased, stop words and punctuation dropped, lemmas joined
+by spaces) but:
+
+- looks texts up in a SQLite cache shared by all scripts and reruns, keyed by
+  a hash of the text and the spaCy model/version;
+- runs only the misses through ``nlp.pipe`` in batches, with the parser,
+  NER and sentence segmenter excluded and several processes for large
+  batches (only where the fork start method is available, since these
+  scripts have no ``__main__`` guard).
+
+``warm(texts)`` lemmatizes a whole batch up front; calling the lemmatizer on a
+single text afterwards is a dictionary lookup.
+"""
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+LEMMA_CACHE_PATH = Path(os.getenv("LEMMA_CACHE_PATH", Path(__file__).resolve().parent.parent / "lemma_cache" / "lemmas.sqlite"))
+SPACY_MODEL = os.getenv("SPACY_MODEL", "en_core_web_sm")
+SPACY_BATCH_SIZE = int(os.getenv("SPACY_BATCH_SIZE", "1000"))
+SPACY_N_PROCESS = int(os.getenv("SPACY_N_PROCESS", str(min(4, os.cpu_count() or 1))))
+# Below this many misses, worker start-up costs more than it saves
+SPACY_PARALLEL_MIN = int(os.getenv("SPACY_PARALLEL_MIN", "5000"))
+# The lemmatizer needs tok2vec, tagger and attribute_ruler; nothing else
+SPACY_EXCLUDE = ["parser", "ner", "senter"]
+# SQLite's default limit on bound parameters is 999
+SQLITE_BATCH = 900
+
+
+def lemma_text(doc):
+    return " ".join(token.lemma_ for token in doc if not token.is_stop and not token.is_punct)
+
+
+class Lemmatizer:
+    def __init__(self, model=SPACY_MODEL, cache_path=LEMMA_CACHE_PATH, batch_size=SPACY_BATCH_SIZE,
+                 n_process=SPACY_N_PROCESS):
+        self.model = model
+        self.batch_size = batch_size
+        self.n_process = n_process if multiprocessing.get_start_method() == "fork" else 1
+        self.memo = {}
+        self.stats = {"texts": 0, "memory_hits": 0, "cache_hits": 0, "lemmatized": 0, "seconds": 0.0}
+        self._nlp = None
+        self.version = self._model_version()
+        cache_path = Path(cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(cache_path), timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lemmas (key TEXT PRIMARY KEY, lemma TEXT NOT NULL)")
+        self.db.commit()
+
+    def _model_version(self):
+        # Package version without loading the pipeline, so cache hits never load spaCy
+        try:
+            from importlib.metadata import version
+            return version(self.model)
+        except Exception:
+            return "unknown"
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            import spacy
+            self._nlp = spacy.load(self.model, exclude=SPACY_EXCLUDE)
+        return self._nlp
+
+    def _key(self, text):
+        return hashlib.sha1(f"{self.model}@{self.version}\0{text}".encode("utf-8")).hexdigest()
+
+    def warm(self, texts):
+        """Lemmatize every text not yet in memory, using the cache and then spaCy"""
+        start = time.time()
+        pending = list(dict.fromkeys(str(t).lower() for t in texts if t is not None))
+        pending = [t for t in pending if t not in self.memo]
+        if not pending:
+            return
+
+        keys = {self._key(t): t for t in pending}
+        key_list = list(keys)
+        for i in range(0, len(key_list), SQLITE_BATCH):
+            chunk = key_list[i:i + SQLITE_BATCH]
+            rows = self.db.execute(
+                f"SELECT key, lemma FROM lemmas WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for key, lemma in rows:
+                self.memo[keys[key]] = lemma
+        self.stats["cache_hits"] += len(pending) - len([t for t in pending if t not in self.memo])
+
+        misses = [t for t in pending if t not in self.memo]
+        if misses:
+            n_process = self.n_process if len(misses) >= SPACY_PARALLEL_MIN else 1
+            print(f"Lemmatizing {len(misses)} texts with spaCy (batch {self.batch_size}, n_process={n_process})...")
+            lemmas = [lemma_text(doc) for doc in self.nlp.pipe(misses, batch_size=self.batch_size, n_process=n_process)]
+            self.memo.update(zip(misses, lemmas))
+            self.db.executemany("INSERT OR REPLACE INTO lemmas (key, lemma) VALUES (?, ?)",
+                                [(self._key(t), lemma) for t, lemma in zip(misses, lemmas)])
+            self.db.commit()
+            self.stats["lemmatized"] += len(misses)
+        self.stats["seconds"] += time.time() - start
+
+    def lemmatize_many(self, texts):
+        texts = [str(t) for t in texts]
+        self.warm(texts)
+        return [self(t) for t in texts]
+
+    def __call__(self, text):
+        """Lemmatize and filter text"""
+        if not isinstance(text, str):
+            text = str(text)
+        text = text.lower()
+        self.stats["texts"] += 1
+        if text in self.memo:
+            self.stats["memory_hits"] += 1
+        else:
+            self.warm([text])
+        return self.memo[text]
+
+    def report(self):
+        s = self.stats
+        print(f"Lemmatizer: {len(self.memo)} distinct texts, {s['cache_hits']} from cache, "
+              f"{s['lemmatized']} lemmatized with spaCy in {s['seconds']:.1f}s")
+        return dict(s, seconds=round(s["seconds"], 2))
+
+    def close(self):
+        self.db.close()
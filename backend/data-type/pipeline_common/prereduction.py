@@ -0,0 +1,171 @@
+"""Linear pre-reduction of wide embeddings ahead of UMAP.
+
+The gte-Qwen2-7B vectors are 3584 dimensions wide, and UMAP's nearest
+neighbour search (and everything after it) pays for every one of them.
+With PREREDUCE_MODE set, ``reduce_cached`` first projects the embeddings to
+PREREDUCE_COMPONENTS dimensions:
+
+- ``pca``: randomized PCA (centered);
+- ``svd``: randomized truncated SVD (uncentered, so dot products and cosine
+  similarities are approximated directly).
+
+With PREREDUCE_VARIANCE (e.g. 0.95) the projection keeps the fewest
+components, up to PREREDUCE_COMPONENTS, whose explained variance reaches the
+threshold. A projection is fitted once per (data, settings) and cached next to
+the UMAP reductions, with its explained variance in a JSON sidecar; the UMAP
+cache key includes the pre-reduction settings.
+
+    python -m pipeline_common.prereduction --embeddings all_embeddings.npy --components 64 128 256
+
+compares UMAP + HDBSCAN with and without pre-reduction on a matrix: time, peak
+RSS, explained variance, silhouette, intra-cluster similarity (always on the
+original vectors) and label agreement (ARI) with the unreduced run.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+PREREDUCE_MODE = os.getenv("PREREDUCE_MODE", "off")
+PREREDUCE_COMPONENTS = int(os.getenv("PREREDUCE_COMPONENTS", "256"))
+PREREDUCE_VARIANCE = float(os.getenv("PREREDUCE_VARIANCE", "0")) or None
+PREREDUCE_SEED = 42
+PREREDUCE_MODES = ("off", "pca", "svd")
+
+
+def prereduce_config(mode=PREREDUCE_MODE, n_components=PREREDUCE_COMPONENTS, variance=PREREDUCE_VARIANCE):
+    """The settings that identify a projection, or None when pre-reduction is off"""
+    if mode not in PREREDUCE_MODES:
+        raise ValueError(f"Unknown PREREDUCE_MODE '{mode}', expected one of {PREREDUCE_MODES}")
+    if mode == "off":
+        return None
+    return {"mode": mode, "n_components": n_components, "variance": variance, "seed": PREREDUCE_SEED}
+
+
+def _fit(embeddings, config):
+    from sklearn.decomposition import PCA, TruncatedSVD
+
+    n_components = min(config["n_components"], embeddings.shape[1] - 1, len(embeddings) - 1)
+    if config["mode"] == "pca":
+        model = PCA(n_components=n_components, svd_solver="randomized", random_state=config["seed"])
+    else:
+        model = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=config["seed"])
+    projected = model.fit_transform(embeddings).astype(np.float32)
+    ratios = model.explained_variance_ratio_
+    if config["variance"]:
+        cumulative = np.cumsum(ratios)
+        n_components = int(min(np.searchsorted(cumulative, config["variance"]) + 1, len(ratios)))
+        projected = np.ascontiguousarray(projected[:, :n_components])
+    return projected, {"components": n_components, "explained_variance": round(float(ratios[:n_components].sum()), 4)}
+
+
+def prereduce(embeddings, config, data_hash=None, cache_dir=None):
+    """Project ``embeddings`` per ``config`` (from ``prereduce_config``); returns (matrix, info).
+
+    ``info`` has the input and output dimensions, the explained variance kept,
+    the fit time and whether the projection came from the cache. With
+    pre-reduction off (``config`` None) the input is returned unchanged and
+    ``info`` is None.
+    """
+    from pipeline_common.sweep import UMAP_CACHE_DIR, fingerprint
+
+    if not config:
+        return embeddings, None
+    data_hash = data_hash or fingerprint(embeddings)
+    key = json.dumps({"data": data_hash, **config}, sort_keys=True)
+    path = Path(cache_dir or UMAP_CACHE_DIR) / f"prereduce_{hashlib.sha256(key.encode()).hexdigest()[:32]}.npy"
+    info_path = path.with_suffix(".json")
+
+    if path.exists() and info_path.exists():
+        with open(info_path) as f:
+            info = json.load(f)
+        info["cached"] = True
+        return np.load(path), info
+
+    start = time.time()
+    projected, info = _fit(np.asarray(embeddings, dtype=np.float32), config)
+    info.update({"mode": config["mode"], "input_dim": int(embeddings.shape[1]), "seconds": round(time.time() - start, 2)})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npy")
+    np.save(tmp_path, projected)
+    os.replace(tmp_path, path)
+    with open(info_path, "w") as f:
+        json.dump(info, f, indent=2)
+    print(f"Pre-reduced {info['input_dim']} -> {info['components']} dimensions ({config['mode']}, "
+          f"{info['explained_variance'] * 100:.1f}% variance kept) in {info['seconds']}s")
+    return projected, dict(info, cached=False)
+
+
+def _cluster(embeddings, reduced_input, umap_params, hdbscan_params, n_components):
+    import hdbscan
+    import umap
+
+    from pipeline_common.benchmark_pipeline import PeakRSS
+    from pipeline_common.cluster_metrics import cluster_similarities, sampled_silhouette
+
+    start = time.time()
+    with PeakRSS() as rss:
+        reduced = umap.UMAP(n_components=n_components, metric="cosine", **umap_params).fit_transform(reduced_input)
+    umap_seconds = time.time() - start
+    labels = hdbscan.HDBSCAN(metric="euclidean", **hdbscan_params).fit_predict(reduced)
+    valid = labels != -1
+    result = {
+        "umap_seconds": round(umap_seconds, 2),
+        "umap_peak_rss_mb": round(rss.peak / 1e6, 1),
+        "umap_rss_growth_mb": round((rss.peak - rss.start) / 1e6, 1),
+        "clusters": int(len(set(labels)) - (1 if -1 in labels else 0)),
+        "noise_percent": round(float(np.mean(~valid) * 100), 2),
+        "silhouette": None,
+        "avg_similarity": None,
+    }
+    if len(set(labels[valid])) > 1:
+        result["silhouette"] = round(sampled_silhouette(reduced[valid], labels[valid], metric="cosine")["score"], 4)
+        similarities = [s for s in cluster_similarities(embeddings, labels).values() if not np.isnan(s)]
+        result["avg_similarity"] = round(float(np.mean(similarities)), 4) if similarities else None
+    return labels, result
+
+
+def main():
+    from sklearn.metrics import adjusted_rand_score
+
+    parser = argparse.ArgumentParser(description="Compare UMAP + HDBSCAN with and without PCA/SVD pre-reduction")
+    parser.add_argument("--embeddings", required=True, help=".npy matrix of original embeddings")
+    parser.add_argument("--mode", choices=["pca", "svd"], default="pca")
+    parser.add_argument("--components", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--variance", type=float, help="keep the fewest components reaching this variance")
+    parser.add_argument("--n-components", type=int, default=20, help="UMAP dimensions, as in the sweep")
+    parser.add_argument("--output", default="prereduction_report.json")
+    args = parser.parse_args()
+
+    embeddings = np.load(args.embeddings).astype(np.float32)
+    umap_params = {"n_neighbors": 15, "min_dist": 0.1}
+    hdbscan_params = {"min_cluster_size": 3, "min_samples": 3, "cluster_selection_method": "eom"}
+    report = {"rows": len(embeddings), "input_dim": int(embeddings.shape[1]), "umap_params": umap_params,
+              "hdbscan_params": hdbscan_params, "runs": []}
+
+    print(f"Baseline: UMAP on all {embeddings.shape[1]} dimensions...")
+    baseline_labels, baseline = _cluster(embeddings, embeddings, umap_params, hdbscan_params, args.n_components)
+    report["baseline"] = baseline
+    print(f"  {baseline}")
+
+    for components in args.components:
+        config = prereduce_config(args.mode, components, args.variance)
+        projected, info = prereduce(embeddings, config)
+        labels, result = _cluster(embeddings, projected, umap_params, hdbscan_params, args.n_components)
+        result.update(info)
+        result["ari_vs_baseline"] = round(float(adjusted_rand_score(baseline_labels, labels)), 4)
+        result["umap_speedup"] = round(baseline["umap_seconds"] / max(result["umap_seconds"], 1e-9), 2)
+        report["runs"].append(result)
+        print(f"  {args.mode} {components}: {result}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved pre-reduction report to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Publish generator progress to a shared MongoDB collection.
+
+Each long-running job upserts a single document (keyed by ``job_id``) into the
+``pipeline_progress`` collection. Writes are rate limited so a fast job does not
+turn into a write storm; the API streams these documents to the dashboard via
+``/api/pipeline/progress/stream``.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_COLLECTION = "pipeline_progress"
+PROGRESS_DB_NAME = os.getenv("PROGRESS_DB_NAME", "sparzaai")
+PROGRESS_PUBLISH_INTERVAL = float(os.getenv("PROGRESS_PUBLISH_INTERVAL", "5"))
+# After a failed write, wait this long before trying Mongo again
+PROGRESS_RETRY_BACKOFF = 60.0
+
+
+class ProgressPublisher:
+    """Rate-limited publisher for per-job throughput, success/failure rates and ETA."""
+
+    def __init__(self, job_name, max_concurrency=None, model=None, total=None,
+                 collection=None, min_interval=PROGRESS_PUBLISH_INTERVAL):
+        self.job_name = job_name
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.started_at = datetime.utcnow()
+        self.job_id = f"{job_name}:{self.host}:{self.pid}:{self.started_at.strftime('%Y%m%d_%H%M%S')}"
+        self.max_concurrency = max_concurrency
+        self.model = model
+        self.total = total
+        self.min_interval = min_interval
+
+        self._collection = collection
+        self._client = None
+        self._start = time.time()
+        self._last_publish = 0.0
+        self._disabled_until = 0.0
+        # publish may run on worker threads; claiming a publish slot is serialized
+        self._claim_lock = threading.Lock()
+        # (timestamp, processed) of the previous publish, for the recent throughput window
+        self._last_sample = (self._start, 0)
+
+    def set_total(self, total):
+        self.total = total
+
+    def _get_collection(self):
+        if self._collection is None:
+            mongo_uri = os.getenv("MONGO_CONNECTION_STRING")
+            if not mongo_uri:
+                raise RuntimeError("MONGO_CONNECTION_STRING is not set")
+            self._client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+            self._collection = self._client[PROGRESS_DB_NAME][PROGRESS_COLLECTION]
+            self._collection.create_index("updated_at")
+            self._collection.create_index("job_name")
+        return self._collection
+
+    def _build_document(self, succeeded, failed, active, status, extra, now):
+        processed = succeeded + failed
+        elapsed = now - self._start
+        throughput = processed / elapsed if elapsed > 0 else 0.0
+
+        last_time, last_processed = self._last_sample
+        window = now - last_time
+        recent_throughput = (processed - last_processed) / window if window > 0 else 0.0
+
+        remaining = max(self.total - processed, 0) if self.total else None
+        eta_seconds = remaining / throughput if remaining and throughput > 0 else None
+
+        doc = {
+            "job_name": self.job_name,
+            "host": self.host,
+            "pid": self.pid,
+            "status": status,
+            "model": self.model,
+            "updated_at": datetime.utcnow(),
+            "elapsed_seconds": round(elapsed, 1),
+            "total": self.total,
+            "processed": processed,
+            "remaining": remaining,
+            "succeeded": succeeded,
+            "failed": failed,
+            "success_rate": round(succeeded / processed, 4) if processed else None,
+            "failure_rate": round(failed / processed, 4) if processed else None,
+            "throughput_per_sec": round(throughput, 4),
+            "throughput_per_hour": round(throughput * 3600, 1),
+            "recent_throughput_per_sec": round(recent_throughput, 4),
+            "eta_seconds": round(eta_seconds) if eta_seconds is not None else None,
+            "active_concurrency": active,
+            "max_concurrency": self.max_concurrency,
+        }
+        if extra:
+            doc["extra"] = extra
+        return doc
+
+    def due(self):
+        """Whether a non-forced publish would write now; lets async callers skip the thread hop"""
+        now = time.time()
+        return now - self._last_publish >= self.min_interval and now >= self._disabled_until
+
+    def publish(self, succeeded, failed, active=0, status="running", extra=None, force=False):
+        """Upsert the job document unless the last publish was under ``min_interval`` ago.
+
+        Returns True when a write was made. Publishing never raises: a broken
+        progress feed must not take the generator down with it. The write is a
+        blocking pymongo call; from a coroutine, run it with ``asyncio.to_thread``.
+        """
+        with self._claim_lock:
+            now = time.time()
+            if not force and (now - self._last_publish < self.min_interval or now < self._disabled_until):
+                return False
+
+            doc = self._build_document(succeeded, failed, active, status, extra, now)
+            self._last_publish = now
+            self._last_sample = (now, doc["processed"])
+
+        try:
+            self._get_collection().update_one(
+                {"_id": self.job_id},
+                {"$set": doc, "$setOnInsert": {"started_at": self.started_at}},
+                upsert=True,
+            )
+            return True
+        except Exception as e:
+            self._disabled_until = now + PROGRESS_RETRY_BACKOFF
+            logger.warning(f"Progress publish failed for {self.job_id}: {e}")
+            return False
+
+    def finish(self, succeeded, failed, status="completed", extra=None):
+        """Write the final snapshot regardless of the rate limit and close the client."""
+        self._disabled_until = 0.0
+        self.publish(succeeded, failed, active=0, status=status, extra=extra, force=True)
+        if self._client is not None:
+            self._client.close()
+            self._client = None
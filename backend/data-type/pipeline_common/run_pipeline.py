@@ -0,0 +1,236 @@
+"""Run the clustering pipeline for several channels from one process.
+
+    python -m pipeline_common.run_pipeline --bank common-bank --channels email chat ticket
+    python -m pipeline_common.run_pipeline --bank EU-bank --channels all --stages embed
+    python -m pipeline_common.run_pipeline --channels email --stages cluster label map
+
+Every channel's embeddings.py loads the embedding model, spaCy and a MongoDB
+client from scratch, so a full refresh paid the model load once per channel.
+Here the ``embed`` stage runs in this process for all selected channels:
+
+- one MongoDB client reads every channel's unembedded documents concurrently
+  (PIPELINE_WORKERS threads);
+- one ``Lemmatizer`` lemmatizes the texts of all channels in a single batch;
+- keyphrases are deduplicated across channels and looked up in the shared
+  embedding cache, and the model loads once, only if something is missing;
+- the write-back (one UpdateMany per keyphrase, as in embeddings.py) runs
+  per channel concurrently.
+
+The later stages (``sweep``, ``cluster``, ``label``, ``map``) are the
+existing channel scripts, which do not load the embedding model. They run as
+subprocesses in their channel's directory, several channels at once and each
+channel's stages in order, with their output in PIPELINE_LOG_DIR.
+
+``CHANNELS`` holds the per-channel configuration: collection, text field and
+the script of each stage. The ``sweep`` stage (the HDBSCAN parameter search)
+only runs when asked for.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from pymongo import MongoClient, UpdateMany
+
+from pipeline_common.embedding_backend import get_embedding_backend
+from pipeline_common.embedding_cache import EmbeddingCache
+from pipeline_common.embedding_codec import encode_embedding
+from pipeline_common.embedding_models import embedding_model_filter
+from pipeline_common.mongo_bulk import bulk_write_chunked
+from pipeline_common.preprocess import Lemmatizer
+
+DATA_TYPE_DIR = Path(__file__).resolve().parent.parent
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "3"))
+PIPELINE_LOG_DIR = Path(os.getenv("PIPELINE_LOG_DIR", DATA_TYPE_DIR / "pipeline_logs"))
+PIPELINE_DB_NAME = os.getenv("PIPELINE_DB_NAME", "sparzaai")
+# Phrases per forward-pass group, as in embeddings.py
+EMBED_BATCH_SIZE = 256
+READ_BATCH_SIZE = 2000
+
+BANKS = ("common-bank", "EU-bank")
+STAGES = ("embed", "sweep", "cluster", "label", "map")
+DEFAULT_STAGES = ("embed", "cluster", "label", "map")
+
+CHANNELS = {
+    "email": {
+        "directory": "Email", "collection": "emailmessages", "text_field": "dominant_topic",
+        "scripts": {"sweep": "clustering.py", "cluster": "k-means.py", "label": "cluster_label.py", "map": "mapping.py"},
+    },
+    "chat": {
+        "directory": "Chat", "collection": "chat-chunks", "text_field": "dominant_topic",
+        "scripts": {"sweep": "clustering1.py", "cluster": "clustering2.py", "label": "labelling.py", "map": "mapping.py"},
+    },
+    "ticket": {
+        "directory": "Ticket", "collection": "tickets", "text_field": "dominant_topic",
+        "scripts": {"sweep": "clustering1.py", "cluster": "clustering2.py", "label": "cluster_label.py", "map": "mapping.py"},
+    },
+    # Embedded for search and analytics; not clustered yet
+    "twitter": {"directory": "twitter", "collection": "twitter", "text_field": "dominant_topic", "scripts": {}},
+    "voice": {"directory": "voice", "collection": "voice", "text_field": "dominant_topic", "scripts": {}},
+}
+
+
+def _read_unembedded(db, name, model_id):
+    """(doc_id, text) for documents of a channel without an embedding from ``model_id``"""
+    channel = CHANNELS[name]
+    text_field = channel["text_field"]
+    query = {
+        text_field: {"$exists": True, "$ne": None},
+        "$nor": [{"embeddings": {"$exists": True}, **embedding_model_filter(model_id)}],
+    }
+    rows = []
+    for doc in db[channel["collection"]].find(query, {text_field: 1}).batch_size(READ_BATCH_SIZE):
+        text = doc.get(text_field)
+        if isinstance(text, str) and text.strip():
+            rows.append((doc["_id"], text))
+    print(f"[{name}] {len(rows)} documents need embeddings")
+    return rows
+
+
+def _write_back(db, name, keyphrase_to_documents, vectors, model_id):
+    channel = CHANNELS[name]
+    operations = [
+        UpdateMany({"_id": {"$in": doc_ids}},
+                   {"$set": {"embeddings": encode_embedding(vectors[keyphrase]), "embedding_model": model_id,
+                             f"{channel['text_field']}_lemma": keyphrase}})
+        for keyphrase, doc_ids in keyphrase_to_documents.items() if keyphrase in vectors
+    ]
+    stats = bulk_write_chunked(db[channel["collection"]], operations, label=f"[{name}] embedding write-back")
+    return {"keyphrases": len(operations), "documents_updated": stats["matched"],
+            "failed_operations": stats["failed_operations"], "seconds": stats["seconds"]}
+
+
+def run_embed_stage(db, names, workers=PIPELINE_WORKERS):
+    """Embed the unembedded documents of every channel in ``names`` with one model load"""
+    start = time.time()
+    backend = get_embedding_backend()
+    print(f"Embedding model: {backend.model_id}")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = dict(zip(names, pool.map(lambda name: _read_unembedded(db, name, backend.model_id), names)))
+
+    # One spaCy pass (and one lemma cache lookup) for every channel's texts
+    lemmatizer = Lemmatizer()
+    lemmatizer.warm([text for channel_rows in rows.values() for _, text in channel_rows])
+    keyphrase_documents = {}
+    for name, channel_rows in rows.items():
+        mapping = keyphrase_documents[name] = {}
+        for doc_id, text in channel_rows:
+            keyphrase = lemmatizer(text)
+            if keyphrase.strip():
+                mapping.setdefault(keyphrase, []).append(doc_id)
+    lemmatizer.report()
+    lemmatizer.close()
+
+    keyphrases = list(dict.fromkeys(k for mapping in keyphrase_documents.values() for k in mapping))
+    embedding_cache = EmbeddingCache(backend.cache_name, backend.revision)
+    vectors = embedding_cache.get_many(keyphrases)
+    missing = [k for k in keyphrases if k not in vectors]
+    print(f"{len(keyphrases)} distinct keyphrases across {len(names)} channels: "
+          f"{len(vectors)} cached, {len(missing)} to embed")
+    if missing:
+        backend.load()
+        backend.check_parity(missing)
+        for i in range(0, len(missing), EMBED_BATCH_SIZE):
+            batch = missing[i:i + EMBED_BATCH_SIZE]
+            computed = [(phrase, vector) for phrase, vector in zip(batch, backend.embed(batch)) if vector is not None]
+            embedding_cache.put_many(computed)
+            vectors.update(computed)
+            print(f"Embedded {min(i + EMBED_BATCH_SIZE, len(missing))}/{len(missing)} keyphrases")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(_write_back, db, name, keyphrase_documents[name], vectors, backend.model_id)
+                   for name in names}
+        channels = {name: dict(future.result(), documents=len(rows[name])) for name, future in futures.items()}
+
+    return {
+        "channels": channels,
+        "distinct_keyphrases": len(keyphrases),
+        "embedded": len(missing),
+        "embedding_model": backend.model_id,
+        "embedding_cache": embedding_cache.report(),
+        "seconds": round(time.time() - start, 1),
+    }
+
+
+def _run_script(bank, name, stage, log_dir):
+    channel = CHANNELS[name]
+    script = channel["scripts"][stage]
+    workdir = DATA_TYPE_DIR / bank / "clustering" / channel["directory"]
+    log_path = log_dir / f"{bank}-{name}-{stage}.log"
+    start = time.time()
+    with open(log_path, "w", encoding="utf-8") as log:
+        returncode = subprocess.run([sys.executable, script], cwd=workdir, stdout=log,
+                                    stderr=subprocess.STDOUT).returncode
+    seconds = round(time.time() - start, 1)
+    print(f"[{name}] {stage} ({script}) {'finished' if returncode == 0 else f'FAILED ({returncode})'} "
+          f"in {seconds}s; log: {log_path}")
+    return {"script": script, "returncode": returncode, "seconds": seconds, "log": str(log_path)}
+
+
+def _run_channel_stages(bank, name, stages, log_dir):
+    """Run a channel's script stages in order, stopping at the first failure"""
+    results = {}
+    for stage in stages:
+        if stage not in CHANNELS[name]["scripts"]:
+            continue
+        results[stage] = _run_script(bank, name, stage, log_dir)
+        if results[stage]["returncode"] != 0:
+            break
+    return results
+
+
+def run_pipeline(bank, names, stages=DEFAULT_STAGES, workers=PIPELINE_WORKERS, db_name=PIPELINE_DB_NAME):
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    log_dir = PIPELINE_LOG_DIR / run_id
+    log_dir.mkdir(parents=True, exist_ok=True)
+    report = {"run_id": run_id, "bank": bank, "channels": list(names), "stages": list(stages)}
+    start = time.time()
+
+    if "embed" in stages:
+        client = MongoClient(os.getenv("MONGO_CONNECTION_STRING"))
+        try:
+            report["embed"] = run_embed_stage(client[db_name], names, workers)
+        finally:
+            client.close()
+
+    script_stages = [stage for stage in stages if stage != "embed"]
+    if script_stages:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {name: pool.submit(_run_channel_stages, bank, name, script_stages, log_dir) for name in names}
+            report["scripts"] = {name: future.result() for name, future in futures.items()}
+
+    report["seconds"] = round(time.time() - start, 1)
+    with open(log_dir / "report.json", "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Pipeline run {run_id} finished in {report['seconds']}s; report: {log_dir / 'report.json'}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the clustering pipeline for several channels in one process")
+    parser.add_argument("--bank", choices=BANKS, default="common-bank")
+    parser.add_argument("--channels", nargs="+", default=["email", "chat", "ticket"],
+                        choices=sorted(CHANNELS) + ["all"])
+    parser.add_argument("--stages", nargs="+", default=list(DEFAULT_STAGES), choices=STAGES)
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS, help="channels processed at once")
+    parser.add_argument("--db", default=PIPELINE_DB_NAME)
+    args = parser.parse_args()
+
+    names = sorted(CHANNELS) if "all" in args.channels else list(dict.fromkeys(args.channels))
+    # Keep the pipeline order whatever order the stages were given in
+    stages = [stage for stage in STAGES if stage in args.stages]
+    report = run_pipeline(args.bank, names, stages, args.workers, args.db)
+    failed = [f"{name}/{stage}" for name, results in report.get("scripts", {}).items()
+              for stage, result in results.items() if result["returncode"] != 0]
+    if failed:
+        print(f"Failed stages: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
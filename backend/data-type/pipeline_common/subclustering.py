@@ -0,0 +1,160 @@
+"""Split a cluster's keyphrases into subclusters from their embeddings.
+
+The labelling scripts used to ask the LLM to partition each cluster's
+keyphrases, which was slow, different on every run and overflowed the context
+window for large clusters. ``group_keyphrases`` partitions them
+algorithmically instead, so the LLM only has to name each group:
+
+- ``load_cluster_keyphrase_embeddings`` reads the member messages of a
+  cluster and averages the normalized embeddings of each keyphrase;
+- ``agglomerative`` (average linkage, cosine) cuts the tree at about one group
+  per SUBCLUSTER_TARGET_SIZE keyphrases; ``hdbscan`` finds dense groups of at
+  least SUBCLUSTER_MIN_SIZE and attaches noise to the nearest group;
+- groups above SUBCLUSTER_MAX_SIZE are split in two until they fit, and
+  groups below SUBCLUSTER_MIN_SIZE merge into the group with the closest
+  centroid.
+
+Each group lists its keyphrases closest to the centroid first, so a naming
+prompt can show the first SUBCLUSTER_NAME_SAMPLE of them. The result depends
+only on the embeddings, not on the order of the keyphrases.
+"""
+import logging
+import math
+import os
+
+import numpy as np
+
+from pipeline_common.embedding_codec import decode_embedding, embedding_dimension
+from pipeline_common.embedding_models import configured_model_id, embedding_model_filter
+
+logger = logging.getLogger(__name__)
+
+# "embedding" groups keyphrases algorithmically and has the LLM name the groups; "llm" keeps LLM partitioning
+SUBCLUSTER_MODE = os.getenv("SUBCLUSTER_MODE", "embedding")
+SUBCLUSTER_METHOD = os.getenv("SUBCLUSTER_METHOD", "agglomerative")
+SUBCLUSTER_MIN_SIZE = int(os.getenv("SUBCLUSTER_MIN_SIZE", "3"))
+SUBCLUSTER_MAX_SIZE = int(os.getenv("SUBCLUSTER_MAX_SIZE", "25"))
+SUBCLUSTER_TARGET_SIZE = int(os.getenv("SUBCLUSTER_TARGET_SIZE", "12"))
+# Keyphrases per group shown to the LLM when naming it
+SUBCLUSTER_NAME_SAMPLE = int(os.getenv("SUBCLUSTER_NAME_SAMPLE", "15"))
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def load_cluster_keyphrase_embeddings(collection, cluster_id, model_id=None):
+    """{keyphrase: mean normalized embedding} over the messages of ``cluster_id``"""
+    query = {"kmeans_cluster_id": cluster_id, "kmeans_cluster_keyphrase": {"$type": "string"},
+             "embeddings": {"$exists": True}, **embedding_model_filter(model_id or configured_model_id())}
+    sums, counts = {}, {}
+    for doc in collection.find(query, {"kmeans_cluster_keyphrase": 1, "embeddings": 1}):
+        if not embedding_dimension(doc.get("embeddings")):
+            continue
+        keyphrase = doc["kmeans_cluster_keyphrase"]
+        vector = _normalize(decode_embedding(doc["embeddings"]).astype(np.float64))
+        if keyphrase in sums and len(sums[keyphrase]) != len(vector):
+            continue
+        sums[keyphrase] = sums[keyphrase] + vector if keyphrase in sums else vector
+        counts[keyphrase] = counts.get(keyphrase, 0) + 1
+    return {keyphrase: _normalize(sums[keyphrase] / counts[keyphrase]) for keyphrase in sums}
+
+
+def _agglomerative(vectors, n_groups):
+    from sklearn.cluster import AgglomerativeClustering
+
+    if n_groups <= 1 or len(vectors) < 2:
+        return np.zeros(len(vectors), dtype=int)
+    return AgglomerativeClustering(n_clusters=n_groups, metric="cosine", linkage="average").fit_predict(vectors)
+
+
+def _hdbscan(vectors, min_size):
+    import hdbscan
+
+    if len(vectors) < 2 * min_size:
+        return np.zeros(len(vectors), dtype=int)
+    # Euclidean distance on unit vectors orders pairs like cosine distance
+    labels = hdbscan.HDBSCAN(min_cluster_size=min_size, metric="euclidean").fit_predict(vectors)
+    groups = sorted(set(labels) - {-1})
+    if not groups:
+        return np.zeros(len(vectors), dtype=int)
+    centroids = _normalize(np.stack([vectors[labels == g].mean(axis=0) for g in groups]))
+    noise = labels == -1
+    if noise.any():
+        labels[noise] = np.asarray(groups)[np.argmax(vectors[noise] @ centroids.T, axis=1)]
+    return labels
+
+
+def _split_large(vectors, indices, max_size):
+    if len(indices) <= max_size:
+        return [indices]
+    halves = _agglomerative(vectors[indices], 2)
+    if halves.min() == halves.max():
+        # Identical vectors: split in order instead
+        middle = len(indices) // 2
+        parts = [indices[:middle], indices[middle:]]
+    else:
+        parts = [indices[halves == 0], indices[halves == 1]]
+    return [group for part in parts for group in _split_large(vectors, part, max_size)]
+
+
+def _merge_small(vectors, groups, min_size, max_size):
+    groups = sorted(groups, key=len)
+    while len(groups) > 1 and len(groups[0]) < min_size:
+        small = groups.pop(0)
+        centroids = _normalize(np.stack([vectors[g].mean(axis=0) for g in groups]))
+        similarity = centroids @ _normalize(vectors[small].mean(axis=0))
+        # Prefer a group that stays within the size range
+        fits = np.array([len(g) + len(small) <= max_size for g in groups])
+        if fits.any():
+            similarity = np.where(fits, similarity, -np.inf)
+        target = int(np.argmax(similarity))
+        groups[target] = np.concatenate([groups[target], small])
+        groups.sort(key=len)
+    return groups
+
+
+def group_keyphrases(keyphrase_vectors, method=SUBCLUSTER_METHOD, min_size=SUBCLUSTER_MIN_SIZE,
+                     max_size=SUBCLUSTER_MAX_SIZE, target_size=SUBCLUSTER_TARGET_SIZE):
+    """Partition {keyphrase: vector} into lists of keyphrases, central keyphrases first"""
+    if not keyphrase_vectors:
+        return []
+    keyphrases = sorted(keyphrase_vectors)
+    vectors = _normalize(np.stack([keyphrase_vectors[k] for k in keyphrases]))
+    if method == "hdbscan":
+        labels = _hdbscan(vectors, min_size)
+    elif method == "agglomerative":
+        labels = _agglomerative(vectors, min(len(vectors), math.ceil(len(vectors) / max(target_size, 1))))
+    else:
+        raise ValueError(f"Unknown subclustering method: {method}")
+
+    groups = []
+    for label in sorted(set(labels)):
+        groups.extend(_split_large(vectors, np.flatnonzero(labels == label), max_size))
+    groups = _merge_small(vectors, groups, min_size, max_size)
+
+    result = []
+    for indices in groups:
+        centrality = vectors[indices] @ _normalize(vectors[indices].mean(axis=0))
+        result.append([keyphrases[i] for i in indices[np.lexsort((indices, -centrality))]])
+    result.sort(key=lambda group: (-len(group), group[0]))
+    return result
+
+
+def subcluster_groups(collection, cluster_id, keyphrases, **kwargs):
+    """Groups for a cluster's ``keyphrases`` ([] if none has a stored embedding); keyphrases
+    without an embedding form groups of their own"""
+    vectors = load_cluster_keyphrase_embeddings(collection, cluster_id)
+    vectors = {keyphrase: vectors[keyphrase] for keyphrase in set(keyphrases) if keyphrase in vectors}
+    if not vectors:
+        return []
+    groups = group_keyphrases(vectors, **kwargs)
+    unembedded = sorted(set(keyphrases) - set(vectors))
+    if unembedded:
+        logger.info(f"Cluster {cluster_id}: {len(unembedded)} keyphrases have no stored embedding")
+        max_size = kwargs.get("max_size", SUBCLUSTER_MAX_SIZE)
+        groups.extend(unembedded[i:i + max_size] for i in range(0, len(unembedded), max_size))
+    logger.info(f"Cluster {cluster_id}: {len(keyphrases)} keyphrases in {len(groups)} subclusters "
+                f"(sizes {[len(g) for g in groups]})")
+    return groups
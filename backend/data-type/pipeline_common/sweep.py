@@ -0,0 +1,197 @@
+"""Parallel UMAP x HDBSCAN parameter sweep with on-disk UMAP reductions.
+
+The sweep runs in two phases on a loky process pool (joblib, already required
+by hdbscan; unlike multiprocessing it does not re-run the calling script in
+each worker):
+
+1. one task per UMAP configuration, each writing its reduction to the cache;
+2. one task per (UMAP, HDBSCAN) pair, reading the cached reduction and
+   computing labels, silhouette, coherence and intra-cluster similarity.
+
+Reductions are cached under UMAP_CACHE_DIR keyed by a hash of the input matrix
+and the UMAP parameters, so reruns and other HDBSCAN variants skip UMAP.
+With PREREDUCE_MODE set (see ``prereduction``), UMAP runs on a cached PCA/SVD
+projection of the embeddings, fitted once per sweep in the calling process.
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import umap
+from joblib import Parallel, delayed
+
+from pipeline_common.cluster_metrics import cluster_similarities, sampled_silhouette
+from pipeline_common.coherence import COHERENCE_MODE, CoherenceScorer, compare_modes, print_mode_comparison
+from pipeline_common.prereduction import prereduce, prereduce_config
+
+UMAP_CACHE_DIR = Path(os.getenv("UMAP_CACHE_DIR", Path(__file__).resolve().parent.parent / "umap_cache"))
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", str(os.cpu_count() or 1)))
+
+
+def fingerprint(array):
+    """Stable hash of a matrix's shape, dtype and contents"""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(f"{array.shape}|{array.dtype}".encode())
+    digest.update(memoryview(array).cast("B"))
+    return digest.hexdigest()[:32]
+
+
+def reduction_path(data_hash, n_components, umap_params, metric="cosine", cache_dir=UMAP_CACHE_DIR,
+                   prereduce=None):
+    key = {
+        "data": data_hash,
+        "n_components": n_components,
+        "metric": metric,
+        "params": umap_params,
+        "umap": getattr(umap, "__version__", "unknown"),
+    }
+    # Only keyed when enabled, so reductions cached without pre-reduction stay valid
+    if prereduce:
+        key["prereduce"] = prereduce
+    key = json.dumps(key, sort_keys=True)
+    return Path(cache_dir) / f"umap_{hashlib.sha256(key.encode()).hexdigest()[:32]}.npy"
+
+
+def reduce_cached(embeddings, n_components, umap_params, metric="cosine", data_hash=None, cache_dir=UMAP_CACHE_DIR):
+    """UMAP-reduce ``embeddings``, reusing a cached reduction for the same data and params"""
+    data_hash = data_hash or fingerprint(embeddings)
+    config = prereduce_config()
+    path = reduction_path(data_hash, n_components, umap_params, metric, cache_dir, config)
+    if path.exists():
+        print(f"Using cached UMAP reduction {path.name} ({n_components}d, {umap_params})")
+        return np.load(path)
+
+    embeddings, _ = prereduce(embeddings, config, data_hash, cache_dir)
+    reduced = umap.UMAP(n_components=n_components, metric=metric, **umap_params).fit_transform(embeddings)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npy")
+    np.save(tmp_path, reduced)
+    os.replace(tmp_path, path)
+    return reduced
+
+
+def _reduce_task(embeddings, n_components, umap_params, data_hash, cache_dir):
+    try:
+        start = time.time()
+        reduce_cached(embeddings, n_components, umap_params, data_hash=data_hash, cache_dir=cache_dir)
+        return {"umap_params": umap_params, "ok": True, "seconds": round(time.time() - start, 1)}
+    except Exception as e:
+        return {"umap_params": umap_params, "ok": False, "error": str(e)}
+
+
+def _evaluate_task(exp_id, reduced_file, embeddings, coherence_scorer, umap_params, hdbscan_params):
+    import hdbscan
+
+    start = time.time()
+    reduced_embeddings = np.load(reduced_file)
+    # Parallelism comes from the pool; one core per HDBSCAN fit avoids oversubscription
+    clusterer = hdbscan.HDBSCAN(metric="euclidean", core_dist_n_jobs=1, **hdbscan_params)
+    labels = clusterer.fit_predict(reduced_embeddings)
+
+    num_clusters = len(set(labels)) - (1 if -1 in labels else 0)
+    noise_count = int(np.sum(labels == -1))
+    result = {
+        "experiment_id": exp_id,
+        "reduction_file": reduced_file,
+        "umap_params": umap_params,
+        "hdbscan_params": hdbscan_params,
+        "labels": labels,
+        "num_clusters": num_clusters,
+        "noise_count": noise_count,
+        "noise_percent": noise_count / len(labels) * 100,
+        "silhouette_score": np.nan,
+        "silhouette_stderr": np.nan,
+        "silhouette_sample_size": 0,
+        "coherence_score": np.nan,
+        "coherence_npmi": np.nan,
+        "coherence_c_v": np.nan,
+        "cluster_similarities": {},
+        "avg_similarity": np.nan,
+        "errors": [],
+    }
+    # Only noise or a single cluster: nothing further to score
+    if num_clusters <= 1:
+        result["seconds"] = round(time.time() - start, 1)
+        return result
+
+    try:
+        valid_labels = labels != -1
+        if valid_labels.sum() > 1:
+            silhouette = sampled_silhouette(reduced_embeddings[valid_labels], labels[valid_labels], metric="cosine")
+            result["silhouette_score"] = silhouette["score"]
+            result["silhouette_stderr"] = silhouette["stderr"]
+            result["silhouette_sample_size"] = silhouette["sample_size"]
+    except Exception as e:
+        result["errors"].append(f"Could not calculate silhouette score: {e}")
+
+    try:
+        coherence = coherence_scorer.score(labels)
+        result["coherence_score"] = coherence["coherence"]
+        result["coherence_npmi"] = coherence["npmi"]
+        result["coherence_c_v"] = coherence["c_v"]
+    except Exception as e:
+        result["errors"].append(f"Error calculating coherence score: {e}")
+
+    # Use original embeddings for similarity calculations
+    result["cluster_similarities"] = cluster_similarities(embeddings, labels)
+    valid_similarities = [sim for sim in result["cluster_similarities"].values() if not np.isnan(sim)]
+    result["avg_similarity"] = np.mean(valid_similarities) if valid_similarities else np.nan
+    result["seconds"] = round(time.time() - start, 1)
+    return result
+
+
+def run_hdbscan_sweep(embeddings, keyphrases, umap_params_list, hdbscan_params_list, n_components=20,
+                      phrase_repeats=None, n_jobs=SWEEP_WORKERS, cache_dir=UMAP_CACHE_DIR):
+    """Evaluate every (UMAP, HDBSCAN) pair; results come back in grid order.
+
+    ``phrase_repeats`` gives how many documents each keyphrase row stands for,
+    so coherence statistics count documents rather than unique keyphrases.
+    Experiments whose UMAP reduction failed are left out. Each result carries
+    the input ``data_hash``, the ``reduction_file`` it was clustered on and
+    the ``prereduce`` projection UMAP ran on (None when off).
+    """
+    data_hash = fingerprint(embeddings)
+    config = prereduce_config()
+    # Dictionary and co-occurrence statistics are shared by every experiment
+    coherence_scorer = CoherenceScorer(keyphrases, phrase_repeats)
+    n_jobs = max(1, min(n_jobs, len(umap_params_list) * len(hdbscan_params_list)))
+    print(f"Running {len(umap_params_list)}x{len(hdbscan_params_list)} sweep on {n_jobs} workers (data {data_hash[:12]})")
+
+    with Parallel(n_jobs=n_jobs, backend="loky") as parallel:
+        pending = [p for p in umap_params_list
+                   if not reduction_path(data_hash, n_components, p, cache_dir=cache_dir, prereduce=config).exists()]
+        # Fit the projection once here; the UMAP workers then load it from the cache
+        _, prereduce_info = prereduce(embeddings, config, data_hash, cache_dir)
+        if pending:
+            print(f"Computing {len(pending)} UMAP reductions ({len(umap_params_list) - len(pending)} cached)...")
+            for outcome in parallel(delayed(_reduce_task)(embeddings, n_components, p, data_hash, cache_dir) for p in pending):
+                if outcome["ok"]:
+                    print(f"UMAP {outcome['umap_params']} reduced in {outcome['seconds']}s")
+                else:
+                    print(f"UMAP reduction failed for {outcome['umap_params']}: {outcome['error']}")
+
+        tasks = []
+        for umap_idx, umap_params in enumerate(umap_params_list):
+            reduced_file = reduction_path(data_hash, n_components, umap_params, cache_dir=cache_dir, prereduce=config)
+            if not reduced_file.exists():
+                continue
+            for hdbscan_idx, hdbscan_params in enumerate(hdbscan_params_list):
+                exp_id = f"umap_{umap_idx+1}_hdbscan_{hdbscan_idx+1}"
+                tasks.append(delayed(_evaluate_task)(exp_id, str(reduced_file), embeddings, coherence_scorer,
+                                                     umap_params, hdbscan_params))
+        results = parallel(tasks)
+    for result in results:
+        result["data_hash"] = data_hash
+        result["n_components"] = n_components
+        result["prereduce"] = prereduce_info
+
+    if COHERENCE_MODE == "both":
+        print_mode_comparison(compare_modes(
+            [r["experiment_id"] for r in results],
+            [r["coherence_npmi"] for r in results],
+            [r["coherence_c_v"] for r in results],
+        ))
+    return results